@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+
+# Micro-benchmarks for the public REStore methods.
+#
+# For each of the given data set sizes, we generate a synthetic DB (see
+# gendata.py), and time a number of calls to each REStore method against it,
+# with inputs picked at random from the data.  The results (per-call latency
+# statistics, by data set size and method) are written out as JSON.  Given a
+# baseline (the saved results of an earlier run), we also report how each
+# method fared against it, and exit with status 2 if any of them got slower
+# by more than the threshold.
+#
+# Reads are timed with the result cache turned off (unless asked otherwise),
+# so that we measure the SQL, not the cache.
+
+import argparse
+import collections
+import collections.abc
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import gendata
+from restore import REStore, hash_password
+
+
+# Data set sizes to run with by default, as scales for gendata.py.
+default_scales = [0.001, 0.01]
+
+# Number of (timed) calls per method; some of the heavier methods are capped
+# at fewer calls (see `benchmarks' below).
+default_number = 200
+
+# Password of all the generated users and admins.
+password = 'password'
+
+# Status to exit with if any method got slower than the baseline.
+REGRESSION_STATUS = 2
+
+# Length (in seconds) of the time ranges the "_between" listings are timed on.
+DAY = 24 * 60 * 60
+
+
+def parse_args():
+    '''Parse command line arguments.'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', '--baseline', type=str,
+                        help='compare the results with those in this file '
+                             '(written earlier with --save)')
+    parser.add_argument('-d', '--data-dir', type=str,
+                        help='keep the generated data sets in this directory, '
+                             'and reuse them in later runs')
+    parser.add_argument('-m', '--methods', type=str, nargs='+',
+                        help='only run the benchmarks for these methods')
+    parser.add_argument('-n', '--number', type=int, default=default_number,
+                        help='specify the number of calls per method')
+    parser.add_argument('-o', '--output-file', type=str,
+                        help='also write the results (as JSON) to this file')
+    parser.add_argument('-s', '--scales', type=float, nargs='+',
+                        default=default_scales,
+                        help='specify the data set sizes, relative to '
+                             'production scale (see gendata.py)')
+    parser.add_argument('-t', '--threshold', type=float, default=0.25,
+                        help='specify the (relative) slowdown in the median '
+                             'latency that counts as a regression')
+    parser.add_argument('--cache', action='store_true',
+                        help='keep the result cache of REStore enabled')
+    parser.add_argument('--save', type=str,
+                        help='save the results as a baseline in this file')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='specify the random seed')
+    return parser.parse_args()
+
+
+def error_exit(msg, status):
+    sys.stderr.write('%s\n' % msg)
+    sys.exit(status)
+
+
+def log(msg):
+    sys.stderr.write('%s\n' % msg)
+
+
+# --- Inputs for the benchmarks. ---
+
+def pick(conn, rng, n, table, columns):
+    '''Return (up to) `n' random rows of `columns' from `table', whose first
+    column must be its (integer) primary key.'''
+    key = columns.split(',')[0]
+    top = conn.execute('SELECT max(%s) FROM %s;' % (key, table)).fetchone()[0]
+    keys = rng.sample(range(1, (top or 0) + 1), min(n, top or 0))
+    rows = []
+    for i in range(0, len(keys), 500):
+        chunk = keys[i:i+500]
+        rows += conn.execute('SELECT %s FROM %s WHERE %s IN (%s);'
+                             % (columns, table, key,
+                                ', '.join('?' * len(chunk))), chunk)
+    rows.sort()
+    rng.shuffle(rows)
+    return rows
+
+
+class Sample:
+    '''Rows picked at random from a data set, used as benchmark inputs.'''
+    def __init__(self, dbfile, rng, n=1000):
+        conn = sqlite3.connect(dbfile)
+        self.users = pick(conn, rng, n, 'users', 'uid, username')
+        self.admins = pick(conn, rng, n, 'admins', 'aid, username, vid')
+        self.vendors = pick(conn, rng, n, 'vendors', 'vid, name')
+        self.items = pick(conn, rng, n, 'items', 'iid, name')
+        self.dishes = pick(conn, rng, n, 'dishes', 'did, iid, vid')
+        self.orders = pick(conn, rng, n, 'orders', 'oid, uid, timestamp')
+        conn.close()
+        words = {word.lower() for _, name in self.items + self.vendors
+                 for word in name.split() if len(word) >= 3}
+        self.terms = sorted(words)
+        self.short_terms = sorted({word[:2] for word in words})
+
+
+    def __call__(self, rows, n):
+        '''Return `n' of `rows', cycling through them as needed.'''
+        return [rows[i % len(rows)] for i in range(n)]
+
+
+# Each benchmark has a name, the REStore method it times, and a setup function
+# which (untimed) prepares for, and returns the arguments of, `n' calls.
+# Where `number' is set, it caps the number of calls.
+Benchmark = collections.namedtuple('Benchmark', 'name method setup number',
+                                   defaults=(None,))
+
+
+def new_users(prefix, n):
+    return [('%s-%d' % (prefix, i), password, 'Bench User', '0000000000')
+            for i in range(n)]
+
+
+def new_dishes(store, sample, prefix, n):
+    '''Add `n' new items, and return (iid, vid, price) tuples for dishes of
+    them (which are not in the DB yet).'''
+    iids = store.add_items(['%s %d' % (prefix, i) for i in range(n)])
+    vendors = sample(sample.vendors, n)
+    return [(iids['%s %d' % (prefix, i)], vid, 99.0)
+            for i, (vid, _) in enumerate(vendors)]
+
+
+def add_hashed_users(store, users):
+    '''Add `users' (as returned by new_users()) quickly: without hashing each
+    of their passwords.'''
+    phash = hash_password(password)
+    store.add_users([(uname, phash, fname, phone)
+                     for uname, _, fname, phone in users], hashed=True)
+
+
+def setup_del_user(store, sample, n):
+    users = new_users('bench-del-user', n)
+    add_hashed_users(store, users)
+    return [(uname,) for uname, _, _, _ in users]
+
+
+def setup_del_users(store, sample, n):
+    users = new_users('bench-del-users', n * 100)
+    add_hashed_users(store, users)
+    unames = [uname for uname, _, _, _ in users]
+    return [(unames[i:i+100],) for i in range(0, len(unames), 100)]
+
+
+def setup_del_admin(store, sample, n):
+    admins = [('bench-del-admin-%d' % i, password, vid)
+              for i, (_, _, vid) in enumerate(sample(sample.admins, n))]
+    with store.transaction():
+        for admin in admins:
+            store.add_admin(*admin)
+    return [(uname,) for uname, _, _ in admins]
+
+
+def setup_del_vendor(store, sample, n):
+    names = ['Bench Del Vendor %d' % i for i in range(n)]
+    with store.transaction():
+        for name in names:
+            store.add_vendor(name, 'Bench Road')
+    return [(name,) for name in names]
+
+
+def setup_del_item(store, sample, n):
+    names = ['Bench Del Item %d' % i for i in range(n)]
+    store.add_items(names)
+    return [(name,) for name in names]
+
+
+def setup_del_dish(store, sample, n):
+    dishes = new_dishes(store, sample, 'Bench Del Dish', n)
+    store.add_dishes(dishes)
+    return [(iid, vid) for iid, vid, _ in dishes]
+
+
+def setup_add_order_dish(store, sample, n):
+    oids = [store.add_order(uid, ts)
+            for _, uid, ts in sample(sample.orders, n)]
+    return [(oid, did, 1)
+            for oid, (did, _, _) in zip(oids, sample(sample.dishes, n))]
+
+
+def setup_place_order(store, sample, n):
+    # Each order has 3 dishes, which need not be from the same vendor here.
+    dids = [did for did, _, _ in sample(sample.dishes, n * 3)]
+    return [(uid, ts, [(did, 1) for did in dids[3*i:3*i+3]])
+            for i, (_, uid, ts) in enumerate(sample(sample.orders, n))]
+
+
+def setup_del_order(store, sample, n):
+    return [(store.place_order(*args),)
+            for args in setup_place_order(store, sample, n)]
+
+
+benchmarks = [
+    # Users.
+    Benchmark('get_uid', 'get_uid',
+              lambda store, s, n: [(u,) for _, u in s(s.users, n)]),
+    # NOTE: The methods that hash (or check) passwords are slow by design, so
+    # we make fewer calls to those.
+    Benchmark('add_user', 'add_user',
+              lambda store, s, n: new_users('bench-add-user', n), 20),
+    Benchmark('add_users[10]', 'add_users',
+              lambda store, s, n: [(new_users('bench-add-users-%d' % i, 10),)
+                                   for i in range(n)], 5),
+    Benchmark('user_exists', 'user_exists',
+              lambda store, s, n: [(u,) for _, u in s(s.users, n)]),
+    Benchmark('del_user', 'del_user', setup_del_user),
+    Benchmark('del_users[100]', 'del_users', setup_del_users, 20),
+    Benchmark('check_user_credentials', 'check_user_credentials',
+              lambda store, s, n: [(u, password) for _, u in s(s.users, n)],
+              20),
+    Benchmark('user_data', 'user_data',
+              lambda store, s, n: [(uid,) for uid, _ in s(s.users, n)]),
+    # Admins.
+    Benchmark('add_admin', 'add_admin',
+              lambda store, s, n: [('bench-add-admin-%d' % i, password, vid)
+                                   for i, (_, _, vid)
+                                   in enumerate(s(s.admins, n))], 20),
+    Benchmark('admin_exists', 'admin_exists',
+              lambda store, s, n: [(u,) for _, u, _ in s(s.admins, n)]),
+    Benchmark('del_admin', 'del_admin', setup_del_admin, 20),
+    Benchmark('check_admin_credentials', 'check_admin_credentials',
+              lambda store, s, n: [(u, password)
+                                   for _, u, _ in s(s.admins, n)], 20),
+    # Vendors.
+    Benchmark('get_vid', 'get_vid',
+              lambda store, s, n: [(name,) for _, name in s(s.vendors, n)]),
+    Benchmark('add_vendor', 'add_vendor',
+              lambda store, s, n: [('Bench Add Vendor %d' % i, 'Bench Road')
+                                   for i in range(n)]),
+    Benchmark('vendor_exists', 'vendor_exists',
+              lambda store, s, n: [(name,) for _, name in s(s.vendors, n)]),
+    Benchmark('del_vendor', 'del_vendor', setup_del_vendor),
+    Benchmark('list_vendors', 'list_vendors',
+              lambda store, s, n: [()] * n, 20),
+    Benchmark('list_vendors[page]', 'list_vendors',
+              lambda store, s, n: [(vid, 100) for vid, _ in s(s.vendors, n)]),
+    Benchmark('list_vendors_by_name', 'list_vendors_by_name',
+              lambda store, s, n: [(t,) for t in s(s.terms, n)]),
+    Benchmark('catalog_version', 'catalog_version',
+              lambda store, s, n: [()] * n),
+    # Items.
+    Benchmark('add_item', 'add_item',
+              lambda store, s, n: [('Bench Add Item %d' % i,)
+                                   for i in range(n)]),
+    Benchmark('get_iid', 'get_iid',
+              lambda store, s, n: [(name,) for _, name in s(s.items, n)]),
+    Benchmark('add_items[100]', 'add_items',
+              lambda store, s, n: [(['Bench Add Items %d %d' % (i, j)
+                                     for j in range(100)],)
+                                   for i in range(n)], 20),
+    Benchmark('item_exists', 'item_exists',
+              lambda store, s, n: [(name,) for _, name in s(s.items, n)]),
+    Benchmark('del_item', 'del_item', setup_del_item),
+    # Dishes.
+    Benchmark('add_dish', 'add_dish',
+              lambda store, s, n: new_dishes(store, s, 'Bench Add Dish', n)),
+    Benchmark('get_did', 'get_did',
+              lambda store, s, n: [(iid, vid)
+                                   for _, iid, vid in s(s.dishes, n)]),
+    Benchmark('add_dishes[100]', 'add_dishes',
+              lambda store, s, n: [(new_dishes(store, s,
+                                               'Bench Add Dishes %d' % i,
+                                               100),)
+                                   for i in range(n)], 20),
+    Benchmark('dish_ids', 'dish_ids', lambda store, s, n: [()] * n, 5),
+    Benchmark('dish_exists', 'dish_exists',
+              lambda store, s, n: [(iid, vid)
+                                   for _, iid, vid in s(s.dishes, n)]),
+    Benchmark('del_dish', 'del_dish', setup_del_dish),
+    Benchmark('list_dishes_by_name', 'list_dishes_by_name',
+              lambda store, s, n: [(t,) for t in s(s.terms, n)]),
+    Benchmark('list_dishes_by_name[short]', 'list_dishes_by_name',
+              lambda store, s, n: [(t,) for t in s(s.short_terms, n)], 20),
+    Benchmark('list_dishes_by_vendor', 'list_dishes_by_vendor',
+              lambda store, s, n: [(vid,) for vid, _ in s(s.vendors, n)]),
+    # Orders.
+    Benchmark('add_order', 'add_order',
+              lambda store, s, n: [(uid, ts)
+                                   for _, uid, ts in s(s.orders, n)]),
+    Benchmark('add_order_dish', 'add_order_dish', setup_add_order_dish),
+    Benchmark('place_order', 'place_order', setup_place_order),
+    Benchmark('del_order', 'del_order', setup_del_order),
+    Benchmark('list_order_by_uid', 'list_order_by_uid',
+              lambda store, s, n: [(uid,) for uid, _ in s(s.users, n)]),
+    Benchmark('list_order_by_uid[page]', 'list_order_by_uid',
+              lambda store, s, n: [(uid, 0, 20) for uid, _ in s(s.users, n)]),
+    Benchmark('iter_order_by_uid', 'iter_order_by_uid',
+              lambda store, s, n: [(uid,) for uid, _ in s(s.users, n)]),
+    Benchmark('list_order_by_vid', 'list_order_by_vid',
+              lambda store, s, n: [(vid,) for vid, _ in s(s.vendors, n)], 20),
+    Benchmark('list_order_by_vid[page]', 'list_order_by_vid',
+              lambda store, s, n: [(vid, 0, 20)
+                                   for vid, _ in s(s.vendors, n)]),
+    Benchmark('iter_order_by_vid', 'iter_order_by_vid',
+              lambda store, s, n: [(vid,) for vid, _ in s(s.vendors, n)], 20),
+    Benchmark('list_order_docs_by_uid', 'list_order_docs_by_uid',
+              lambda store, s, n: [(uid,) for uid, _ in s(s.users, n)]),
+    Benchmark('list_order_docs_by_vid[page]', 'list_order_docs_by_vid',
+              lambda store, s, n: [(vid, 0, 20)
+                                   for vid, _ in s(s.vendors, n)]),
+    Benchmark('list_order_by_uid_between[day]', 'list_order_by_uid_between',
+              lambda store, s, n: [(uid, ts - DAY, ts + DAY)
+                                   for _, uid, ts in s(s.orders, n)]),
+    Benchmark('list_order_by_vid_between[day]', 'list_order_by_vid_between',
+              lambda store, s, n: [(vid, ts, ts + DAY)
+                                   for (vid, _), (_, _, ts)
+                                   in zip(s(s.vendors, n), s(s.orders, n))]),
+]
+
+
+# --- Running the benchmarks. ---
+
+def make_dataset(tmpdir, scale, seed, data_dir):
+    '''Return the path of a DB (in `tmpdir') with the data set for `scale'.
+    If `data_dir' is given, the data set is generated there (unless it's
+    already there), and copied over.'''
+    dbfile = os.path.join(tmpdir, 'bench.db')
+    target = dbfile
+    if data_dir:
+        target = os.path.join(data_dir, 'bench-%g-%d.db' % (scale, seed))
+    if not os.path.exists(target):
+        log('generating the data set for scale %g' % scale)
+        cfile = os.path.join(tmpdir, 'gendata.ini')
+        with open(cfile, 'w') as cf:
+            cf.write('[DEFAULT]\ndbfile = %s\n' % target)
+        gendata.generate(cfile, gendata.scaled_sizes(scale), seed,
+                         password=password)
+    if target != dbfile:
+        shutil.copyfile(target, dbfile)
+    return dbfile
+
+
+def time_calls(func, calls):
+    '''Call `func' with each of the argument tuples in `calls', and return the
+    latencies (in seconds).  Iterators returned by `func' are consumed as
+    part of the call.'''
+    latencies = []
+    for args in calls:
+        start = time.perf_counter()
+        result = func(*args)
+        if isinstance(result, collections.abc.Iterator):
+            for _ in result:
+                pass
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def percentile(values, p):
+    '''Return the `p'-th percentile of the (sorted) list `values'.'''
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+
+    def us(seconds):
+        return round(seconds * 1e6, 1)
+
+    return {
+        'calls': len(latencies),
+        'mean_us': us(sum(latencies) / len(latencies)),
+        'min_us': us(latencies[0]),
+        'p50_us': us(percentile(latencies, 50)),
+        'p95_us': us(percentile(latencies, 95)),
+        'max_us': us(latencies[-1]),
+    }
+
+
+def run_scale(scale, selected, number, seed, cache, data_dir):
+    '''Run the `selected' benchmarks against the data set for `scale'.
+    Return a dict with the results for each of them.'''
+    tmpdir = tempfile.mkdtemp(prefix='resteasy-bench-')
+    try:
+        dbfile = make_dataset(tmpdir, scale, seed, data_dir)
+        cfile = os.path.join(tmpdir, 'config.ini')
+        with open(cfile, 'w') as cf:
+            cf.write('[DEFAULT]\ndbfile = %s\n' % dbfile)
+            if not cache:
+                cf.write('cachesize = 0\n')
+        rng = random.Random(seed)
+        sample = Sample(dbfile, rng)
+        store = REStore(cfile)
+        results = {}
+        try:
+            for bench in selected:
+                n = min(number, bench.number or number)
+                calls = bench.setup(store, sample, n)
+                log('scale %g: %s (%d calls)' % (scale, bench.name, n))
+                results[bench.name] = summarize(
+                    time_calls(getattr(store, bench.method), calls))
+        finally:
+            store.close()
+        return results
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+# --- Comparing and reporting the results. ---
+
+def compare(results, baseline, threshold):
+    '''Compare the median latencies in `results' with those in `baseline'
+    (both as returned by run_scale(), by scale).  Return a dict with the
+    ratio (new/old) and a verdict for each benchmark found in both.'''
+    comparison = {}
+    for scale, benches in results.items():
+        for name, r in benches.items():
+            old = baseline.get(scale, {}).get(name)
+            if not old:
+                continue
+            ratio = r['p50_us'] / max(old['p50_us'], 0.1)
+            if ratio > 1 + threshold:
+                verdict = 'regression'
+            elif ratio < 1 / (1 + threshold):
+                verdict = 'improvement'
+            else:
+                verdict = 'ok'
+            comparison.setdefault(scale, {})[name] = {
+                'baseline_p50_us': old['p50_us'],
+                'ratio': round(ratio, 3),
+                'verdict': verdict,
+            }
+    return comparison
+
+
+def print_results(results, comparison):
+    header = '%-30s%8s%7s%12s%12s%12s%12s%9s' \
+             % ('Method', 'Scale', 'Calls', 'Mean (us)', 'p50 (us)',
+                'p95 (us)', 'Base p50', 'Change')
+    print('-' * len(header))
+    print(header)
+    print('-' * len(header))
+    for scale, benches in results.items():
+        for name, r in benches.items():
+            c = comparison.get(scale, {}).get(name)
+            base, change = '', ''
+            if c:
+                base = '%.1f' % c['baseline_p50_us']
+                change = '%+.0f%%' % ((c['ratio'] - 1) * 100)
+                if c['verdict'] == 'regression':
+                    change += ' !'
+            print('%-30s%8s%7d%12.1f%12.1f%12.1f%12s%9s'
+                  % (name, scale, r['calls'], r['mean_us'], r['p50_us'],
+                     r['p95_us'], base, change))
+    print('-' * len(header))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.number < 1 or not all(scale > 0 for scale in args.scales):
+        error_exit('number and scales must be positive', 1)
+    selected = [bench for bench in benchmarks
+                if not args.methods or bench.method in args.methods
+                or bench.name in args.methods]
+    if not selected:
+        error_exit('no benchmarks match the given methods', 1)
+    baseline = {}
+    if args.baseline:
+        try:
+            with open(args.baseline) as bf:
+                baseline = json.load(bf)['results']
+        except (OSError, ValueError, KeyError) as e:
+            error_exit('failed to read baseline "%s": %s'
+                       % (args.baseline, e), 1)
+    if args.data_dir:
+        os.makedirs(args.data_dir, exist_ok=True)
+
+    results = {}
+    for scale in args.scales:
+        results['%g' % scale] = run_scale(scale, selected, args.number,
+                                          args.seed, args.cache,
+                                          args.data_dir)
+    comparison = compare(results, baseline, args.threshold)
+
+    print_results(results, comparison)
+    meta = {
+        'time': int(time.time()),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'seed': args.seed,
+        'number': args.number,
+        'cache': args.cache,
+    }
+    if args.save:
+        with open(args.save, 'w') as sf:
+            json.dump({'meta': meta, 'results': results}, sf, indent=2)
+    if args.output_file:
+        output = {'meta': meta, 'results': results}
+        if args.baseline:
+            output.update(baseline=args.baseline, threshold=args.threshold,
+                          comparison=comparison)
+        with open(args.output_file, 'w') as of:
+            json.dump(output, of, indent=2)
+    if any(c['verdict'] == 'regression'
+           for benches in comparison.values() for c in benches.values()):
+        sys.exit(REGRESSION_STATUS)
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+
+# Generate a synthetic RestEasy DB, at up to production scale.
+#
+# The data is deterministic for a given seed and set of sizes.  Popularity is
+# skewed the way real traffic is: a few vendors, users, and dishes on each
+# menu account for most of the orders (Zipf distributions), most orders are
+# placed around lunch and dinner time, and popular items (e.g. "Masala Dosa")
+# show up on many menus.
+#
+# The rows are written straight into the DB with bulk inserts, bypassing the
+# per-row checks of REStore.  Indexes and triggers are dropped during the load
+# and rebuilt at the end, which is much faster than maintaining them row by
+# row.
+
+import argparse
+import bisect
+import configparser
+import itertools
+import math
+import os
+import random
+import sqlite3
+import sys
+import time
+
+from restore import REStore, hash_password
+
+
+# Sizes of the data set at scale 1.0, by table.
+production_sizes = {
+    'users': 1000000,
+    'vendors': 50000,
+    'items': 20000,
+    'dishes': 2000000,
+    'orderdishes': 100000000,
+}
+
+# The span of time over which orders are spread.
+order_days = 365
+order_end = 1767225600      # 2026-01-01 00:00:00 UTC
+
+# Relative number of orders placed in each hour of the day.
+hourly_weights = [
+    1, 0.5, 0.2, 0.1, 0.1, 0.2, 0.5, 2,         # 00:00 - 07:59
+    4, 4, 3, 5, 12, 14, 9, 3,                   # 08:00 - 15:59
+    3, 4, 6, 11, 14, 12, 7, 3,                  # 16:00 - 23:59
+]
+
+# Mean number of (distinct) dishes per order.
+mean_order_lines = 2.5
+
+# Number of rows per bulk insert.
+batch_size = 50000
+
+# Building blocks for the names we make up.
+item_styles = [
+    '', 'Andhra', 'Chettinad', 'Kerala', 'Punjabi', 'Hyderabadi', 'Udupi',
+    'Bengali', 'Goan', 'Mangalorean', 'Rajasthani', 'Kashmiri', 'Lucknowi',
+    'Gujarati', 'Malabar', 'Amritsari', 'Mumbai', 'Delhi', 'Kolkata',
+]
+item_flavours = [
+    'Plain', 'Masala', 'Rava', 'Onion', 'Paneer', 'Butter', 'Ghee', 'Spicy',
+    'Special', 'Mysore', 'Veg', 'Chicken', 'Egg', 'Mushroom', 'Cheese',
+    'Schezwan', 'Tandoori', 'Garlic', 'Jeera', 'Mutton',
+]
+item_bases = [
+    'Dosa', 'Idli', 'Vada', 'Uttapam', 'Naan', 'Kulcha', 'Biryani', 'Pulao',
+    'Fried Rice', 'Noodles', 'Paratha', 'Roti', 'Curry', 'Tikka', 'Kebab',
+    'Soup', 'Salad', 'Ice-Cream', 'Lassi', 'Coffee', 'Tea', 'Juice',
+    'Sandwich', 'Pizza', 'Burger', 'Pasta', 'Momos', 'Thali', 'Halwa',
+    'Pakora',
+]
+vendor_words = [
+    'Anand', 'Bhavan', 'Sagar', 'Udupi', 'Grand', 'Royal', 'Spice', 'Garden',
+    'Kitchen', 'Dhaba', 'Cafe', 'Corner', 'Palace', 'Express', 'Delight',
+    'Paradise', 'Empire', 'Meghana', 'Nandhini', 'Adigas', 'Vidyarthi',
+]
+areas = [
+    'B G Road', 'M G Road', 'Indiranagar', 'Koramangala', 'Jayanagar',
+    'Malleshwaram', 'Whitefield', 'HSR Layout', 'JP Nagar', 'Basavanagudi',
+    'Banashankari', 'Hebbal', 'Yelahanka', 'Marathahalli', 'Rajajinagar',
+]
+first_names = [
+    'Amit', 'Soham', 'Arun', 'Priya', 'Kavya', 'Rahul', 'Sneha', 'Vikram',
+    'Anita', 'Rohan', 'Divya', 'Karthik', 'Meera', 'Suresh', 'Lakshmi',
+    'Arjun', 'Pooja', 'Nikhil', 'Deepa', 'Manoj',
+]
+last_names = [
+    'Mishra', 'Dubey', 'Pant', 'Rao', 'Iyer', 'Sharma', 'Reddy', 'Nair',
+    'Gupta', 'Menon', 'Patel', 'Kumar', 'Shetty', 'Joshi', 'Bhat',
+]
+
+
+def parse_args():
+    '''Parse command line arguments.'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config-file', type=str,
+                        help='specify the configuration file (the DB file it '
+                             'names must not exist yet)')
+    parser.add_argument('-p', '--password', type=str, default='password',
+                        help='specify the password for all generated users '
+                             'and admins')
+    parser.add_argument('-s', '--scale', type=float, default=0.01,
+                        help='specify the size of the data set, relative to '
+                             'production scale (1M users, 50k vendors, 2M '
+                             'dishes, 100M ordered dishes)')
+    parser.add_argument('-z', '--zipf', type=float, default=1.1,
+                        help='specify the exponent of the Zipf distributions '
+                             'used for popularity')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='specify the random seed')
+    for table in production_sizes:
+        parser.add_argument('--%s' % table, type=int,
+                            help='override the number of %s' % table)
+    return parser.parse_args()
+
+
+def error_exit(msg, status):
+    sys.stderr.write('%s\n' % msg)
+    sys.exit(status)
+
+
+def read_dbfile(cfile):
+    '''Return the name of the DB file in the config file `cfile'.'''
+    config = configparser.ConfigParser()
+    config.read(cfile)
+    return config['DEFAULT']['dbfile']
+
+
+def scaled_sizes(scale, overrides={}):
+    '''Return the number of rows per table at the given `scale', with the
+    `overrides' (a dict) applied.'''
+    sizes = {table: max(1, int(n * scale))
+             for table, n in production_sizes.items()}
+    sizes.update((table, n) for table, n in overrides.items() if n)
+    return sizes
+
+
+class Zipf:
+    '''Sampler for ranks 0..n-1, where rank r has weight 1/(r+1)**s.'''
+    def __init__(self, n, s, rng):
+        self.rng = rng
+        self.cum = list(itertools.accumulate(
+            1 / (r + 1) ** s for r in range(n)))
+
+    def sample(self, n=None):
+        '''Return a random rank.  If `n' is given, only consider the first
+        `n' ranks.'''
+        total = self.cum[(n or len(self.cum)) - 1]
+        return bisect.bisect(self.cum, self.rng.random() * total)
+
+
+def item_names(n):
+    '''Return `n' distinct item names, most familiar ones first.'''
+    names = [' '.join(w for w in (style, flavour, base) if w)
+             for style in item_styles
+             for flavour, base in itertools.product(item_flavours,
+                                                    item_bases)]
+    basic = names[:len(item_flavours) * len(item_bases)]
+    for i in itertools.count(2):
+        if len(names) >= n:
+            return names[:n]
+        names += ['%s %d' % (name, i) for name in basic]
+
+
+def shuffled_ids(n, rng):
+    '''Return the IDs 1..n in random order; we index this with popularity
+    ranks, so that popular entities are not just the ones with low IDs.'''
+    ids = list(range(1, n + 1))
+    rng.shuffle(ids)
+    return ids
+
+
+# --- Bulk loading. ---
+
+def insert(conn, sql, rows):
+    '''Insert `rows' (any iterable) using `sql', in batches.'''
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return
+        conn.executemany(sql, batch)
+
+
+def drop_indexes_and_triggers(conn):
+    '''Drop all our (explicit) indexes and triggers.  Return the SQL to
+    recreate them.'''
+    objects = conn.execute('''\
+        SELECT type, name, sql FROM sqlite_master
+        WHERE type IN ('index', 'trigger') AND sql IS NOT NULL;''').fetchall()
+    for kind, name, _ in objects:
+        conn.execute('DROP %s %s;' % (kind.upper(), name))
+    return [sql for _, _, sql in objects]
+
+
+def generate(cfile, sizes, seed=1, zipf=1.1, password='password', log=None):
+    '''Create the DB named in the config file `cfile' (which must not exist
+    yet), and fill it with synthetic data as per `sizes' (see scaled_sizes()).
+    If `log' is given, call it with progress messages.'''
+    log = log or (lambda msg: None)
+    store = REStore(cfile)          # Creates the schema.
+    store.close()
+    conn = sqlite3.connect(read_dbfile(cfile), isolation_level=None)
+    conn.execute('PRAGMA journal_mode = OFF;')
+    conn.execute('PRAGMA synchronous = OFF;')
+    conn.execute('PRAGMA cache_size = -262144;')      # 256 MB.
+    conn.execute('BEGIN;')
+    rebuild = drop_indexes_and_triggers(conn)
+    rng = random.Random(seed)
+    # NOTE: Everyone has the same password, so they share its hash (and its
+    # salt); hashing it for each of them would take forever.
+    phash = hash_password(password)
+
+    nusers, nvendors = sizes['users'], sizes['vendors']
+    log('users: %d' % nusers)
+    insert(conn, '''\
+        INSERT INTO users (uid, username, password, fullname, phonenum)
+        VALUES (?, ?, ?, ?, ?);''',
+        ((uid, 'user%d' % uid, phash,
+          '%s %s' % (rng.choice(first_names), rng.choice(last_names)),
+          '9%09d' % rng.randrange(10 ** 9))
+         for uid in range(1, nusers + 1)))
+
+    log('vendors: %d' % nvendors)
+    insert(conn, 'INSERT INTO vendors (vid, name, address) VALUES (?, ?, ?);',
+           ((vid, '%s %s %d' % (rng.choice(vendor_words),
+                                rng.choice(vendor_words), vid),
+             '%s, Bangalore' % rng.choice(areas))
+            for vid in range(1, nvendors + 1)))
+    insert(conn, '''\
+        INSERT INTO admins (aid, username, password, vid)
+        VALUES (?, ?, ?, ?);''',
+        ((vid, 'admin%d' % vid, phash, vid)
+         for vid in range(1, nvendors + 1)))
+
+    names = item_names(sizes['items'])
+    log('items: %d' % len(names))
+    insert(conn, 'INSERT INTO items (iid, name, calories) VALUES (?, ?, ?);',
+           ((iid, name, rng.randrange(50, 900, 10))
+            for iid, name in enumerate(names, 1)))
+
+    # Menus: each vendor offers a (variable) number of items, picked by item
+    # popularity.  A vendor's dishes get consecutive IDs, so we can remember
+    # its menu as (first did, number of dishes).
+    log('dishes: ~%d' % sizes['dishes'])
+    mean_menu = max(1, sizes['dishes'] // nvendors)
+    item_zipf = Zipf(len(names), zipf, rng)
+    menus = []
+
+    def dishes():
+        did = 1
+        for vid in range(1, nvendors + 1):
+            size = min(len(names), max(1, int(rng.uniform(0.5, 1.5)
+                                              * mean_menu)))
+            iids = set()
+            while len(iids) < size:
+                iids.add(item_zipf.sample() + 1)
+            menus.append((did, size))
+            for iid in iids:
+                yield did, iid, vid, rng.randrange(20, 500, 5)
+                did += 1
+    insert(conn, '''\
+        INSERT INTO dishes (did, iid, vid, price)
+        VALUES (?, ?, ?, ?);''', dishes())
+
+    # Orders: spread over `order_days' days, in order of time, with the time
+    # of day following `hourly_weights'.  Each order is for one vendor.
+    norders = max(1, int(sizes['orderdishes'] / mean_order_lines))
+    log('orders: %d' % norders)
+    user_ids = shuffled_ids(nusers, rng)
+    vendor_ids = shuffled_ids(nvendors, rng)
+    user_zipf = Zipf(nusers, zipf, rng)
+    vendor_zipf = Zipf(nvendors, zipf, rng)
+    dish_zipf = Zipf(max(size for _, size in menus), zipf, rng)
+    hours = list(itertools.accumulate(hourly_weights))
+    start = order_end - order_days * 86400
+    # The floor of an exponential variate with this rate is geometric with a
+    # mean of (mean_order_lines - 1); we add 1 to that for the order size.
+    lines_rate = math.log(1 + 1 / (mean_order_lines - 1))
+
+    orders, orderdishes = [], []
+    for oid in range(1, norders + 1):
+        day = (oid - 1) * order_days // norders
+        hour = bisect.bisect(hours, rng.random() * hours[-1])
+        ts = start + day * 86400 + hour * 3600 + rng.randrange(3600)
+        orders.append((oid, user_ids[user_zipf.sample()], ts))
+        first, size = menus[vendor_ids[vendor_zipf.sample()] - 1]
+        nlines = min(size, 1 + int(rng.expovariate(lines_rate)))
+        lines = set()
+        while len(lines) < nlines:
+            lines.add(dish_zipf.sample(size))
+        for line in lines:
+            orderdishes.append((oid, first + line,
+                                1 + int(rng.expovariate(1.5))))
+        if len(orderdishes) >= batch_size or oid == norders:
+            conn.executemany(
+                'INSERT INTO orders (oid, uid, timestamp) VALUES (?, ?, ?);',
+                orders)
+            conn.executemany('''\
+                INSERT INTO orderdishes (oid, did, quantity)
+                VALUES (?, ?, ?);''', orderdishes)
+            orders.clear()
+            orderdishes.clear()
+
+    log('rebuilding indexes and triggers')
+    for sql in rebuild:
+        conn.execute(sql)
+    conn.execute("INSERT INTO items_fts (items_fts) VALUES ('rebuild');")
+    conn.execute("INSERT INTO vendors_fts (vendors_fts) VALUES ('rebuild');")
+    conn.execute('''\
+        INSERT INTO vendororders (vid, timestamp, oid)
+        SELECT DISTINCT dishes.vid, orders.timestamp, orders.oid
+        FROM orderdishes
+        INNER JOIN dishes ON dishes.did = orderdishes.did
+        INNER JOIN orders ON orders.oid = orderdishes.oid;''')
+    conn.execute('UPDATE catalog_versions SET version = version + 1;')
+    conn.execute('COMMIT;')
+    conn.execute('ANALYZE;')
+    conn.close()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if not args.config_file:
+        error_exit('config file must be specified', 1)
+    sizes = scaled_sizes(args.scale,
+                         {table: getattr(args, table)
+                          for table in production_sizes})
+    dbfile = read_dbfile(args.config_file)
+    if os.path.exists(dbfile):
+        error_exit('DB file "%s" exists already' % dbfile, 1)
+
+    started = time.time()
+
+    def log(msg):
+        sys.stderr.write('[%7.1fs] %s\n' % (time.time() - started, msg))
+
+    generate(args.config_file, sizes, args.seed, args.zipf, args.password, log)
+    log('done')
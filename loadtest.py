@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+
+# Load test the RestEasy web API (storeapi.py + REStore) end to end.
+#
+# By default, we start a local API server on a scratch DB (seeded with users,
+# and with the vendors in vendor*.txt), and run a number of concurrent virtual
+# users against it for a while.  Each virtual user repeatedly runs one of our
+# real user workflows (signup, login, search, etc.), picked at random as per
+# the configured mix.  At the end we report the throughput and the latency
+# percentiles for each endpoint.
+
+import argparse
+import collections
+import glob
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from restore import REStore, hash_password
+
+
+# Directory with our code (and the vendor*.txt fixtures).
+srcdir = os.path.dirname(os.path.abspath(__file__))
+
+# The default mix of workflows, with their relative weights.
+default_mix = 'signup=1,login=2,search=6,menu=6,order=2,history=3'
+
+# Password for all the users we seed the DB with.
+seed_password = 'loadtest'
+
+
+def parse_args():
+    '''Parse command line arguments.'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--concurrency', type=int, default=16,
+                        help='specify the number of concurrent virtual users')
+    parser.add_argument('-d', '--duration', type=float, default=30,
+                        help='specify how long (in seconds) to run the test')
+    parser.add_argument('-m', '--mix', type=str, default=default_mix,
+                        help='specify the workflow mix, as comma-separated '
+                             'WORKFLOW=WEIGHT pairs (default: %s)'
+                             % default_mix)
+    parser.add_argument('-o', '--output-file', type=str,
+                        help='also write the results (as JSON) to this file')
+    parser.add_argument('-p', '--port', type=int, default=5055,
+                        help='specify the port for the local API server')
+    parser.add_argument('-s', '--seed', type=int, default=None,
+                        help='specify the random seed')
+    parser.add_argument('-u', '--users', type=int, default=1000,
+                        help='specify the number of users to seed the DB with')
+    parser.add_argument('--url', type=str,
+                        help='test an already running server at this URL '
+                             '(whose DB is seeded the same way) instead of '
+                             'starting a local one')
+    return parser.parse_args()
+
+
+def error_exit(msg, status):
+    sys.stderr.write('%s\n' % msg)
+    sys.exit(status)
+
+
+def parse_mix(mix):
+    '''Parse the workflow `mix' into a dict mapping workflows to weights.'''
+    weights = {}
+    for pair in mix.split(','):
+        name, _, weight = pair.partition('=')
+        if name not in workflows:
+            raise ValueError('unknown workflow "%s"' % name)
+        weights[name] = float(weight)
+    return weights
+
+
+# --- Setting up the DB and the server. ---
+
+def seed_store(cfile, nusers):
+    '''Create a scratch DB as per `cfile', with `nusers' users (named "user0",
+    "user1", etc.) and the vendors in our vendor*.txt files.'''
+    store = REStore(cfile)
+    # NOTE: Hashing each user's password would take a while; since they all
+    # have the same password, they may as well share its hash (and salt).
+    phash = hash_password(seed_password)
+    with store.transaction():
+        store.add_users([('user%d' % i, phash, 'User %d' % i, '%010d' % i)
+                         for i in range(nusers)], hashed=True)
+        for vfile in sorted(glob.glob(os.path.join(srcdir, 'vendor*.txt'))):
+            with open(vfile) as vf:
+                lines = [line.strip() for line in vf if line.strip()]
+            name, addr, uname, pword = lines[0].split(';')
+            vid = store.add_vendor(name.title(), addr.title())
+            store.add_admin(uname, pword, vid)
+            dishes = [line.split(';') for line in lines[1:]]
+            iids = store.add_items(item.title() for item, _ in dishes)
+            store.add_dishes([(iids[item.title()], vid, price)
+                              for item, price in dishes])
+    store.close()
+
+
+def start_server(cfile, port):
+    '''Start an API server (in a child process) using the config `cfile'.
+    Return the process, once the server is ready.'''
+    env = dict(os.environ, RESTEASY_CONFIG=cfile)
+    server = subprocess.Popen(
+        [sys.executable, '-c',
+         'import storeapi; storeapi.app.run(port=%d, threaded=True)' % port],
+        cwd=srcdir, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = 'http://127.0.0.1:%d/' % port
+    for _ in range(100):
+        if server.poll() is not None:
+            error_exit('API server failed to start', 1)
+        try:
+            requests.get(url + 'ping', timeout=1)
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    server.kill()
+    error_exit('API server did not come up', 1)
+
+
+# --- The workflows. ---
+
+class VirtualUser:
+    '''One simulated user of the API, with a connection of its own.'''
+    def __init__(self, url, rng, stats, catalog):
+        self.url = url
+        self.rng = rng
+        self.stats = stats
+        self.catalog = catalog
+        self.session = requests.Session()
+        self.uid = None
+
+
+    def call(self, endpoint, params={}, data=None):
+        '''Call `endpoint' (a GET, or a POST if `data' is given), recording
+        its latency.  Return the decoded response, or None on errors.'''
+        start = time.perf_counter()
+        try:
+            if data is None:
+                resp = self.session.get(self.url + endpoint, params=params)
+            else:
+                resp = self.session.post(self.url + endpoint, json=data)
+            status = resp.status_code
+        except requests.RequestException:
+            resp, status = None, 0
+        self.stats.record(endpoint, time.perf_counter() - start, status)
+        if status != 200:
+            return None
+        return resp.json()
+
+
+    def login(self):
+        uname = 'user%d' % self.rng.randrange(self.catalog['nusers'])
+        session = self.call('login-user',
+                            {'username': uname, 'password': seed_password})
+        if session is not None:
+            self.uid = session['uid']
+            self.session.headers['Authorization'] = \
+                'Bearer %s' % session['token']
+            self.call('user-data', {'uid': self.uid})
+
+
+    def ensure_login(self):
+        if self.uid is None:
+            self.login()
+        return self.uid is not None
+
+
+    def signup(self):
+        uname = 'new-%d-%d' % (threading.get_ident(), self.rng.getrandbits(48))
+        if self.call('user-exists', {'username': uname}) is False:
+            self.call('add-user', {'username': uname,
+                                   'password': seed_password,
+                                   'fullname': 'New User',
+                                   'phone': '0000000000'})
+
+
+    def search(self):
+        self.call('list-dishes-by-name',
+                  {'name': self.rng.choice(self.catalog['terms'])})
+
+
+    def menu(self):
+        self.call('list-dishes-by-vendor',
+                  {'vid': self.rng.choice(self.catalog['vids'])})
+
+
+    def order(self):
+        if not self.ensure_login():
+            return
+        dids = self.rng.sample(self.catalog['dids'], self.rng.randint(1, 4))
+        dishes = [[did, self.rng.randint(1, 3)] for did in dids]
+        self.call('place-order', data={'uid': self.uid,
+                                       'timestamp': int(time.time()),
+                                       'dishes': dishes})
+
+
+    def history(self):
+        if not self.ensure_login():
+            return
+        self.call('list-order-by-uid', {'uid': self.uid, 'limit': 20})
+
+
+# The workflows we know about, by name.
+workflows = {
+    'signup': VirtualUser.signup,
+    'login': VirtualUser.login,
+    'search': VirtualUser.search,
+    'menu': VirtualUser.menu,
+    'order': VirtualUser.order,
+    'history': VirtualUser.history,
+}
+
+
+# --- Collecting and reporting the results. ---
+
+class Stats:
+    '''Latencies and statuses of all the calls made, by endpoint.'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+
+
+    def record(self, endpoint, latency, status):
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+            if status != 200:
+                self.errors[endpoint] += 1
+
+
+def percentile(values, p):
+    '''Return the `p'-th percentile of the (sorted) list `values'.'''
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def summarize(stats, elapsed):
+    '''Return a dict with the results for each endpoint (and in total).'''
+    results = {}
+    everything = []
+    for endpoint, latencies in sorted(stats.latencies.items()):
+        everything.extend(latencies)
+        results[endpoint] = summarize_latencies(
+            latencies, stats.errors[endpoint], elapsed)
+    results['TOTAL'] = summarize_latencies(
+        everything, sum(stats.errors.values()), elapsed)
+    return results
+
+
+def summarize_latencies(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+
+    def ms(p):
+        if not latencies:
+            return None
+        return round(percentile(latencies, p) * 1000, 2)
+
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': ms(50),
+        'p95_ms': ms(95),
+        'p99_ms': ms(99),
+    }
+
+
+def print_results(results):
+    header = '%-24s%10s%8s%10s%10s%10s%10s' \
+             % ('Endpoint', 'Requests', 'Errors', 'Req/s',
+                'p50 (ms)', 'p95 (ms)', 'p99 (ms)')
+    print('-' * len(header))
+    print(header)
+    print('-' * len(header))
+    for endpoint, r in results.items():
+        if endpoint == 'TOTAL':
+            print('-' * len(header))
+        print('%-24s%10d%8d%10.1f%10.2f%10.2f%10.2f'
+              % (endpoint, r['requests'], r['errors'], r['rps'],
+                 r['p50_ms'] or 0, r['p95_ms'] or 0, r['p99_ms'] or 0))
+    print('-' * len(header))
+
+
+# --- Running the test. ---
+
+def load_catalog(cfile, nusers):
+    '''Return the data the workflows pick from: the vendor IDs, dish IDs,
+    and search terms (words from the item names).'''
+    store = REStore(cfile)
+    dishes = store.dish_ids()
+    catalog = {
+        'nusers': nusers,
+        'vids': [vid for vid, _, _ in store.list_vendors()],
+        'dids': list(dishes.values()),
+        'terms': sorted({word.lower() for item, _ in dishes
+                         for word in item.split() if len(word) >= 3}),
+    }
+    store.close()
+    return catalog
+
+
+def run(url, weights, concurrency, duration, catalog, seed):
+    stats = Stats()
+    names = list(weights)
+    deadline = time.monotonic() + duration
+
+    def virtual_user(n):
+        rng = random.Random(None if seed is None else seed + n)
+        user = VirtualUser(url, rng, stats, catalog)
+        while time.monotonic() < deadline:
+            workflow = rng.choices(names, [weights[w] for w in names])[0]
+            workflows[workflow](user)
+
+    threads = [threading.Thread(target=virtual_user, args=(n,))
+               for n in range(concurrency)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(stats, time.monotonic() - start)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    try:
+        weights = parse_mix(args.mix)
+    except ValueError as e:
+        error_exit('bad workflow mix: %s' % e, 1)
+    if args.concurrency < 1 or args.duration <= 0 or args.users < 1:
+        error_exit('concurrency, duration and users must be positive', 1)
+
+    tmpdir = tempfile.mkdtemp(prefix='resteasy-loadtest-')
+    cfile = os.path.join(tmpdir, 'config.ini')
+    with open(cfile, 'w') as cf:
+        cf.write('[DEFAULT]\ndbfile = %s\n' % os.path.join(tmpdir, 'load.db'))
+    server = None
+    try:
+        seed_store(cfile, args.users)
+        catalog = load_catalog(cfile, args.users)
+        if args.url:
+            url = args.url if args.url.endswith('/') else args.url + '/'
+        else:
+            server = start_server(cfile, args.port)
+            url = 'http://127.0.0.1:%d/' % args.port
+        results = run(url, weights, args.concurrency, args.duration,
+                      catalog, args.seed)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(tmpdir)
+
+    print_results(results)
+    if args.output_file:
+        with open(args.output_file, 'w') as of:
+            json.dump({'concurrency': args.concurrency,
+                       'duration': args.duration,
+                       'mix': weights,
+                       'results': results}, of, indent=2)
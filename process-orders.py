@@ -4,6 +4,8 @@
 # The info for each order is taken from a specified CSV file.
 
 import argparse
+import csv
+import itertools
 import sys
 import time
 
@@ -17,8 +19,13 @@ def parse_args():
                         help='specify the configuration file')
     parser.add_argument('-i', '--input-file', type=str,
                         help='specify the input (CSV) file')
+    parser.add_argument('-n', '--batch-size', type=int, default=1000,
+                        help='specify the number of orders per commit '
+                             '(without --user)')
     parser.add_argument('-u', '--user', type=str,
-                        help='specify the user placing the order')
+                        help='specify the user placing the order; if not '
+                             'given, each line in the input file names its '
+                             'own user and timestamp')
     return parser.parse_args()
 
 
@@ -30,49 +37,84 @@ def error_exit(msg, status):
 def get_uid_or_exit(store, uname):
     uid = store.get_uid(uname)
     if uid is None:
-        error_exit('invalid user "%s"' % uname)
+        error_exit('invalid user "%s"' % uname, 1)
     return uid
 
 
-def get_iid_or_exit(store, item):
-    iid = store.get_iid(item)
-    if iid is None:
-        error_exit('invalid item "%s"' % item)
-    return iid
-
-
-def get_vid_or_exit(store, vendor):
-    vid = store.get_vid(vendor)
-    if vid is None:
-        error_exit('invalid vendor "%s"' % vendor)
-    return vid
-
-
-def get_did_or_exit(store, item, vendor):
-    iid = get_iid_or_exit(store, item)
-    vid = get_vid_or_exit(store, vendor)
-    did = store.get_did(iid, vid)
+def get_did_or_exit(dids, item, vendor):
+    did = dids.get((item, vendor))
     if did is None:
-        error_exit('vendor "%s" does not offer dish "%s"' % (vendor, item))
+        error_exit('vendor "%s" does not offer dish "%s"' % (vendor, item), 1)
     return did
 
 
 # Place orders from `ofile' (a CSV file with order data).
 def process_orders(store, uname, ofile):
+    # Resolve all the dish names with one query, instead of three per line.
+    dids = store.dish_ids()
     orders = []
     with open(ofile) as of:
         separator = ','
         for line in of:
             line = line.strip()
             item, vendor, qty = line.split(separator)
-            did = get_did_or_exit(store, item, vendor)
+            did = get_did_or_exit(dids, item, vendor)
             orders.append((did, qty))
 
     ts = int(time.time())
     uid = get_uid_or_exit(store, uname)
-    oid = store.add_order(uid, ts)
-    for did, qty in orders:
-        store.add_order_dish(oid, did, qty)
+    store.place_order(uid, ts, orders)
+
+
+# Read the orders in `ofile' (a CSV file where each line is of the form
+# USER,TIMESTAMP,ITEM,VENDOR,QTY).  Consecutive lines with the same user and
+# timestamp make up one order.  Yield each order as a tuple of the line number
+# it starts on, the user, the timestamp, and the list of its (item, vendor,
+# qty) entries.
+def read_orders(ofile):
+    with open(ofile, newline='') as of:
+        rows = ((lineno, row)
+                for lineno, row in enumerate(csv.reader(of), 1) if row)
+        for (uname, ts), lines in itertools.groupby(
+                rows, lambda lr: tuple(lr[1][:2])):
+            lines = list(lines)
+            yield (lines[0][0], uname, ts,
+                   [tuple(row[2:]) for _, row in lines])
+
+
+# Replay all the orders (of any number of users) in `ofile', committing them in
+# batches of `size' orders.  Orders that refer to unknown users or dishes are
+# reported and skipped.  Return the number of such orders.
+def replay_orders(store, ofile, size):
+    dids = store.dish_ids()
+    uids = {}
+    failures = 0
+    orders = read_orders(ofile)
+    while True:
+        batch = list(itertools.islice(orders, size))
+        if not batch:
+            return failures
+        with store.transaction():
+            for lineno, uname, ts, lines in batch:
+                try:
+                    if uname not in uids:
+                        uids[uname] = store.get_uid(uname)
+                    if uids[uname] is None:
+                        raise ValueError('invalid user "%s"' % uname)
+                    dishes = []
+                    for entry in lines:
+                        if len(entry) != 3:
+                            raise ValueError('malformed line')
+                        item, vendor, qty = entry
+                        if (item, vendor) not in dids:
+                            raise ValueError('vendor "%s" does not offer '
+                                             'dish "%s"' % (vendor, item))
+                        dishes.append((dids[(item, vendor)], int(qty)))
+                    store.place_order(uids[uname], int(ts), dishes)
+                except Exception as e:
+                    sys.stderr.write('Failed to process order at line %d: '
+                                     '%s.  Ignored.\n' % (lineno, e))
+                    failures += 1
 
 
 if __name__ == '__main__':
@@ -81,8 +123,13 @@ if __name__ == '__main__':
         error_exit('config file must be specified', 1)
     if not args.input_file:
         error_exit('input file must be specified', 1)
-    if not args.user:
-        error_exit('user must be specified', 1)
+    if args.batch_size < 1:
+        error_exit('batch size must be positive', 1)
     store = REStore(args.config_file)
-    process_orders(store, args.user, args.input_file)
+    if args.user:
+        process_orders(store, args.user, args.input_file)
+        failures = 0
+    else:
+        failures = replay_orders(store, args.input_file, args.batch_size)
     store.close()
+    sys.exit(1 if failures else 0)
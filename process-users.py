@@ -2,11 +2,20 @@
 
 # Process a set of users.  Modifies the `users' table.
 # The info for each user is taken from a specified CSV file.
+#
+# NOTE: Passwords are stored hashed, and hashing one takes a while by design
+# (about 0.1-0.15 seconds of CPU with the default "hashiterations"), so adding
+# a few million users takes hours of CPU, even with the hashing spread over
+# all the cores (see "hashworkers" in the config).  For such imports, hash the
+# passwords ahead of time (see restore.hash_password()), and load them with
+# --bulk --pre-hashed, which stores them as they are.
 
 import argparse
+import csv
+import itertools
 import sys
 
-from restore import REStore
+from restore import is_password_hash, REStore
 
 
 def parse_args():
@@ -14,10 +23,18 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-a', '--action', type=str, choices=['add', 'del'],
                         default='add', help='specify the configuration file')
+    parser.add_argument('-b', '--bulk', action='store_true',
+                        help='stream the input file in batches')
     parser.add_argument('-c', '--config-file', type=str,
                         help='specify the configuration file')
     parser.add_argument('-i', '--input-file', type=str,
                         help='specify the input (CSV) file')
+    parser.add_argument('-n', '--batch-size', type=int, default=1000,
+                        help='specify the number of rows per batch/commit '
+                             '(with --bulk)')
+    parser.add_argument('-p', '--pre-hashed', action='store_true',
+                        help='the passwords in the input file are already '
+                             'hashed (with --bulk)')
     return parser.parse_args()
 
 
@@ -45,11 +62,70 @@ def del_users(store, ufile):
         for line in uf:
             line = line.strip()
             uname, _, _, _ = line.split(',')
-            store.del_user(uname)
+            try:
+                store.del_user(uname)
+            except Exception as e:
+                sys.stderr.write(
+                    'Failed to delete user "%s": %s.  Ignored.\n' % (uname, e))
+
+
+# Read `ufile' (a CSV file with user data) in batches of `size' rows, so that
+# memory use does not grow with the size of the file.  Yield each batch as a
+# list of (uname, pword, fname, phone) tuples.  Malformed rows are reported
+# and skipped.
+def read_batches(ufile, size):
+    with open(ufile, newline='') as uf:
+        rows = enumerate(csv.reader(uf), 1)
+        while True:
+            chunk = list(itertools.islice(rows, size))
+            if not chunk:
+                return
+            batch = []
+            for lineno, row in chunk:
+                if len(row) == 4:
+                    batch.append(tuple(field.strip() for field in row))
+                elif row:
+                    sys.stderr.write('Malformed row at line %d of "%s".  '
+                                     'Ignored.\n' % (lineno, ufile))
+            # NOTE: A chunk may have no valid rows at all; that doesn't mean
+            # we're at the end of the file.
+            if batch:
+                yield batch
+
+
+# Like add_users(), but add the users in batches of `size', one transaction
+# (and commit) per batch.  If `hashed' is True, the passwords are taken to be
+# hashed already (and rows with anything else in place of a hash are skipped).
+def bulk_add_users(store, ufile, size, hashed=False):
+    for batch in read_batches(ufile, size):
+        if hashed:
+            for uname in [uname for uname, pword, _, _ in batch
+                          if not is_password_hash(pword)]:
+                sys.stderr.write('Failed to add user "%s": password is not '
+                                 'hashed.  Ignored.\n' % uname)
+            batch = [user for user in batch if is_password_hash(user[1])]
+        with store.transaction():
+            conflicts = store.add_users(batch, hashed=hashed)
+        for uname in conflicts:
+            sys.stderr.write('Failed to add user "%s": user already exists.  '
+                             'Ignored.\n' % uname)
+
+
+# Like del_users(), but delete the users in batches of `size', one transaction
+# (and commit) per batch.  Users who have placed orders are reported and
+# skipped.
+def bulk_del_users(store, ufile, size):
+    for batch in read_batches(ufile, size):
+        with store.transaction():
+            skipped = store.del_users([uname for uname, _, _, _ in batch])
+        for uname in skipped:
+            sys.stderr.write('Failed to delete user "%s": user has orders.  '
+                             'Ignored.\n' % uname)
 
 
 # Mapping of actions to the corresponding processors.
 processor = {'add': add_users, 'del': del_users}
+bulk_processor = {'add': bulk_add_users, 'del': bulk_del_users}
 
 
 if __name__ == '__main__':
@@ -58,6 +134,18 @@ if __name__ == '__main__':
         error_exit('config file must be specified', 1)
     if not args.input_file:
         error_exit('input file must be specified', 1)
+    if args.batch_size < 1:
+        error_exit('batch size must be positive', 1)
+    if args.pre_hashed and not args.bulk:
+        error_exit('pre-hashed passwords can only be loaded with --bulk', 1)
+    if args.pre_hashed and args.action != 'add':
+        error_exit('pre-hashed passwords can only be used with -a add', 1)
     store = REStore(args.config_file)
-    processor[args.action](store, args.input_file)
+    if args.bulk and args.action == 'add':
+        bulk_add_users(store, args.input_file, args.batch_size,
+                       args.pre_hashed)
+    elif args.bulk:
+        bulk_processor[args.action](store, args.input_file, args.batch_size)
+    else:
+        processor[args.action](store, args.input_file)
     store.close()
@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 
-# Add a vendor to the RestEasy DB.
-# The data for the vendor is taken from a specified input file.
+# Add vendors to the RestEasy DB.
+# The data for each vendor is taken from a specified input file.
 
 import argparse
+import os
 import sys
 
 from restore import REStore
@@ -12,10 +13,13 @@ from restore import REStore
 def parse_args():
     '''Parse command line arguments.'''
     parser = argparse.ArgumentParser()
+    parser.add_argument('-b', '--bulk', action='store_true',
+                        help='load all the input files in one transaction')
     parser.add_argument('-c', '--config-file', type=str,
                         help='specify the configuration file')
-    parser.add_argument('-i', '--input-file', type=str,
-                        help='specify the input (CSV) file')
+    parser.add_argument('-i', '--input-file', type=str, nargs='+',
+                        help='specify the input file(s), or directories '
+                             'containing them')
     return parser.parse_args()
 
 
@@ -24,38 +28,123 @@ def error_exit(msg, status):
     sys.exit(status)
 
 
-def add_metadata(store, mdline):
+def parse_metadata(mdline):
     # Format of the metadata line (`mdline') is:
     # NAME;ADDRESS;ADMIN-USERNAME;ADMIN-PASSWORD
     separator = ';'
     name, addr, uname, pword = mdline.split(separator)
-    vid = store.add_vendor(name.title(), addr.title())
-    store.add_admin(uname, pword, vid)
-    return vid
+    return name.title(), addr.title(), uname, pword
 
 
-def add_dishes(store, vid, dishes):
+def parse_dish(dish):
     # Format of each dish record/line:
     # ITEM-NAME;PRICE
     separator = ';'
+    item, price = dish.split(separator)
+    return item.title(), price
+
+
+def add_metadata(store, mdline):
+    name, addr, uname, pword = parse_metadata(mdline)
+    vid = store.add_vendor(name, addr)
+    store.add_admin(uname, pword, vid)
+    return vid
+
+
+def add_dishes(store, vid, dishes):
     for dish in dishes:
-        item, price = dish.split(separator)
-        iid = store.add_item(item.title())
+        item, price = parse_dish(dish)
+        iid = store.add_item(item)
         store.add_dish(iid, vid, price)
 
 
 # Add a vendor from `vfile' (a file with the vendor data) into the appropriate
-# tables in the RestEasy DB.
+# tables in the RestEasy DB.  If that fails, report it, and return False (the
+# vendor is not added at all).
 def add_vendor(store, vfile):
-    with open(vfile) as vf:
-        lines = [line.strip() for line in vf]
-
     try:
-        vid = add_metadata(store, lines[0]) # First line is the metadata.
-        add_dishes(store, vid, lines[1:])   # All other lines are dishes.
+        with open(vfile) as vf:
+            lines = [line.strip() for line in vf]
+        with store.transaction():
+            vid = add_metadata(store, lines[0]) # First line is the metadata.
+            add_dishes(store, vid, lines[1:])   # All other lines are dishes.
     except Exception as e:
-        sys.stderr.write('Failed to add vendor: %s\n' % e)
-        sys.exit(1)
+        sys.stderr.write('Failed to add vendor from "%s": %s.  Ignored.\n'
+                         % (vfile, e))
+        return False
+    return True
+
+
+# Parse `vfile' (a file with the vendor data).  Return the vendor metadata and
+# a list of (item-name, price) pairs.
+def read_vendor(vfile):
+    with open(vfile) as vf:
+        lines = [line.strip() for line in vf if line.strip()]
+    if not lines:
+        raise ValueError('empty vendor file')
+    dishes = [parse_dish(line) for line in lines[1:]]
+    # Catch bad prices here, rather than halfway through the load.
+    for item, price in dishes:
+        float(price)
+    return parse_metadata(lines[0]), dishes
+
+
+# Add the vendors from all of `vfiles' in one transaction, using set-based
+# inserts for their items and dishes.  Vendors that fail (e.g. due to a bad
+# file, or because they exist already) are reported and skipped.  Return the
+# number of such failures.
+def bulk_add_vendors(store, vfiles):
+    failures = 0
+    vendors = []
+    for vfile in vfiles:
+        try:
+            vendors.append((vfile,) + read_vendor(vfile))
+        except Exception as e:
+            sys.stderr.write(
+                'Failed to read "%s": %s.  Ignored.\n' % (vfile, e))
+            failures += 1
+
+    with store.transaction():
+        added = []
+        for vfile, (name, addr, uname, pword), dishes in vendors:
+            try:
+                # Roll back just this vendor (and its admin) if it fails.
+                with store.transaction():
+                    vid = store.add_vendor(name, addr)
+                    store.add_admin(uname, pword, vid)
+            except Exception as e:
+                sys.stderr.write('Failed to add vendor "%s" from "%s": %s.  '
+                                 'Ignored.\n' % (name, vfile, e))
+                failures += 1
+            else:
+                added.append((vid, dishes))
+
+        iids = store.add_items(
+            item for _, dishes in added for item, _ in dishes)
+        rows = []
+        for vid, dishes in added:
+            # A vendor offers an item only once; the first price listed wins.
+            seen = set()
+            for item, price in dishes:
+                if iids[item] not in seen:
+                    seen.add(iids[item])
+                    rows.append((iids[item], vid, price))
+        store.add_dishes(rows)
+
+    return failures
+
+
+# Expand the directories in `paths' into the (regular) files inside them.
+def list_input_files(paths):
+    vfiles = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if os.path.isfile(os.path.join(path, name)):
+                    vfiles.append(os.path.join(path, name))
+        else:
+            vfiles.append(path)
+    return vfiles
 
 
 if __name__ == '__main__':
@@ -64,6 +153,11 @@ if __name__ == '__main__':
         error_exit('config file must be specified', 1)
     if not args.input_file:
         error_exit('input file must be specified', 1)
+    vfiles = list_input_files(args.input_file)
     store = REStore(args.config_file)
-    add_vendor(store, args.input_file)
+    if args.bulk:
+        failures = bulk_add_vendors(store, vfiles)
+    else:
+        failures = sum(not add_vendor(store, vfile) for vfile in vfiles)
     store.close()
+    sys.exit(1 if failures else 0)
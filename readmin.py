@@ -4,9 +4,9 @@
 # We are building this prototype as a CLI rather than a real browser based UI.
 
 from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timedelta
 from getpass import getpass
-import json
+from itertools import groupby
 import os
 import requests
 import sys
@@ -17,19 +17,19 @@ from reutils import (
     call_api,
     check_tty,
     clear_screen,
+    decode,
     HTTP_OK,
+    iter_pages,
     ping_server,
     quit_app,
     read_choice,
-    select
+    select,
+    set_session_token
 )
 
 
 # --- Global variables. ---
 
-# This is the URL where we will find the (web) API to use.
-apiurl = 'http://localhost:5000/'
-
 # Data about the admin on whose behalf we are acting.
 admindata = { 'aid': None, 'uname': None, 'vid': None }
 
@@ -42,47 +42,66 @@ def print_header():
     print('\n>>> RestEasy Admin | %s' % uname)
 
 
-def list_orders(orders):
+def list_orders(dishes):
     header = '%5s  %-25s%-3s' \
              % ('#', 'Item', 'Qty')
     print('-' * len(header))
     print(header)
     print('-' * len(header))
-    for i, (_, _, dish, qty) in enumerate(orders, 1):
+    for i, (dish, qty) in enumerate(dishes, 1):
         print('%5d. %-25s%3d' % (i, dish, qty))
     print('-' * len(header))
 
 
-def view_all_orders():
-    resp = call_api('list-order-by-vid', params={'vid': admindata['vid']})
-    if resp.status_code == HTTP_OK:
-        all_orders = json.loads(resp.text)
-        if len(all_orders) == 0:
-            print('\nNo orders have been placed against your restaurant.')
-        else:
-            orders = []; prev_oid = None; i = 0
-            for oid, ts, name, dish, qty in all_orders:
-                if oid != prev_oid and orders:
-                    # All entries in `orders` should have the same timestamp
-                    # and customer: they belong to the same order.
-                    dt = datetime.fromtimestamp(orders[0][0])
-                    customer = orders[0][1]
-                    i += 1
-                    print('\n%5d. Order placed on %s at %s by %s'
-                          % (i, dt.strftime('%F'), dt.strftime('%T'), customer))
-                    list_orders(orders)
-                    orders = []
-                orders.append((ts, name, dish, qty))
-                prev_oid = oid
-    else:
+def print_orders(orders, none_msg):
+    '''Print the `orders' (documents, as returned by list-order-docs-by-vid),
+    or `none_msg' if there are none.'''
+    try:
+        i = 0
+        for i, (_, ts, customer, dishes) in enumerate(orders, 1):
+            dt = datetime.fromtimestamp(ts)
+            print('\n%5d. Order placed on %s at %s by %s'
+                  % (i, dt.strftime('%F'), dt.strftime('%T'), customer))
+            list_orders(dishes)
+        if i == 0:
+            print(none_msg)
+    except RuntimeError:
         print('Failed to fetch orders')
+
+
+def view_all_orders():
+    # NOTE: The orders are fetched page by page, as we go through them; the
+    # server groups the dishes of each order into one document.
+    orders = iter_pages('list-order-docs-by-vid',
+                        params={'vid': admindata['vid']})
+    print_orders(orders,
+                 '\nNo orders have been placed against your restaurant.')
     input('\nPress <Enter> to return to main menu: ')
 
 
 def view_orders_on_date():
-    print('Sorry, this functionality is not implemented yet...')
+    today = datetime.now().strftime('%F')
+    date = input('\nDate (YYYY-MM-DD) [%s]: ' % today) or today
+    try:
+        start = datetime.strptime(date, '%Y-%m-%d')
+    except ValueError:
+        print('*** Error: Invalid date "%s".' % date)
+    else:
+        # The orders placed from midnight to midnight (local time).
+        end = start + timedelta(days=1)
+        rows = iter_pages('list-order-by-vid-between',
+                          params={'vid': admindata['vid'],
+                                  'from': int(start.timestamp()),
+                                  'to': int(end.timestamp())})
+        # All the rows of an order are consecutive; group them into the
+        # documents print_orders() expects.
+        orders = ((oid, ts, name,
+                   [(item, qty) for *_, item, qty in dishes])
+                  for (oid, ts, name), dishes
+                  in groupby(rows, lambda row: row[:3]))
+        print_orders(orders, '\nNo orders were placed against your restaurant '
+                           'on %s.' % date)
     input('\nPress <Enter> to return to main menu: ')
-    pass
 
 
 def login():
@@ -98,8 +117,11 @@ def login():
         resp = call_api('login-admin',
                         params={'username': uname, 'password': pword})
         if resp.status_code == HTTP_OK:
-            admindata['aid'], admindata['vid'] = json.loads(resp.text)
+            session = decode(resp)
+            admindata['aid'] = session['aid']
+            admindata['vid'] = session['vid']
             admindata['uname'] = uname
+            set_session_token(session['token'])
             print('Welcome, %s!' % admindata['uname'])
         else:
             print('Login failed.')
@@ -0,0 +1,256 @@
+'''Asynchronous (asyncio based) client library for the RestEasy web API.
+
+Each API endpoint is exposed as a coroutine method of AsyncAPIClient, so that
+independent calls can run concurrently, e.g.:
+
+    async with AsyncAPIClient() as client:
+        menus = await client.list_dishes_by_vendors([1, 2, 3])
+'''
+
+import asyncio
+
+import aiohttp
+
+import recodec
+from reutils import (
+    APIClient,
+    HTTP_OK,
+    apiurl,
+    connect_timeout,
+    max_retries,
+    read_timeout,
+    retry_backoff
+)
+
+
+class APIError(RuntimeError):
+    '''Raised when an API call fails with an HTTP error status.'''
+    def __init__(self, endpoint, status, message):
+        super().__init__('call to "%s" failed with status %d: %s'
+                         % (endpoint, status, message))
+        self.status = status
+
+
+class AsyncAPIClient:
+    '''
+    An asyncio client for the RestEasy web API.
+
+    All calls share one aiohttp session, whose connector pools and reuses the
+    TCP connections to the server.  At most "concurrency" calls are in flight
+    at any time; others wait for their turn.  As with reutils.APIClient, calls
+    to idempotent endpoints are retried with exponential backoff if they fail
+    due to network errors or "server unavailable" type statuses.
+
+    Use it as an async context manager, or call close() when done with it.
+    The coroutines return the decoded data, and raise APIError if the
+    server reports an error.  After a successful login_user() or login_admin()
+    call, all calls are made as part of the new session.
+    '''
+    def __init__(self, baseurl=apiurl, concurrency=100,
+                 timeout=(connect_timeout, read_timeout),
+                 retries=max_retries, backoff=retry_backoff):
+        self.__baseurl = baseurl
+        self.__retries = retries
+        self.__backoff = backoff
+        self.__limit = asyncio.Semaphore(concurrency)
+        self.__headers = {'Accept': recodec.ACCEPT}
+        self.__session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=concurrency),
+            timeout=aiohttp.ClientTimeout(connect=timeout[0],
+                                          sock_read=timeout[1]))
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+    async def close(self):
+        '''Close all the pooled connections.'''
+        await self.__session.close()
+
+
+    def set_token(self, token):
+        '''Send the session `token' with all later calls; or, if it's None,
+        stop sending one.'''
+        if token is None:
+            self.__headers.pop('Authorization', None)
+        else:
+            self.__headers['Authorization'] = 'Bearer %s' % token
+
+
+    async def get(self, endpoint, params={}):
+        '''Call the given API `endpoint' with query parameters `params'.'''
+        return await self.__send('GET', endpoint,
+                                 endpoint in APIClient.IDEMPOTENT,
+                                 params=params)
+
+
+    async def post(self, endpoint, data):
+        '''POST `data' (JSON-encoded) to the given API `endpoint'.'''
+        return await self.__send('POST', endpoint, False, json=data)
+
+
+    async def __send(self, method, endpoint, retry, **kwargs):
+        url = self.__baseurl + endpoint
+        attempts = 1 + (self.__retries if retry else 0)
+        for attempt in range(attempts):
+            last = attempt == attempts - 1
+            try:
+                async with self.__limit:
+                    async with self.__session.request(
+                            method, url, headers=dict(self.__headers),
+                            **kwargs) as resp:
+                        if resp.status == HTTP_OK:
+                            return recodec.decode(
+                                await resp.read(),
+                                resp.headers.get('Content-Type'))
+                        if last or resp.status not in APIClient.RETRY_STATUSES:
+                            raise APIError(endpoint, resp.status,
+                                           await resp.text())
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if last:
+                    raise
+            await asyncio.sleep(self.__backoff * 2 ** attempt)
+
+
+    async def iter_pages(self, endpoint, params={}, limit=100):
+        '''Call the given (paged) API `endpoint' with query parameters
+        `params', fetching `limit' entries per call.  Yield the rows from the
+        pages, one by one; the next page is fetched only when the current one
+        is used up.'''
+        params = dict(params, limit=limit)
+        while True:
+            page = await self.get(endpoint, params)
+            for row in page['rows']:
+                yield row
+            if page['next'] is None:
+                return
+            params['after'] = page['next']
+
+
+    # --- General endpoints. ---
+    async def ping(self):
+        return await self.get('ping')
+
+
+    # --- Users. ---
+    async def get_uid(self, uname):
+        return await self.get('get-uid', {'username': uname})
+
+
+    async def user_exists(self, uname):
+        return await self.get('user-exists', {'username': uname})
+
+
+    async def add_user(self, uname, pword, fname, phone):
+        return await self.get('add-user', {'username': uname,
+                                           'password': pword,
+                                           'fullname': fname,
+                                           'phone': phone})
+
+
+    async def login_user(self, uname, pword):
+        '''Log in as user `uname'.  Return {"uid": UID, "token": TOKEN}.'''
+        session = await self.get('login-user', {'username': uname,
+                                                'password': pword})
+        self.set_token(session['token'])
+        return session
+
+
+    async def logout(self):
+        await self.post('logout', {})
+        self.set_token(None)
+
+
+    async def user_data(self, uid):
+        return await self.get('user-data', {'uid': uid})
+
+
+    # --- Admins. ---
+    async def login_admin(self, uname, pword):
+        '''Log in as admin `uname'.  Return {"aid": AID, "vid": VID,
+        "token": TOKEN}.'''
+        session = await self.get('login-admin', {'username': uname,
+                                                 'password': pword})
+        self.set_token(session['token'])
+        return session
+
+
+    # --- Vendors and dishes. ---
+    async def list_vendors(self):
+        return await self.get('list-vendors')
+
+
+    async def list_vendors_by_name(self, name):
+        return await self.get('list-vendors-by-name', {'name': name})
+
+
+    async def list_dishes_by_vendor(self, vid):
+        return await self.get('list-dishes-by-vendor', {'vid': vid})
+
+
+    async def list_dishes_by_name(self, name):
+        return await self.get('list-dishes-by-name', {'name': name})
+
+
+    async def list_dishes_by_vendors(self, vids):
+        '''Fetch the menus of all the vendors in `vids' concurrently.  Return
+        a dict mapping each vendor ID to its list of dishes.'''
+        menus = await asyncio.gather(
+            *(self.list_dishes_by_vendor(vid) for vid in vids))
+        return dict(zip(vids, menus))
+
+
+    # --- Orders. ---
+    async def place_order(self, uid, ts, dishes):
+        '''Place an order for user `uid' at time `ts', for `dishes': a list of
+        (did, qty) pairs.  Return the order ID.'''
+        return await self.post('place-order', {
+            'uid': uid,
+            'timestamp': ts,
+            'dishes': [[did, qty] for did, qty in dishes],
+        })
+
+
+    async def list_order_by_uid(self, uid):
+        return [row async for row in
+                self.iter_pages('list-order-by-uid', {'uid': uid})]
+
+
+    async def list_order_by_vid(self, vid):
+        return [row async for row in
+                self.iter_pages('list-order-by-vid', {'vid': vid})]
+
+
+    async def list_order_docs_by_uid(self, uid):
+        '''List the orders of user `uid', as a document per order, with its
+        dishes and totals in it.'''
+        return [doc async for doc in
+                self.iter_pages('list-order-docs-by-uid', {'uid': uid})]
+
+
+    async def list_order_docs_by_vid(self, vid):
+        '''List the orders against vendor `vid', as a document per order,
+        with its customer and dishes in it.'''
+        return [doc async for doc in
+                self.iter_pages('list-order-docs-by-vid', {'vid': vid})]
+
+
+    async def list_order_by_uid_between(self, uid, start, end):
+        '''List the orders of user `uid' placed at times in [`start',
+        `end').'''
+        return [row async for row in
+                self.iter_pages('list-order-by-uid-between',
+                                {'uid': uid, 'from': start, 'to': end})]
+
+
+    async def list_order_by_vid_between(self, vid, start, end):
+        '''List the orders against vendor `vid' placed at times in [`start',
+        `end').'''
+        return [row async for row in
+                self.iter_pages('list-order-by-vid-between',
+                                {'vid': vid, 'from': start, 'to': end})]
@@ -0,0 +1,113 @@
+'''Encodings of the RestEasy API's responses, negotiated through the HTTP
+"Accept" header.
+
+Besides plain JSON (the default), the API server can send:
+- Columnar JSON, in which a list of rows (lists of the same length) is sent
+  as {"columns": [COLUMN, ...]}, with a list of values for each column, in
+  place of a list per row.  This applies to a response that is a list of rows,
+  and to the lists of rows in a response that is an object (like the "rows"
+  of a page); anything else is sent as it is.
+- MessagePack, if the msgpack module is installed.
+
+Clients ask for the encoding they decode fastest (see ACCEPT), and decode
+responses with decode(), whatever encoding the server picked.
+'''
+
+import json
+import operator
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON_MIMETYPE = 'application/json'
+COLUMNAR_MIMETYPE = 'application/vnd.resteasy.columnar+json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+
+# The encodings we support (given the modules installed), in the order the
+# server prefers them when the client does not care: plain JSON first, for
+# clients that do not know about the others.
+MIMETYPES = [JSON_MIMETYPE, COLUMNAR_MIMETYPE]
+if msgpack is not None:
+    MIMETYPES.append(MSGPACK_MIMETYPE)
+
+# Short names of the encodings, e.g. for telling their ETags apart.
+NAMES = {
+    JSON_MIMETYPE: 'json',
+    COLUMNAR_MIMETYPE: 'columnar',
+    MSGPACK_MIMETYPE: 'msgpack',
+}
+
+# The "Accept" header for clients to send: the encodings we support, those
+# we decode fastest first.  MessagePack is several times faster to encode (and
+# faster to decode) than JSON.  Columnar JSON is only a little smaller than
+# plain JSON, and no faster; worse, it cannot be streamed (see stream_rows()
+# in storeapi.py), so it comes last.
+_PREFERRED = [mimetype for mimetype
+              in (MSGPACK_MIMETYPE, JSON_MIMETYPE, COLUMNAR_MIMETYPE)
+              if mimetype in MIMETYPES]
+ACCEPT = ', '.join('%s;q=%.1f' % (mimetype, 1 - 0.1 * i)
+                   for i, mimetype in enumerate(_PREFERRED))
+
+
+def is_rows(value):
+    '''Return True if "value" is a (non-empty) list of rows: lists or tuples,
+    all of the same length.'''
+    if not isinstance(value, list) or not value:
+        return False
+    if not isinstance(value[0], (list, tuple)):
+        return False
+    width = len(value[0])
+    return all(isinstance(row, (list, tuple)) and len(row) == width
+               for row in value)
+
+
+def to_columns(value):
+    '''Return "value" with its lists of rows in columnar form (see above).'''
+    if is_rows(value):
+        return {'columns': [list(map(operator.itemgetter(i), value))
+                            for i in range(len(value[0]))]}
+    if isinstance(value, dict):
+        return {key: to_columns(val) if is_rows(val) else val
+                for key, val in value.items()}
+    return value
+
+
+def from_columns(value):
+    '''Undo to_columns().'''
+    if is_columns(value):
+        return list(map(list, zip(*value['columns'])))
+    if isinstance(value, dict):
+        return {key: from_columns(val) if is_columns(val) else val
+                for key, val in value.items()}
+    return value
+
+
+def is_columns(value):
+    return isinstance(value, dict) and list(value) == ['columns']
+
+
+def encode(value, mimetype):
+    '''Return "value" encoded as "mimetype" (one of MIMETYPES), as bytes.'''
+    if mimetype == MSGPACK_MIMETYPE:
+        return msgpack.packb(value)
+    if mimetype == COLUMNAR_MIMETYPE:
+        value = to_columns(value)
+    return json.dumps(value, separators=(',', ':')).encode()
+
+
+def decode(data, content_type):
+    '''Return the value encoded in "data" (bytes), as per "content_type" (the
+    value of a "Content-Type" header).'''
+    mimetype = (content_type or JSON_MIMETYPE).split(';')[0].strip().lower()
+    if mimetype == MSGPACK_MIMETYPE:
+        if msgpack is None:
+            raise RuntimeError('cannot decode %s without the msgpack module'
+                               % mimetype)
+        return msgpack.unpackb(data)
+    value = json.loads(data)
+    if mimetype == COLUMNAR_MIMETYPE:
+        value = from_columns(value)
+    return value
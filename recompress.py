@@ -0,0 +1,186 @@
+'''Compression of the RestEasy API server's responses.
+
+Responses are compressed with gzip, or with zstd or br (Brotli) when the
+zstandard or brotli modules are installed, as negotiated with the client
+through its "Accept-Encoding" header.  Small bodies, which would hardly
+shrink, are sent as they are.  Streamed bodies are compressed chunk by chunk,
+as they are sent; each chunk is flushed, so that the client can decode the
+rows in it right away.
+
+The catalog listings (menus, vendors) are highly repetitive and compress very
+well, but they are also requested over and over, unchanged.  So compressed
+bodies that are tagged with an ETag (which changes whenever the data does) are
+kept in a small LRU cache, and reused rather than compressed again.
+'''
+
+import collections
+import gzip
+import threading
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class _Gzip:
+    name = 'gzip'
+    level = 6
+
+    def compress(self, data):
+        # A fixed mtime in the header, so that equal bodies compress equal.
+        return gzip.compress(data, self.level, mtime=0)
+
+
+    def stream(self, chunks):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            yield compressor.compress(chunk) + \
+                  compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+
+class _Brotli:
+    name = 'br'
+    quality = 5             # Out of 11; the higher ones are far too slow.
+
+    def compress(self, data):
+        return brotli.compress(data, quality=self.quality)
+
+
+    def stream(self, chunks):
+        compressor = brotli.Compressor(quality=self.quality)
+        for chunk in chunks:
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+
+
+class _Zstd:
+    name = 'zstd'
+    level = 3
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+
+    def stream(self, chunks):
+        compressor = zstandard.ZstdCompressor(level=self.level).compressobj()
+        for chunk in chunks:
+            yield compressor.compress(chunk) + \
+                  compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        yield compressor.flush()
+
+
+# The codings we can use, in the order we prefer them when the client accepts
+# several equally: the better (and faster) ones first.
+_CODERS = [coder for coder, available in ((_Zstd(), zstandard is not None),
+                                          (_Brotli(), brotli is not None),
+                                          (_Gzip(), True))
+           if available]
+
+
+class Compressor:
+    '''
+    Compresses response bodies, caching the compressed bodies of tagged
+    responses.
+
+    Bodies shorter than "minsize" bytes are not compressed.  At most
+    "cachesize" compressed bodies are cached; the least recently used are
+    dropped to make room for new ones.
+    '''
+    def __init__(self, minsize, cachesize):
+        self.__minsize = minsize
+        self.__cachesize = cachesize
+        self.__coders = {coder.name: coder for coder in _CODERS}
+        # (key, coding) -> compressed body, least recently used first.
+        self.__cache = collections.OrderedDict()
+        self.__lock = threading.Lock()
+        self.__counts = collections.Counter()
+
+
+    def codings(self):
+        '''Return the codings we can use, the preferred ones first.'''
+        return [coder.name for coder in _CODERS]
+
+
+    def wants(self, size):
+        '''Return True if a body of "size" bytes is worth compressing.'''
+        return size >= self.__minsize
+
+
+    def compress(self, data, coding, key=None):
+        '''Return "data" (bytes) compressed with "coding" (one of codings()).
+        If a "key" is given, it must identify "data" (e.g. the request's URL
+        and the ETag of the response); the compressed body is then cached
+        under it, and reused for later calls with the same key.'''
+        if key is not None:
+            with self.__lock:
+                body = self.__cache.get((key, coding))
+                if body is not None:
+                    self.__cache.move_to_end((key, coding))
+                    self.__counts['hits'] += 1
+                    self.__count(coding, len(data), len(body))
+                    return body
+                self.__counts['misses'] += 1
+        body = self.__coders[coding].compress(data)
+        with self.__lock:
+            self.__count(coding, len(data), len(body))
+            if key is not None and self.__cachesize > 0:
+                self.__cache[(key, coding)] = body
+                self.__cache.move_to_end((key, coding))
+                while len(self.__cache) > self.__cachesize:
+                    self.__cache.popitem(last=False)
+                    self.__counts['evictions'] += 1
+        return body
+
+
+    def stream(self, chunks, coding):
+        '''Return an iterator over "chunks" (an iterable of bytes) compressed
+        with "coding", for a streamed body.'''
+        coder = self.__coders[coding]
+        sizes = [0, 0]
+
+        def measured(chunks):
+            for chunk in chunks:
+                sizes[0] += len(chunk)
+                yield chunk
+
+        try:
+            for chunk in coder.stream(measured(chunks)):
+                sizes[1] += len(chunk)
+                yield chunk
+        finally:
+            with self.__lock:
+                self.__count(coding, *sizes)
+
+
+    def __count(self, coding, insize, outsize):
+        self.__counts[coding, 'responses'] += 1
+        self.__counts[coding, 'in'] += insize
+        self.__counts[coding, 'out'] += outsize
+
+
+    def stats(self):
+        '''Return a dict with the number of responses compressed and the
+        bytes before and after (by coding), the counters of the cache (hits,
+        misses, evictions), and its current size.'''
+        with self.__lock:
+            return {
+                'codings': {coding: {
+                    'responses': self.__counts[coding, 'responses'],
+                    'bytes_in': self.__counts[coding, 'in'],
+                    'bytes_out': self.__counts[coding, 'out'],
+                } for coding in self.__coders},
+                'hits': self.__counts['hits'],
+                'misses': self.__counts['misses'],
+                'evictions': self.__counts['evictions'],
+                'size': len(self.__cache),
+                'maxsize': self.__cachesize,
+            }
@@ -0,0 +1,205 @@
+'''Minimal metrics (counters, gauges and histograms) for the RestEasy API
+server, rendered in the Prometheus text exposition format.
+
+The metrics live in the memory of the process that records them; with several
+server processes behind a load balancer, each one is scraped on its own.
+'''
+
+import bisect
+import threading
+
+
+# Default histogram buckets (upper bounds, in seconds) for request latencies.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Content type of the rendered metrics.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_value(value):
+    '''Format the number "value" as Prometheus expects.'''
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(labels):
+    '''Format "labels" (a list of name, value pairs) as "{name="value",...}",
+    or as an empty string if there are none.'''
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                                      .replace('"', r'\"')
+                                      .replace('\n', r'\n'))
+        for name, value in labels)
+
+
+def render_family(name, kind, helptext, samples):
+    '''Return the lines for a metric family: its HELP and TYPE lines, and a
+    line for each of its "samples" (labels, value pairs).'''
+    lines = ['# HELP %s %s' % (name, helptext), '# TYPE %s %s' % (name, kind)]
+    lines += ['%s%s %s' % (name, format_labels(labels), format_value(value))
+              for labels, value in samples]
+    return lines
+
+
+class Metric:
+    '''
+    Base class of the metric types below.
+
+    A metric has a name, a help text, and the names of its labels; it keeps
+    a value for each combination of label values it has seen.
+    '''
+    kind = 'untyped'
+
+    def __init__(self, name, helptext, labelnames=()):
+        self.name = name
+        self.helptext = helptext
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+
+    def labels(self, labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError('metric "%s" takes labels %s'
+                             % (self.name, ', '.join(self.labelnames)))
+        return list(zip(self.labelnames, labelvalues))
+
+
+    def render(self):
+        '''Return the lines for this metric in the exposition format.'''
+        with self.lock:
+            samples = [(self.labels(key), value)
+                       for key, value in sorted(self.values.items())]
+        return render_family(self.name, self.kind, self.helptext, samples)
+
+
+class Counter(Metric):
+    '''A value that only goes up, e.g. the number of requests served.'''
+    kind = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+
+class Gauge(Metric):
+    '''A value that goes up and down, e.g. the number of requests in flight.'''
+    kind = 'gauge'
+
+    def inc(self, *labelvalues, amount=1):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+
+    def dec(self, *labelvalues, amount=1):
+        self.inc(*labelvalues, amount=-amount)
+
+
+    def set(self, value, *labelvalues):
+        with self.lock:
+            self.values[labelvalues] = value
+
+
+class Histogram(Metric):
+    '''The distribution of observed values (e.g. latencies) over a fixed set
+    of buckets, along with their count and sum.'''
+    kind = 'histogram'
+
+    def __init__(self, name, helptext, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, helptext, labelnames)
+        self.buckets = sorted(buckets)
+
+
+    def observe(self, value, *labelvalues):
+        with self.lock:
+            entry = self.values.get(labelvalues)
+            if entry is None:
+                # Per-bucket (not cumulative) counts, with one more for +Inf;
+                # and the sum of the values.
+                entry = self.values[labelvalues] = [
+                    [0] * (len(self.buckets) + 1), 0]
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+
+    def render(self):
+        with self.lock:
+            entries = [(self.labels(key), list(counts), total)
+                       for key, (counts, total)
+                       in sorted(self.values.items())]
+        lines = ['# HELP %s %s' % (self.name, self.helptext),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for labels, counts, total in entries:
+            cumulative = 0
+            for bound, count in zip(self.buckets + [float('inf')], counts):
+                cumulative += count
+                lines.append('%s_bucket%s %s'
+                             % (self.name,
+                                format_labels(labels
+                                              + [('le', format_value(bound))]),
+                                cumulative))
+            lines.append('%s_count%s %d'
+                         % (self.name, format_labels(labels), cumulative))
+            lines.append('%s_sum%s %s'
+                         % (self.name, format_labels(labels),
+                            format_value(total)))
+        return lines
+
+
+class Registry:
+    '''
+    A set of metrics, rendered together.
+
+    Besides metrics recorded as things happen, a registry can have collectors:
+    functions called at render time, which return lines for metrics whose
+    values are read from elsewhere (see render_family()).
+    '''
+    def __init__(self):
+        self.__metrics = []
+        self.__collectors = []
+        self.__lock = threading.Lock()
+
+
+    def counter(self, name, helptext, labelnames=()):
+        return self.__add(Counter(name, helptext, labelnames))
+
+
+    def gauge(self, name, helptext, labelnames=()):
+        return self.__add(Gauge(name, helptext, labelnames))
+
+
+    def histogram(self, name, helptext, labelnames=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self.__add(Histogram(name, helptext, labelnames, buckets))
+
+
+    def collector(self, func):
+        '''Register "func" as a collector.  (Usable as a decorator.)'''
+        with self.__lock:
+            self.__collectors.append(func)
+        return func
+
+
+    def __add(self, metric):
+        with self.__lock:
+            self.__metrics.append(metric)
+        return metric
+
+
+    def render(self):
+        '''Return all the metrics, in the Prometheus text format.'''
+        with self.__lock:
+            metrics = list(self.__metrics)
+            collectors = list(self.__collectors)
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        for collector in collectors:
+            lines += collector()
+        return '\n'.join(lines) + '\n'
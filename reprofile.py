@@ -0,0 +1,150 @@
+'''On-demand profiling of the requests served by the RestEasy API server.
+
+A profiling session is started on a running server, and profiles (with
+cProfile) the next N requests, or the requests that start within the next T
+seconds, whichever limit is hit first.  The profiles of those requests are
+aggregated into one set of pstats statistics, which can be saved (in the
+format of pstats.Stats.dump_stats()) and inspected with pstats, snakeviz,
+gprof2dot, flameprof, etc.
+'''
+
+import cProfile
+import io
+import marshal
+import pstats
+import threading
+import time
+
+
+class RequestProfiler:
+    '''
+    Profiles the requests in a profiling session, one session at a time.
+
+    Each profiled request gets a cProfile.Profile of its own, enabled in the
+    thread serving it from the start of the request to the end of its
+    response; the profiles are merged when the requests are done.  Requests
+    that are not profiled pay (almost) nothing.
+    '''
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__active = False
+        self.__left = 0             # Requests yet to be profiled.
+        self.__deadline = 0         # No requests are profiled after this.
+        self.__running = 0          # Requests being profiled right now.
+        self.__profiled = 0         # Requests profiled so far.
+        self.__started = None
+        self.__stats = None
+
+
+    def start(self, nrequests, seconds):
+        '''Start a session that profiles the next "nrequests" requests, or
+        those that start within "seconds".  Return False (and do nothing) if
+        a session is already in progress.'''
+        with self.__lock:
+            if self.__in_progress():
+                return False
+            self.__active = True
+            self.__left = nrequests
+            self.__deadline = time.monotonic() + seconds
+            self.__running = 0
+            self.__profiled = 0
+            self.__started = time.time()
+            self.__stats = None
+            return True
+
+
+    def stop(self):
+        '''End the current session early: no more requests are profiled,
+        though those being profiled are allowed to finish.'''
+        with self.__lock:
+            self.__left = 0
+
+
+    def begin_request(self):
+        '''If the current session wants to profile another request, return
+        an (enabled) profiler for the calling thread's request; the caller
+        must pass it to end_request() when the request is done.  Otherwise,
+        return None.'''
+        if not self.__active:               # The fast path, without a lock.
+            return None
+        with self.__lock:
+            if not self.__wants_more():
+                # Back to the fast path, once the session is over.
+                self.__active = self.__running > 0
+                return None
+            self.__left -= 1
+            self.__running += 1
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is active in this process (Python 3.12+ allows
+            # only one at a time); leave this request out.
+            with self.__lock:
+                self.__left += 1
+                self.__running -= 1
+            return None
+        return profile
+
+
+    def end_request(self, profile):
+        '''Stop "profile" (as returned by begin_request()), and add its
+        statistics to those of the session.'''
+        profile.disable()
+        with self.__lock:
+            if self.__stats is None:
+                self.__stats = pstats.Stats(profile)
+            else:
+                self.__stats.add(profile)
+            self.__running -= 1
+            self.__profiled += 1
+            if not self.__in_progress():
+                self.__active = False
+
+
+    def __wants_more(self):
+        return self.__left > 0 and time.monotonic() < self.__deadline
+
+
+    def __in_progress(self):
+        return self.__active and (self.__wants_more() or self.__running > 0)
+
+
+    def status(self):
+        '''Return a dict describing the current (or last) session.'''
+        with self.__lock:
+            in_progress = self.__in_progress()
+            return {
+                'started': self.__started,
+                'in_progress': in_progress,
+                'requests_left': self.__left if in_progress else 0,
+                'seconds_left': max(0, round(self.__deadline
+                                             - time.monotonic(), 1))
+                                if in_progress else 0,
+                'running': self.__running,
+                'profiled': self.__profiled,
+            }
+
+
+    def result(self):
+        '''Return the statistics of the last session as the contents of a
+        pstats file, or None if the session is still in progress or did not
+        profile any requests.'''
+        with self.__lock:
+            if self.__in_progress() or self.__stats is None:
+                return None
+            return marshal.dumps(self.__stats.stats)
+
+
+    def report(self, sort='cumulative', limit=50):
+        '''Like result(), but return a text report of the top "limit"
+        functions, ordered by "sort" (see pstats.Stats.sort_stats()).'''
+        with self.__lock:
+            if self.__in_progress() or self.__stats is None:
+                return None
+            out = io.StringIO()
+            # Sort (and print) a copy, leaving the stats as they were.
+            stats = pstats.Stats(stream=out)
+            stats.add(self.__stats)
+            stats.sort_stats(sort).print_stats(limit)
+            return out.getvalue()
@@ -0,0 +1,98 @@
+'''In-memory login sessions for the RestEasy API server.
+
+A session is created when a user (or admin) logs in, and is identified by an
+opaque, random token, which the client sends along with each later request
+(as "Authorization: Bearer TOKEN").  Looking a session up costs a dict lookup,
+so authorizing a request stays cheap, while logging in (which checks a slow
+password hash) does not need to happen often.
+
+The sessions live in the memory of the server process: they are lost when it
+restarts, and are not shared between processes.
+'''
+
+import collections
+import secrets
+import threading
+import time
+
+
+class SessionCache:
+    '''
+    A bounded map from session tokens to session data, with expiry.
+
+    A session expires once it has not been used for "ttl" seconds.  If there
+    are "maxsize" sessions already, creating another one evicts the least
+    recently used.  All operations take constant (amortized) time.
+    '''
+    def __init__(self, ttl, maxsize):
+        self.__ttl = ttl
+        self.__maxsize = maxsize
+        # token -> (data, expiry time), least recently used first.  Since each
+        # use of a session moves it to the end and pushes its expiry time out
+        # by "ttl", the entries are in the order of their expiry times too.
+        self.__sessions = collections.OrderedDict()
+        self.__lock = threading.Lock()
+        self.__counts = collections.Counter()
+
+
+    def create(self, data):
+        '''Create a session holding "data" (any object).  Return its token.'''
+        token = secrets.token_urlsafe(32)
+        now = time.monotonic()
+        with self.__lock:
+            self.__purge(now)
+            while len(self.__sessions) >= self.__maxsize:
+                self.__sessions.popitem(last=False)
+                self.__counts['evictions'] += 1
+            self.__sessions[token] = (data, now + self.__ttl)
+            self.__counts['created'] += 1
+        return token
+
+
+    def get(self, token):
+        '''Return the data of the session "token", and extend its life; or
+        None if there is no such (unexpired) session.'''
+        now = time.monotonic()
+        with self.__lock:
+            entry = self.__sessions.get(token)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self.__sessions[token]
+                    self.__counts['expirations'] += 1
+                self.__counts['misses'] += 1
+                return None
+            self.__sessions[token] = (entry[0], now + self.__ttl)
+            self.__sessions.move_to_end(token)
+            self.__counts['hits'] += 1
+            return entry[0]
+
+
+    def delete(self, token):
+        '''End the session "token" (if there is one).'''
+        with self.__lock:
+            self.__sessions.pop(token, None)
+
+
+    def __purge(self, now):
+        # Drop the expired sessions; they are all at the front.
+        while self.__sessions:
+            token, (_, expiry) = next(iter(self.__sessions.items()))
+            if expiry > now:
+                return
+            del self.__sessions[token]
+            self.__counts['expirations'] += 1
+
+
+    def stats(self):
+        '''Return a dict with the counters (sessions created, lookups that
+        hit/missed, expirations, evictions) and current size of the cache.'''
+        with self.__lock:
+            return {
+                'created': self.__counts['created'],
+                'hits': self.__counts['hits'],
+                'misses': self.__counts['misses'],
+                'expirations': self.__counts['expirations'],
+                'evictions': self.__counts['evictions'],
+                'size': len(self.__sessions),
+                'maxsize': self.__maxsize,
+            }
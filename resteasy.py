@@ -4,10 +4,8 @@
 # We are building this prototype as a CLI rather than a real browser based UI.
 
 # Standard library modules.
-from collections import defaultdict
 from datetime import datetime
 from getpass import getpass
-import json
 import os
 import requests
 import sys
@@ -18,11 +16,15 @@ from reutils import (
     call_api,
     check_tty,
     clear_screen,
+    decode,
     HTTP_OK,
+    iter_pages,
     ping_server,
+    post_api,
     quit_app,
     read_choice,
-    select
+    select,
+    set_session_token
 )
 
 
@@ -44,25 +46,25 @@ def user_exists(uname):
     '''Return True if a user with username `uname' exists in our system;
     False otherwise.'''
     resp = call_api('user-exists', params={'username': uname})
-    return json.loads(resp.text)
+    return decode(resp)
 
 
 def get_user_data(uid):
     '''Get data for a user with a given "uid".'''
     resp = call_api('user-data', params={'uid': uid})
-    return json.loads(resp.text)
+    return decode(resp)
 
 
 def list_vendors_by_name(name):
     '''Return a list of vendors whose names have "name" in them.'''
     resp = call_api('list-vendors-by-name', params={'name': name})
-    return json.loads(resp.text)
+    return decode(resp)
 
 
 def list_dishes_by_name(name):
     '''Return a list of dishes whose names have "name" in them.'''
     resp = call_api('list-dishes-by-name', params={'name': name})
-    return json.loads(resp.text)
+    return decode(resp)
 
 
 # --- Our "business logic" functions. ---
@@ -144,7 +146,7 @@ def list_dishes_by_vendor(vendor_data):
     print_header()
     vid, vname, _ = vendor_data
     resp = call_api('list-dishes-by-vendor', params={'vid': vid})
-    dishes = json.loads(resp.text)
+    dishes = decode(resp)
     if not dishes:
         print('\nNo dishes found.')
         input('Press <Enter> to return to main menu: ')
@@ -173,23 +175,28 @@ def list_dishes_by_vendor(vendor_data):
         cart.append(dishes[n-1] + [qty])
 
 
-def list_dishes(dishes):
+def print_dishes(dishes, total):
+    '''Print `dishes' (item, vendor, price, quantity, line total rows), and
+    their `total' price.'''
     header = '%5s  %-25s%-20s%8s%5s%8s' \
              % ('#', 'Item', 'Vendor', 'Price', 'Qty', 'Totals')
     print('-' * len(header))
     print(header)
     print('-' * len(header))
-    total = 0
-    for i, (_, item, vendor, price, qty) in enumerate(dishes, 1):
-        item_price = price * qty
+    for i, (item, vendor, price, qty, item_price) in enumerate(dishes, 1):
         print('%5d. %-25s%-20s%8.2f%5d%8.2f'
               % (i, item, vendor, price, qty, item_price))
-        total += item_price
     print('-' * len(header))
     print('%65s%8.2f' % ('Net price: ', total))
     print('-' * len(header))
 
 
+def list_dishes(dishes):
+    dishes = [(item, vendor, price, qty, price * qty)
+              for _, item, vendor, price, qty in dishes]
+    print_dishes(dishes, sum(dish[-1] for dish in dishes))
+
+
 def view_cart():
     print_header()
     if len(cart) == 0:
@@ -207,39 +214,38 @@ def view_cart():
 
 def view_orders():
     print_header()
-    resp = call_api('list-order-by-uid', params={'uid': userdata['uid']})
-    if resp.status_code != HTTP_OK:
-        print('\nFailed to fetch your orders.')
-    else:
-        ordlist = json.loads(resp.text)
-        if len(ordlist) == 0:
+    # NOTE: The orders are fetched page by page, as we go through them; the
+    # server groups the dishes of each order (with their totals) into one
+    # document.
+    orders = iter_pages('list-order-docs-by-uid',
+                        params={'uid': userdata['uid']})
+    try:
+        i = 0
+        for i, (_, ts, total, dishes) in enumerate(orders, 1):
+            if i == 1:
+                print('\nOrders placed by you:')
+            dt = datetime.fromtimestamp(ts)
+            print('\n%5d. Order placed on %s at %s'
+                  % (i, dt.strftime('%F'), dt.strftime('%T')))
+            print_dishes(dishes, total)
+        if i == 0:
             print('\nCould not find any orders placed by you.')
-        else:
-            print('\nOrders placed by you:')
-            orders = defaultdict(list)
-            # Segregate the orders by (order-id, timestamp) pairs.
-            # NOTE: We include None's in the tuples below, as placeholders for
-            # dish-IDs, so that we can reuse list_dishes().
-            for oid, ts, item, vendor, price, qty in ordlist:
-                orders[(oid, ts)].append((None, item, vendor, price, qty))
-
-            for i, ((oid, ts), dishes) in enumerate(orders.items(), 1):
-                dt = datetime.fromtimestamp(ts)
-                print('\n%5d. Order placed on %s at %s'
-                      % (i, dt.strftime('%F'), dt.strftime('%T')))
-                list_dishes(dishes)
+    except RuntimeError:
+        print('\nFailed to fetch your orders.')
     input('\nPress <Enter> to return to main menu: ')
 
 
 def place_order():
     ts = int(time.time())   # NOTE: We ignore fractions of a second for now.
-    resp = call_api('add-order',
-                    params={'uid': userdata['uid'], 'timestamp': ts})
+    # The whole cart goes to the server in one request, and is stored in one
+    # transaction.
+    resp = post_api('place-order', {
+        'uid': userdata['uid'],
+        'timestamp': ts,
+        'dishes': [[did, qty] for did, _, _, _, qty in cart],
+    })
     if resp.status_code == HTTP_OK:
-        oid = resp
-        for did, _, _, _, qty in cart:
-            call_api('add-order-dish',
-                     params={'oid': oid, 'did': did, 'quantity': qty})
+        cart.clear()
         print('Order placed successfully!')
     else:
         print('Failed to place order.')
@@ -259,7 +265,9 @@ def login():
         resp = call_api('login-user',
                         params={'username': uname, 'password': pword})
         if resp.status_code == HTTP_OK:
-            userdata['uid'] = resp
+            session = decode(resp)
+            userdata['uid'] = session['uid']
+            set_session_token(session['token'])
             data = get_user_data(userdata['uid'])
             userdata['uname'], userdata['fname'], userdata['phone'] = data
             print('Welcome, %s!' % userdata['fname'])
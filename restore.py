@@ -1,7 +1,417 @@
 # This module implements one possible Data Layer for RestEasy, using SQLite3.
 
+import collections
+import concurrent.futures
 import configparser
+import contextlib
+import functools
+import hashlib
+import hmac
+import itertools
+import logging
+import os
+import queue
+import secrets
 import sqlite3
+import threading
+import time
+
+
+# Schema migrations, applied in order by REStore at startup.
+#
+# Entry N (counting from 1) brings the DB from schema version N-1 to N; the
+# current version of a DB is kept in its "PRAGMA user_version".  Never edit an
+# entry that has shipped: append a new one instead.
+_MIGRATIONS = [
+    # 1: The initial set of tables.
+    # NOTE: We keep "IF NOT EXISTS" here, since DBs created before we started
+    # versioning the schema already have these tables (at user_version 0).
+    [
+        '''\
+        CREATE TABLE IF NOT EXISTS users (
+            uid INTEGER PRIMARY KEY,
+            username TEXT NOT NULL UNIQUE,
+            password TEXT NOT NULL,
+            fullname TEXT NOT NULL,
+            phonenum TEXT NOT NULL
+        );''',
+        '''\
+        CREATE TABLE IF NOT EXISTS admins (
+            aid INTEGER PRIMARY KEY,
+            username TEXT NOT NULL UNIQUE,
+            password TEXT NOT NULL,
+            vid INTEGER NOT NULL,
+            FOREIGN KEY(vid) REFERENCES vendors(vid)
+        );''',
+        '''\
+        CREATE TABLE IF NOT EXISTS vendors (
+            vid INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            address TEXT NOT NULL
+        );''',
+        '''\
+        CREATE TABLE IF NOT EXISTS items (
+            iid INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            calories INTEGER DEFAULT 0
+        );''',
+        '''\
+        CREATE TABLE IF NOT EXISTS dishes (
+            did INTEGER PRIMARY KEY,
+            iid INTEGER NOT NULL,
+            vid INTEGER NOT NULL,
+            price REAL NOT NULL,
+            FOREIGN KEY(iid) REFERENCES items(iid),
+            FOREIGN KEY(vid) REFERENCES vendors(vid)
+        );''',
+        '''\
+        CREATE TABLE IF NOT EXISTS orders (
+            oid INTEGER PRIMARY KEY,
+            uid INTEGER NOT NULL,
+            timestamp INTEGER NOT NULL,
+            FOREIGN KEY(uid) REFERENCES users(uid)
+        );''',
+        '''\
+        CREATE TABLE IF NOT EXISTS orderdishes (
+            oid INTEGER NOT NULL,
+            did INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            cancelled INTEGER DEFAULT 0,
+            FOREIGN KEY(oid) REFERENCES orders(oid),
+            FOREIGN KEY(did) REFERENCES dishes(did)
+        );''',
+    ],
+    # 2: Indexes on the foreign-key columns, used by the joins and lookups.
+    [
+        'CREATE INDEX IF NOT EXISTS dishes_vid ON dishes (vid);',
+        'CREATE INDEX IF NOT EXISTS dishes_iid_vid ON dishes (iid, vid);',
+        'CREATE INDEX IF NOT EXISTS admins_vid ON admins (vid);',
+        'CREATE INDEX IF NOT EXISTS orders_uid ON orders (uid);',
+        'CREATE INDEX IF NOT EXISTS orderdishes_oid ON orderdishes (oid);',
+        'CREATE INDEX IF NOT EXISTS orderdishes_did ON orderdishes (did);',
+    ],
+    # 3: Full-text indexes for searching items and vendors by name.
+    # These are external-content FTS5 tables (they don't store a copy of the
+    # names), kept in sync with their content tables by triggers.  The
+    # "trigram" tokenizer makes a MATCH on a quoted string behave like the
+    # (case-insensitive) "LIKE '%...%'" searches it replaces.
+    [
+        '''\
+        CREATE VIRTUAL TABLE items_fts USING fts5 (
+            name, content='items', content_rowid='iid', tokenize='trigram'
+        );''',
+        '''\
+        CREATE TRIGGER items_fts_ai AFTER INSERT ON items BEGIN
+            INSERT INTO items_fts (rowid, name) VALUES (new.iid, new.name);
+        END;''',
+        '''\
+        CREATE TRIGGER items_fts_ad AFTER DELETE ON items BEGIN
+            INSERT INTO items_fts (items_fts, rowid, name)
+            VALUES ('delete', old.iid, old.name);
+        END;''',
+        '''\
+        CREATE TRIGGER items_fts_au AFTER UPDATE OF name ON items BEGIN
+            INSERT INTO items_fts (items_fts, rowid, name)
+            VALUES ('delete', old.iid, old.name);
+            INSERT INTO items_fts (rowid, name) VALUES (new.iid, new.name);
+        END;''',
+        "INSERT INTO items_fts (items_fts) VALUES ('rebuild');",
+        '''\
+        CREATE VIRTUAL TABLE vendors_fts USING fts5 (
+            name, content='vendors', content_rowid='vid', tokenize='trigram'
+        );''',
+        '''\
+        CREATE TRIGGER vendors_fts_ai AFTER INSERT ON vendors BEGIN
+            INSERT INTO vendors_fts (rowid, name) VALUES (new.vid, new.name);
+        END;''',
+        '''\
+        CREATE TRIGGER vendors_fts_ad AFTER DELETE ON vendors BEGIN
+            INSERT INTO vendors_fts (vendors_fts, rowid, name)
+            VALUES ('delete', old.vid, old.name);
+        END;''',
+        '''\
+        CREATE TRIGGER vendors_fts_au AFTER UPDATE OF name ON vendors BEGIN
+            INSERT INTO vendors_fts (vendors_fts, rowid, name)
+            VALUES ('delete', old.vid, old.name);
+            INSERT INTO vendors_fts (rowid, name) VALUES (new.vid, new.name);
+        END;''',
+        "INSERT INTO vendors_fts (vendors_fts) VALUES ('rebuild');",
+    ],
+    # 4: A version number for the catalog (vendors, items and dishes), bumped
+    # by triggers on every change to it, by any process.
+    [
+        'CREATE TABLE catalog_version (version INTEGER NOT NULL);',
+        'INSERT INTO catalog_version (version) VALUES (1);',
+        '''\
+        CREATE TRIGGER items_catalog_ai AFTER INSERT ON items BEGIN
+            UPDATE catalog_version SET version = version + 1;
+        END;''',
+        '''\
+        CREATE TRIGGER items_catalog_au AFTER UPDATE ON items BEGIN
+            UPDATE catalog_version SET version = version + 1;
+        END;''',
+        '''\
+        CREATE TRIGGER items_catalog_ad AFTER DELETE ON items BEGIN
+            UPDATE catalog_version SET version = version + 1;
+        END;''',
+        '''\
+        CREATE TRIGGER vendors_catalog_ai AFTER INSERT ON vendors BEGIN
+            UPDATE catalog_version SET version = version + 1;
+        END;''',
+        '''\
+        CREATE TRIGGER vendors_catalog_au AFTER UPDATE ON vendors BEGIN
+            UPDATE catalog_version SET version = version + 1;
+        END;''',
+        '''\
+        CREATE TRIGGER vendors_catalog_ad AFTER DELETE ON vendors BEGIN
+            UPDATE catalog_version SET version = version + 1;
+        END;''',
+        '''\
+        CREATE TRIGGER dishes_catalog_ai AFTER INSERT ON dishes BEGIN
+            UPDATE catalog_version SET version = version + 1;
+        END;''',
+        '''\
+        CREATE TRIGGER dishes_catalog_au AFTER UPDATE ON dishes BEGIN
+            UPDATE catalog_version SET version = version + 1;
+        END;''',
+        '''\
+        CREATE TRIGGER dishes_catalog_ad AFTER DELETE ON dishes BEGIN
+            UPDATE catalog_version SET version = version + 1;
+        END;''',
+    ],
+    # 5: Indexes for listing the orders placed in a range of time, by user or
+    # by vendor.  The one on orders (uid, oid, timestamp) serves a user's
+    # orders in ID order (as they are paged), with the time of each at hand
+    # for the range; it supersedes the one on (uid).  The one on orderdishes
+    # (oid, did) covers the step from an order to the vendors of its dishes,
+    # and supersedes the one on (oid).
+    [
+        'CREATE INDEX orders_uid_oid_timestamp '
+        'ON orders (uid, oid, timestamp);',
+        'DROP INDEX IF EXISTS orders_uid;',
+        'CREATE INDEX orders_timestamp ON orders (timestamp);',
+        'CREATE INDEX orderdishes_oid_did ON orderdishes (oid, did);',
+        'DROP INDEX IF EXISTS orderdishes_oid;',
+    ],
+    # 6: A version number for each table of the catalog, rather than one for
+    # the whole of it, so that a change to one table only drops the cached
+    # results read from that table.  (Each starts from the old version, so
+    # that the sum of them, which stands for the whole catalog, still only
+    # goes up.)
+    [
+        '''\
+        CREATE TABLE catalog_versions (
+            tbl TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        ) WITHOUT ROWID;''',
+        '''\
+        INSERT INTO catalog_versions (tbl, version)
+        SELECT tbl, version FROM catalog_version,
+            (SELECT 'items' AS tbl UNION ALL SELECT 'vendors'
+             UNION ALL SELECT 'dishes');''',
+        'DROP TRIGGER items_catalog_ai;',
+        'DROP TRIGGER items_catalog_au;',
+        'DROP TRIGGER items_catalog_ad;',
+        'DROP TRIGGER vendors_catalog_ai;',
+        'DROP TRIGGER vendors_catalog_au;',
+        'DROP TRIGGER vendors_catalog_ad;',
+        'DROP TRIGGER dishes_catalog_ai;',
+        'DROP TRIGGER dishes_catalog_au;',
+        'DROP TRIGGER dishes_catalog_ad;',
+        '''\
+        CREATE TRIGGER items_catalog_ai AFTER INSERT ON items BEGIN
+            UPDATE catalog_versions SET version = version + 1
+            WHERE tbl = 'items';
+        END;''',
+        '''\
+        CREATE TRIGGER items_catalog_au AFTER UPDATE ON items BEGIN
+            UPDATE catalog_versions SET version = version + 1
+            WHERE tbl = 'items';
+        END;''',
+        '''\
+        CREATE TRIGGER items_catalog_ad AFTER DELETE ON items BEGIN
+            UPDATE catalog_versions SET version = version + 1
+            WHERE tbl = 'items';
+        END;''',
+        '''\
+        CREATE TRIGGER vendors_catalog_ai AFTER INSERT ON vendors BEGIN
+            UPDATE catalog_versions SET version = version + 1
+            WHERE tbl = 'vendors';
+        END;''',
+        '''\
+        CREATE TRIGGER vendors_catalog_au AFTER UPDATE ON vendors BEGIN
+            UPDATE catalog_versions SET version = version + 1
+            WHERE tbl = 'vendors';
+        END;''',
+        '''\
+        CREATE TRIGGER vendors_catalog_ad AFTER DELETE ON vendors BEGIN
+            UPDATE catalog_versions SET version = version + 1
+            WHERE tbl = 'vendors';
+        END;''',
+        '''\
+        CREATE TRIGGER dishes_catalog_ai AFTER INSERT ON dishes BEGIN
+            UPDATE catalog_versions SET version = version + 1
+            WHERE tbl = 'dishes';
+        END;''',
+        '''\
+        CREATE TRIGGER dishes_catalog_au AFTER UPDATE ON dishes BEGIN
+            UPDATE catalog_versions SET version = version + 1
+            WHERE tbl = 'dishes';
+        END;''',
+        '''\
+        CREATE TRIGGER dishes_catalog_ad AFTER DELETE ON dishes BEGIN
+            UPDATE catalog_versions SET version = version + 1
+            WHERE tbl = 'dishes';
+        END;''',
+        'DROP TABLE catalog_version;',
+    ],
+    # 7: The orders of each vendor, by time, for listing the orders placed
+    # against a vendor in a range of time without going through those of all
+    # the other vendors in it.  An order is in here once for each vendor it
+    # has dishes from; this is kept in step with "orderdishes" by triggers.
+    # It supersedes the index on orders (timestamp).
+    [
+        '''\
+        CREATE TABLE vendororders (
+            vid INTEGER NOT NULL,
+            timestamp INTEGER NOT NULL,
+            oid INTEGER NOT NULL,
+            PRIMARY KEY (vid, timestamp, oid)
+        ) WITHOUT ROWID;''',
+        '''\
+        INSERT INTO vendororders (vid, timestamp, oid)
+        SELECT DISTINCT dishes.vid, orders.timestamp, orders.oid
+        FROM orderdishes
+        INNER JOIN dishes ON dishes.did = orderdishes.did
+        INNER JOIN orders ON orders.oid = orderdishes.oid;''',
+        '''\
+        CREATE TRIGGER orderdishes_vendororders_ai
+        AFTER INSERT ON orderdishes BEGIN
+            INSERT OR IGNORE INTO vendororders (vid, timestamp, oid)
+            SELECT dishes.vid, orders.timestamp, orders.oid
+            FROM dishes, orders
+            WHERE dishes.did = new.did AND orders.oid = new.oid;
+        END;''',
+        '''\
+        CREATE TRIGGER orderdishes_vendororders_ad
+        AFTER DELETE ON orderdishes BEGIN
+            DELETE FROM vendororders
+            WHERE oid = old.oid
+                AND vid = (SELECT vid FROM dishes WHERE did = old.did)
+                AND NOT EXISTS (
+                    SELECT 1 FROM orderdishes
+                    INNER JOIN dishes ON dishes.did = orderdishes.did
+                    WHERE orderdishes.oid = old.oid
+                        AND dishes.vid = vendororders.vid);
+        END;''',
+        'DROP INDEX IF EXISTS orders_timestamp;',
+    ],
+]
+
+
+# The trigram tokenizer cannot match strings shorter than this; searches for
+# those fall back to a (full scan) "LIKE" query.
+_FTS_MIN_CHARS = 3
+
+
+# Max number of values we bind to a single "IN (...)" list.  (Older SQLite3
+# versions allow at most 999 parameters per statement.)
+_MAX_IN_PARAMS = 500
+
+
+def _chunks(seq, size):
+    '''Split the list "seq" into consecutive slices of at most "size".'''
+    return [seq[i:i+size] for i in range(0, len(seq), size)]
+
+
+def _sql_limit(limit):
+    '''Return "limit" as a value for a LIMIT clause; None means no limit.'''
+    return -1 if limit is None else limit
+
+
+# Public REStore methods that are not timed (and attributed queries) in the
+# query stats: they do not query the DB on behalf of a caller.
+_UNTRACKED_METHODS = {'transaction', 'cache_stats', 'query_stats', 'release',
+                      'close'}
+
+
+# Statements taking longer than "slowquerytime" (see the config) are logged
+# here, with their query plans.
+_slow_log = logging.getLogger('restore.slowquery')
+
+
+def _fts_phrase(text):
+    '''Quote "text" as an FTS5 phrase, so that it is matched literally.'''
+    return '"%s"' % text.replace('"', '""')
+
+
+# Passwords are stored as salted PBKDF2-SHA256 hashes, in the form
+# "pbkdf2_sha256$ITERATIONS$SALT$HASH" (with the salt and hash in hex).
+# Anything else in a password column is a plaintext password from before we
+# hashed them; those are replaced by hashes as their owners log in.
+_HASH_SCHEME = 'pbkdf2_sha256'
+
+# Default number of PBKDF2 iterations; see "hashiterations" in the config.
+_HASH_ITERATIONS = 260000
+
+
+def hash_password(pword, iterations=_HASH_ITERATIONS):
+    '''Return the salted hash of the password "pword", as stored in the DB.
+    (Useful for loading users or admins with pre-hashed passwords.)'''
+    salt = secrets.token_bytes(16)
+    digest = hashlib.pbkdf2_hmac('sha256', pword.encode(), salt, iterations)
+    return '%s$%d$%s$%s' % (_HASH_SCHEME, iterations, salt.hex(), digest.hex())
+
+
+def is_password_hash(value):
+    '''Return True if "value" is a password hash, as returned by
+    hash_password().'''
+    parts = value.split('$')
+    if len(parts) != 4 or parts[0] != _HASH_SCHEME:
+        return False
+    try:
+        bytes.fromhex(parts[2]), bytes.fromhex(parts[3])
+        return int(parts[1]) > 0
+    except ValueError:
+        return False
+
+
+def _verify_password(pword, stored, iterations):
+    '''Check the password "pword" against "stored" (as kept in the DB).
+    Return (ok, rehash): whether it matches, and whether "stored" should be
+    replaced by a fresh hash (with "iterations" iterations).'''
+    scheme, _, rest = stored.partition('$')
+    if scheme != _HASH_SCHEME:
+        # A legacy (plaintext) password.
+        return hmac.compare_digest(pword.encode(), stored.encode()), True
+    count, salt, digest = rest.split('$')
+    actual = hashlib.pbkdf2_hmac('sha256', pword.encode(),
+                                 bytes.fromhex(salt), int(count))
+    return (hmac.compare_digest(actual, bytes.fromhex(digest)),
+            int(count) < iterations)
+
+
+# The order listings return a row per ordered dish, with the rows of an order
+# next to each other; these turn them into a document per order, with its
+# dishes (and, for users, the totals) nested in it, as they are read.  The
+# documents are rows (lists), like the rest of our listings, so that no keys
+# are repeated for every order; the order's fields are sent once, and each
+# dish has only its own fields.
+def _user_order_docs(rows):
+    '''Group the rows of list_order_by_uid() into orders, like
+    [OID, TS, TOTAL, [[ITEM, VENDOR, PRICE, QTY, LINE_TOTAL], ...]].'''
+    for (oid, ts), group in itertools.groupby(rows, lambda row: row[:2]):
+        dishes = [[item, vendor, price, qty, round(price * qty, 2)]
+                  for _, _, item, vendor, price, qty in group]
+        yield [oid, ts, round(sum(dish[-1] for dish in dishes), 2), dishes]
+
+
+def _vendor_order_docs(rows):
+    '''Group the rows of list_order_by_vid() into orders, like
+    [OID, TS, CUSTOMER, [[ITEM, QTY], ...]].'''
+    for (oid, ts, name), group in itertools.groupby(rows,
+                                                    lambda row: row[:3]):
+        yield [oid, ts, name, [[item, qty] for _, _, _, item, qty in group]]
 
 
 class REStore:
@@ -13,7 +423,24 @@ class REStore:
     '''
     def __init__(self, cfile):
         self.__config = self.__read_config(cfile)
-        self.__conn = self.__init_db(self.__config['dbfile'])
+        self.__stats = _QueryStats(
+            self.__config.getfloat('slowquerytime', 0.25),
+            self.__config.get('slowquerylog'))
+        self.__conn = self.__init_db(self.__config)
+        self.__migrate()
+        self.__cache = _ResultCache(self.__config.getint('cachesize', 1024))
+        self.__cache_versions = {}
+        self.__local = threading.local()
+        # Password hashing is slow by design; it runs on a pool of its own,
+        # so that (at most) "hashworkers" threads are busy with it at any
+        # time, however many requests want it.  (hashlib releases the GIL
+        # while hashing, so the workers run in parallel.)
+        self.__iterations = self.__config.getint('hashiterations',
+                                                 _HASH_ITERATIONS)
+        self.__hasher = concurrent.futures.ThreadPoolExecutor(
+            self.__config.getint('hashworkers', os.cpu_count() or 1),
+            thread_name_prefix='restore-hash')
+        self.__dummy_hash = None
         self.__tbl_users = _TableUsers(self.__conn)
         self.__tbl_admins = _TableAdmins(self.__conn)
         self.__tbl_vendors = _TableVendors(self.__conn)
@@ -21,19 +448,55 @@ class REStore:
         self.__tbl_dishes = _TableDishes(self.__conn)
         self.__tbl_orders = _TableOrders(self.__conn)
         self.__tbl_orderdishes = _TableOrderDishes(self.__conn)
+        # Attribute the queries (and time) of each public method to it in the
+        # query stats.
+        for name, attr in vars(REStore).items():
+            if (callable(attr) and not name.startswith('_')
+                    and name not in _UNTRACKED_METHODS):
+                setattr(self, name,
+                        self.__stats.track(name, getattr(self, name)))
 
 
-    def __init_db(self, dbfile):
+    def __init_db(self, config):
         try:
-            conn = sqlite3.connect(dbfile, check_same_thread=False)
-            # NOTE: SQLite3 requires us to explicitly enable foreign-key
-            # support at runtime.
-            conn.execute('PRAGMA foreign_keys = ON;')
-            return conn
+            pool = _ConnectionPool(config['dbfile'],
+                                   config.getint('poolsize', 8),
+                                   config.getfloat('busytimeout', 5.0),
+                                   self.__stats)
+            # Open (and validate) the connection for this thread right away,
+            # so that a bad "dbfile" is reported here rather than on the
+            # first query.
+            pool.connection()
+            return pool
         except Exception as e:
             raise RuntimeError('failed to connect with DB: %s' % e)
 
 
+    # Bring the DB schema up to date, applying each pending migration in a
+    # transaction of its own.
+    def __migrate(self):
+        while True:
+            # NOTE: "BEGIN IMMEDIATE" takes the write lock before we read the
+            # version, so two processes starting up together cannot both
+            # apply the same migration.
+            self.__conn.execute('BEGIN IMMEDIATE;')
+            version = self.__conn.execute('PRAGMA user_version;').fetchone()[0]
+            if version >= len(_MIGRATIONS):
+                self.__conn.commit()
+                return
+            try:
+                for stmt in _MIGRATIONS[version]:
+                    self.__conn.execute(stmt)
+                # NOTE: PRAGMA doesn't accept parameters, hence the "%d".
+                self.__conn.execute(
+                    'PRAGMA user_version = %d;' % (version + 1))
+                self.__conn.commit()
+            except Exception as e:
+                self.__conn.rollback()
+                raise RuntimeError('failed to migrate DB to version %d: %s'
+                                   % (version + 1, e))
+
+
     # Read the config at startup.
     def __read_config(self, cfile):
         config = configparser.ConfigParser()
@@ -49,7 +512,25 @@ class REStore:
 
     def add_user(self, uname, pword, fname, phone):
         '''Add a new user with specified user data.'''
-        self.__tbl_users.add_user(uname, pword, fname, phone)
+        self.__tbl_users.add_user(uname, self.__hash(pword), fname, phone)
+
+
+    def add_users(self, users, hashed=False):
+        '''Add the "users" (a list of uname, pword, fname, phone tuples) in one
+        go.  Users whose usernames are taken (in the DB, or by an earlier entry
+        in "users") are skipped.  Return the list of the skipped usernames.
+        If "hashed" is True, the passwords are already hashed (see
+        hash_password()).'''
+        users = list(users)
+        if not hashed:
+            phashes = self.__hasher.map(
+                functools.partial(hash_password,
+                                  iterations=self.__iterations),
+                [pword for _, pword, _, _ in users])
+            users = [(uname, phash, fname, phone)
+                     for (uname, _, fname, phone), phash
+                     in zip(users, phashes)]
+        return self.__tbl_users.add_users(users)
 
 
     def user_exists(self, uname):
@@ -62,10 +543,19 @@ class REStore:
         self.__tbl_users.del_user(uname)
 
 
+    def del_users(self, unames):
+        '''Delete all the users in "unames" from the "users" table, except
+        those who have placed orders.  Return the list of the skipped
+        usernames.'''
+        return self.__tbl_users.del_users(unames)
+
+
     def check_user_credentials(self, uname, pword):
         '''Verify if uname,pword is a correct pair of credentials in "users"
         table.  If yes, return the corresponding "uid".'''
-        return self.__tbl_users.check_credentials(uname, pword)
+        row = self.__check_password(self.__tbl_users.get_credentials(uname),
+                                    pword, self.__tbl_users.set_password)
+        return row[0] if row else None
 
 
     def user_data(self, uid):
@@ -76,7 +566,7 @@ class REStore:
     # --- API around the `admins` table. ---
     def add_admin(self, uname, pword, vid):
         '''Add a new admin with specified user data.'''
-        self.__tbl_admins.add_admin(uname, pword, vid)
+        self.__tbl_admins.add_admin(uname, self.__hash(pword), vid)
 
 
     def admin_exists(self, uname):
@@ -86,13 +576,43 @@ class REStore:
 
     def del_admin(self, uname):
         '''Delete the admin with username "uname" from the "admins" table.'''
-        self.__tbl_users.del_admin(uname)
+        self.__tbl_admins.del_admin(uname)
 
 
     def check_admin_credentials(self, uname, pword):
         '''Verify if uname,pword is a correct pair of credentials in "admins"
-        table.  If yes, return the corresponding "aid".'''
-        return self.__tbl_admins.check_credentials(uname, pword)
+        table.  If yes, return the corresponding (aid, vid).'''
+        return self.__check_password(self.__tbl_admins.get_credentials(uname),
+                                     pword, self.__tbl_admins.set_password)
+
+
+    # --- Password hashing. ---
+    def __hash(self, pword):
+        # Hash "pword" (on the hashing pool) for storing it.
+        return self.__hasher.submit(hash_password, pword,
+                                    self.__iterations).result()
+
+
+    def __check_password(self, row, pword, set_password):
+        # Check "pword" against "row": the ID(s) of a user or admin, followed
+        # by their stored password; or None if there is no such user/admin.
+        # Return the ID(s) if it matches, else None.  Legacy (or weaker)
+        # hashes are replaced, using "set_password(first ID, hash)".
+        if row is None:
+            # Spend as much time on a missing user as on a wrong password, so
+            # that the response time does not tell them apart.
+            if self.__dummy_hash is None:
+                self.__dummy_hash = self.__hash('')
+            stored = self.__dummy_hash
+        else:
+            stored = row[-1]
+        ok, rehash = self.__hasher.submit(_verify_password, pword, stored,
+                                          self.__iterations).result()
+        if row is None or not ok:
+            return None
+        if rehash:
+            set_password(row[0], self.__hash(pword))
+        return tuple(row[:-1])
 
 
     # --- API around the `vendors` table. ---
@@ -104,7 +624,9 @@ class REStore:
 
     def add_vendor(self, name, addr):
         '''Add a new vendor with specified data.  Return the vendor ID.'''
-        return self.__tbl_vendors.add_vendor(name, addr)
+        vid = self.__tbl_vendors.add_vendor(name, addr)
+        self.__invalidate('vendors')
+        return vid
 
 
     def vendor_exists(self, name):
@@ -115,23 +637,47 @@ class REStore:
     def del_vendor(self, name):
         '''Delete vendor "name" from the "vendors" table.'''
         self.__tbl_vendors.del_vendor(name)
+        self.__invalidate('vendors')
 
 
-    def list_vendors(self):
-        '''Return a list of all available vendors.'''
-        return self.__tbl_vendors.list_vendors()
+    def list_vendors(self, after=0, limit=None):
+        '''Return a list of all available vendors, ordered by vendor ID.
+        To fetch them in pages, pass the "limit" on the number of vendors,
+        and the ID of the last vendor seen as "after".'''
+        return self.__cached(('vendors',), self.__tbl_vendors.list_vendors,
+                             after, limit)
 
 
     def list_vendors_by_name(self, name):
-        '''Return a list of all vendors with "name" in their names.'''
-        return self.__tbl_vendors.list_vendors_by_name(name)
+        '''Return a list of all vendors with "name" in their names, best
+        matches first.'''
+        return self.__cached(('vendors',),
+                             self.__tbl_vendors.list_vendors_by_name, name)
+
+
+    def catalog_version(self):
+        '''Return the current version of the catalog: a number that changes
+        whenever any vendor, item or dish is added, changed or deleted.'''
+        cursor = self.__conn.execute(
+            'SELECT SUM(version) FROM catalog_versions;')
+        return cursor.fetchone()[0]
+
+
+    def catalog_versions(self):
+        '''Return a dict with the current version of each table of the
+        catalog ("vendors", "items" and "dishes"), as catalog_version().'''
+        cursor = self.__conn.execute(
+            'SELECT tbl, version FROM catalog_versions;')
+        return dict(cursor.fetchall())
 
 
     # --- API around the `items` table. ---
     def add_item(self, name, cals=0):
         '''Add a new item with specified data.
         Return the corresponding unique (item) ID.'''
-        return self.__tbl_items.add_item(name, cals)
+        iid = self.__tbl_items.add_item(name, cals)
+        self.__invalidate('items')
+        return iid
 
 
     def get_iid(self, name):
@@ -139,6 +685,14 @@ class REStore:
         return self.__tbl_items.get_iid(name)
 
 
+    def add_items(self, names):
+        '''Add all the items in "names" (with 0 calories) that do not exist
+        yet.  Return a dict mapping each of the names to its item ID.'''
+        iids = self.__tbl_items.add_items(names)
+        self.__invalidate('items')
+        return iids
+
+
     def item_exists(self, name):
         '''Return True if item "name" already exists; False otherwise.'''
         return self.__tbl_items.item_exists(name)
@@ -147,12 +701,14 @@ class REStore:
     def del_item(self, name):
         '''Delete item "name" from the "items" table.'''
         self.__tbl_items.del_item(name)
+        self.__invalidate('items')
 
 
     # --- API around the `dishes` table. ---
     def add_dish(self, iid, vid, price):
         '''Add a dish to the "dishes" table.'''
         self.__tbl_dishes.add_dish(iid, vid, price)
+        self.__invalidate('dishes')
 
 
     def get_did(self, iid, vid):
@@ -160,6 +716,20 @@ class REStore:
         return self.__tbl_dishes.get_did(iid, vid)
 
 
+    def add_dishes(self, dishes):
+        '''Add all the "dishes" (a list of iid, vid, price tuples) to the
+        "dishes" table.  Unlike add_dish(), this does not check if any of them
+        already exist.'''
+        self.__tbl_dishes.add_dishes(dishes)
+        self.__invalidate('dishes')
+
+
+    def dish_ids(self):
+        '''Return a dict mapping (item name, vendor name) pairs to the IDs of
+        the corresponding dishes, for all dishes.'''
+        return self.__tbl_dishes.dish_ids()
+
+
     def dish_exists(self, iid, vid):
         '''Check if the dish "iid,vid" exists in the "dishes" table.'''
         return self.__tbl_dishes.dish_exists(iid, vid)
@@ -168,16 +738,20 @@ class REStore:
     def del_dish(self, iid, vid):
         '''Delete a dish from the "dishes" table.'''
         self.__tbl_dishes.del_dish(iid, vid)
+        self.__invalidate('dishes')
 
 
     def list_dishes_by_name(self, name):
-        '''List dishes (by all vendors) that have "name" in their names.'''
-        return self.__tbl_dishes.list_dishes_by_name(name)
+        '''List dishes (by all vendors) that have "name" in their names, best
+        matches first.'''
+        return self.__cached(('dishes', 'items', 'vendors'),
+                             self.__tbl_dishes.list_dishes_by_name, name)
 
 
     def list_dishes_by_vendor(self, vid):
         '''List dishes offered by the vendor with ID "vid".'''
-        return self.__tbl_dishes.list_dishes_by_vendor(vid)
+        return self.__cached(('dishes', 'items', 'vendors'),
+                             self.__tbl_dishes.list_dishes_by_vendor, vid)
 
 
     # --- API around the `orders` and `orderdishes` tables. ---
@@ -189,8 +763,15 @@ class REStore:
 
     def del_order(self, oid):
         '''Delete the order with the ID "oid".'''
-        self.__tbl_orderdishes.del_order_dishes(oid)
-        self.__tbl_orders.del_order(oid)
+        with self.transaction():
+            self.__tbl_orderdishes.del_order_dishes(oid)
+            self.__tbl_orders.del_order(oid)
+
+
+    def get_order_uid(self, oid):
+        '''Return the ID of the user who placed the order "oid", or None if
+        there is no such order.'''
+        return self.__tbl_orders.get_uid(oid)
 
 
     def add_order_dish(self, oid, did, qty):
@@ -199,38 +780,645 @@ class REStore:
         self.__tbl_orderdishes.add_order_dish(oid, did, qty)
 
 
-    def list_order_by_uid(self, uid):
-        '''List the dishes ordered by user "uid".'''
-        return self.__tbl_orderdishes.list_order_by_uid(uid)
+    def place_order(self, uid, ts, dishes):
+        '''Place an order for user "uid" at time "ts", for "dishes": a list of
+        (did, qty) pairs.  The "orders" and "orderdishes" entries are written
+        in a single transaction: either all of them are made, or none.
+        Return the (unique) order ID.'''
+        with self.transaction():
+            oid = self.__tbl_orders.add_order(uid, ts)
+            self.__tbl_orderdishes.add_order_dishes(oid, dishes)
+        return oid
+
+
+    def list_order_by_uid(self, uid, after=0, limit=None):
+        '''List the dishes ordered by user "uid", ordered by order ID.
+        To fetch them in pages, pass the "limit" on the number of orders
+        (not dishes), and the ID of the last order seen as "after".'''
+        return list(self.iter_order_by_uid(uid, after, limit))
+
+
+    def iter_order_by_uid(self, uid, after=0, limit=None):
+        '''Like list_order_by_uid(), but return an iterator over the rows,
+        which are read from the DB as the iterator is consumed.  The iterator
+        must be consumed by the calling thread, before it calls release().'''
+        return self.__tbl_orderdishes.list_order_by_uid(uid, after, limit)
+
+
+    def list_order_by_vid(self, vid, after=0, limit=None):
+        '''List the dishes ordered against vendor "vid", ordered by order ID.
+        To fetch them in pages, pass the "limit" on the number of orders
+        (not dishes), and the ID of the last order seen as "after".'''
+        return list(self.iter_order_by_vid(vid, after, limit))
+
+
+    def iter_order_by_vid(self, vid, after=0, limit=None):
+        '''Like list_order_by_vid(), but return an iterator over the rows,
+        which are read from the DB as the iterator is consumed.  The iterator
+        must be consumed by the calling thread, before it calls release().'''
+        return self.__tbl_orderdishes.list_order_by_vid(vid, after, limit)
+
+
+    def list_order_docs_by_uid(self, uid, after=0, limit=None):
+        '''Like list_order_by_uid(), but return a document per order, with
+        its dishes and totals in it (see _user_order_docs()).  The paging is
+        the same.'''
+        return list(self.iter_order_docs_by_uid(uid, after, limit))
+
+
+    def iter_order_docs_by_uid(self, uid, after=0, limit=None):
+        '''Like list_order_docs_by_uid(), but return an iterator over the
+        documents (see iter_order_by_uid()).'''
+        return _user_order_docs(self.iter_order_by_uid(uid, after, limit))
+
+
+    def list_order_docs_by_vid(self, vid, after=0, limit=None):
+        '''Like list_order_by_vid(), but return a document per order, with
+        its customer and dishes in it (see _vendor_order_docs()).  The
+        paging is the same.'''
+        return list(self.iter_order_docs_by_vid(vid, after, limit))
+
+
+    def iter_order_docs_by_vid(self, vid, after=0, limit=None):
+        '''Like list_order_docs_by_vid(), but return an iterator over the
+        documents (see iter_order_by_vid()).'''
+        return _vendor_order_docs(self.iter_order_by_vid(vid, after, limit))
+
+
+    def list_order_by_uid_between(self, uid, start, end, after=0, limit=None):
+        '''Like list_order_by_uid(), but list only the orders placed at times
+        (in seconds since the epoch) in the range ["start", "end").'''
+        return list(self.iter_order_by_uid_between(uid, start, end,
+                                                   after, limit))
+
+
+    def iter_order_by_uid_between(self, uid, start, end, after=0, limit=None):
+        '''Like list_order_by_uid_between(), but return an iterator over the
+        rows (see iter_order_by_uid()).'''
+        return self.__tbl_orderdishes.list_order_by_uid_between(
+            uid, start, end, after, limit)
+
+
+    def list_order_by_vid_between(self, vid, start, end, after=0, limit=None):
+        '''Like list_order_by_vid(), but list only the orders placed at times
+        (in seconds since the epoch) in the range ["start", "end").'''
+        return list(self.iter_order_by_vid_between(vid, start, end,
+                                                   after, limit))
 
 
-    def list_order_by_vid(self, vid):
-        '''List the dishes ordered against vendor "vid".'''
-        return self.__tbl_orderdishes.list_order_by_vid(vid)
+    def iter_order_by_vid_between(self, vid, start, end, after=0, limit=None):
+        '''Like list_order_by_vid_between(), but return an iterator over the
+        rows (see iter_order_by_vid()).'''
+        return self.__tbl_orderdishes.list_order_by_vid_between(
+            vid, start, end, after, limit)
 
 
-    # Close the DB connection.
+    # Group several changes into one transaction.
+    @contextlib.contextmanager
+    def transaction(self):
+        '''Return a context manager for a transaction.  All the changes made
+        by the calling thread inside the "with" block are committed together
+        when the block exits normally, or rolled back if it raises.  Blocks can
+        be nested; an inner block is rolled back on its own if it raises.
+        The (outermost) block holds the DB's write lock throughout, so keep it
+        short, and don't use it just for reading.
+
+        Outside of such a block, each change is committed immediately.'''
+        try:
+            with self.__conn.transaction():
+                yield
+        finally:
+            if not self.__conn.in_transaction():
+                # Only now are the changes visible to (or undone for) other
+                # threads; drop whatever they may have cached in the meantime.
+                pending, self.__local.pending = \
+                    self.__pending_invalidations(), set()
+                self.__cache.invalidate(pending)
+
+
+    # --- Result cache for the (rarely changing) catalog reads. ---
+    def __cached(self, tables, func, *args):
+        # Return the result of "func(*args)", which reads from "tables", from
+        # the cache if possible.  The result is cached as a tuple, and a fresh
+        # list is returned, so callers cannot corrupt the cached copy.
+        if self.__conn.in_transaction():
+            # We might see our own (uncommitted) changes here; don't share
+            # those with others.
+            return func(*args)
+        # Other processes (e.g. the process-*.py scripts) may have changed the
+        # catalog behind our back; drop what we read from the tables they
+        # changed.  (Our own changes are caught here too, and once more
+        # dropped; but by then there's nothing left to drop for them.)
+        versions = self.catalog_versions()
+        changed = [tbl for tbl, version in versions.items()
+                   if self.__cache_versions.get(tbl) != version]
+        if changed:
+            self.__cache.invalidate(changed)
+            self.__cache_versions = versions
+        key = (func.__name__,) + args
+        hit, rows = self.__cache.get(key)
+        if not hit:
+            stamp = self.__cache.stamp(tables)
+            rows = tuple(func(*args))
+            self.__cache.put(key, tables, stamp, rows)
+        return list(rows)
+
+
+    def __invalidate(self, *tables):
+        # Drop all cached results that depend on "tables".  Inside a
+        # transaction, do it once more when it's done (see transaction()).
+        self.__cache.invalidate(tables)
+        if self.__conn.in_transaction():
+            self.__pending_invalidations().update(tables)
+
+
+    def __pending_invalidations(self):
+        if not hasattr(self.__local, 'pending'):
+            self.__local.pending = set()
+        return self.__local.pending
+
+
+    def cache_stats(self):
+        '''Return a dict with the statistics (hits, misses, evictions, etc.)
+        of the result cache.'''
+        return self.__cache.stats()
+
+
+    def query_stats(self):
+        '''Return a dict with the statistics of the SQL statements run so far
+        (by statement), and of the REStore methods called (by method).  See
+        _QueryStats.snapshot() for the details.'''
+        return self.__stats.snapshot()
+
+
+    # Return the DB connection used by the calling thread to the pool.
+    # Long-lived multi-threaded callers (like the API server) should call this
+    # at the end of each unit of work (e.g. each request).
+    def release(self):
+        self.__conn.release()
+        self.__local.pending = set()
+
+
+    # Close all the DB connections, and stop the hashing pool.
     def close(self):
         self.__conn.close()
+        self.__hasher.shutdown()
+
+
+class _ResultCache:
+    '''
+    A bounded LRU cache for query results, used by REStore.
+
+    Each entry records the tables it was read from.  A write to a table bumps
+    that table's version and drops all the entries that depend on it.  A
+    result is only cached if none of its tables changed while it was being
+    read (see stamp() and put()), so a slow reader cannot put stale data back
+    after an invalidation.
+    '''
+    def __init__(self, maxsize):
+        self.__maxsize = maxsize
+        self.__entries = collections.OrderedDict()  # key -> (tables, value)
+        self.__keys = collections.defaultdict(set)  # table -> keys
+        self.__versions = collections.Counter()     # table -> version
+        self.__lock = threading.Lock()
+        self.__counts = collections.Counter()
+
+
+    def get(self, key):
+        '''Return (True, value) if "key" is cached, else (False, None).'''
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.__counts['misses'] += 1
+                return False, None
+            self.__entries.move_to_end(key)
+            self.__counts['hits'] += 1
+            return True, entry[1]
+
+
+    def stamp(self, tables):
+        '''Return the current versions of "tables", to be passed to put().'''
+        with self.__lock:
+            return [self.__versions[table] for table in tables]
+
+
+    def put(self, key, tables, stamp, value):
+        '''Cache "value" (read from "tables") under "key", unless any of the
+        tables changed since "stamp" was taken.'''
+        if self.__maxsize <= 0:
+            return
+        with self.__lock:
+            if stamp != [self.__versions[table] for table in tables]:
+                return
+            self.__entries[key] = (tables, value)
+            self.__entries.move_to_end(key)
+            for table in tables:
+                self.__keys[table].add(key)
+            while len(self.__entries) > self.__maxsize:
+                self.__drop(next(iter(self.__entries)))
+                self.__counts['evictions'] += 1
+
+
+    def invalidate(self, tables):
+        '''Drop all the entries that depend on any of "tables".'''
+        with self.__lock:
+            for table in tables:
+                self.__versions[table] += 1
+                for key in list(self.__keys[table]):
+                    self.__drop(key)
+                    self.__counts['invalidations'] += 1
+
+
+    def __drop(self, key):
+        tables, _ = self.__entries.pop(key)
+        for table in tables:
+            self.__keys[table].discard(key)
+
+
+    def stats(self):
+        '''Return a dict with the cache's counters and its current size.'''
+        with self.__lock:
+            return {
+                'hits': self.__counts['hits'],
+                'misses': self.__counts['misses'],
+                'evictions': self.__counts['evictions'],
+                'invalidations': self.__counts['invalidations'],
+                'size': len(self.__entries),
+                'maxsize': self.__maxsize,
+            }
+
+
+class _QueryStats:
+    '''
+    Statistics of the SQL statements run by a REStore, and of its methods.
+
+    For each statement (with its whitespace normalized), we count the times it
+    was run, the rows it returned (or changed), and the time spent running it,
+    including fetching its results.  For each public REStore method, we count
+    the calls, the time spent in it, and the statements it ran (and the time
+    spent on those).  Statements slower than "slowtime" seconds are logged to
+    the "restore.slowquery" logger, along with their query plans; if
+    "logfile" is given, that log is (also) written to it.
+    '''
+    def __init__(self, slowtime, logfile=None):
+        self.__slowtime = slowtime
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__statements = collections.defaultdict(collections.Counter)
+        self.__methods = collections.defaultdict(collections.Counter)
+        if logfile and not any(
+                getattr(h, 'baseFilename', None) == os.path.abspath(logfile)
+                for h in _slow_log.handlers):
+            handler = logging.FileHandler(logfile)
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            _slow_log.addHandler(handler)
+
+
+    def track(self, name, func):
+        '''Return a wrapper around "func", which records the calls to it as
+        calls to the method "name".  Calls made from within another tracked
+        method are counted as part of that one.'''
+        @functools.wraps(func)
+        def tracked(*args, **kwargs):
+            if getattr(self.__local, 'method', None) is not None:
+                return func(*args, **kwargs)
+            self.__local.method = name
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.__local.method = None
+                elapsed = time.perf_counter() - start
+                with self.__lock:
+                    counts = self.__methods[name]
+                    counts['calls'] += 1
+                    counts['time'] += elapsed
+        return tracked
+
+
+    def execute(self, conn, sql, params=()):
+        '''Run "sql" on "conn", and return its cursor, wrapped so that the
+        time spent fetching the results is accounted for too.'''
+        start = time.perf_counter()
+        cursor = conn.execute(sql, params)
+        return _TimedCursor(self, conn, cursor, sql, params,
+                            getattr(self.__local, 'method', None),
+                            time.perf_counter() - start)
+
+
+    def executemany(self, conn, sql, seq_of_params):
+        '''Like execute(), for "conn.executemany()".'''
+        start = time.perf_counter()
+        cursor = conn.executemany(sql, seq_of_params)
+        return _TimedCursor(self, conn, cursor, sql, None,
+                            getattr(self.__local, 'method', None),
+                            time.perf_counter() - start)
+
+
+    def record(self, conn, sql, params, method, elapsed, rows):
+        '''Record a run of "sql" (by "method"), which took "elapsed" seconds
+        and returned (or changed) "rows" rows.'''
+        key = _normalize_sql(sql)
+        slow = 0 < self.__slowtime <= elapsed
+        with self.__lock:
+            counts = self.__statements[key]
+            counts['calls'] += 1
+            counts['rows'] += rows
+            counts['time'] += elapsed
+            counts['slow'] += slow
+            if elapsed > counts['max_time']:
+                counts['max_time'] = elapsed
+            if method is not None:
+                counts = self.__methods[method]
+                counts['queries'] += 1
+                counts['query_time'] += elapsed
+        if slow:
+            _slow_log.warning('%.3fs, %d rows, in %s: %s [params: %s]%s',
+                              elapsed, rows, method or '-', key,
+                              _redact_params(params),
+                              self.__query_plan(conn, sql, params))
+
+
+    def __query_plan(self, conn, sql, params):
+        # Return the query plan of "sql" as an indented tree (in a string
+        # starting with a newline), or an empty string if there's none.
+        if params is None or not sql.lstrip().upper().startswith(
+                ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')):
+            return ''
+        try:
+            plan = conn.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            depths, lines = {0: 0}, []
+            for node, parent, _, detail in plan:
+                depths[node] = depths.get(parent, 0) + 1
+                lines.append('  ' * depths[node] + detail)
+            return ''.join('\n' + line for line in lines)
+        except sqlite3.Error:
+            return ''
+
+
+    def snapshot(self):
+        '''Return a dict with the current statistics: under "statements",
+        the calls, rows, slow runs, and total/mean/max time (in seconds) of
+        each statement; under "methods", the calls, total time, queries and
+        query time of each REStore method.'''
+        with self.__lock:
+            statements = {
+                sql: {
+                    'calls': c['calls'],
+                    'rows': c['rows'],
+                    'slow': c['slow'],
+                    'time': c['time'],
+                    'mean_time': c['time'] / c['calls'],
+                    'max_time': c['max_time'],
+                }
+                for sql, c in self.__statements.items()
+            }
+            methods = {
+                name: {
+                    'calls': c['calls'],
+                    'time': c['time'],
+                    'queries': c['queries'],
+                    'query_time': c['query_time'],
+                }
+                for name, c in self.__methods.items()
+            }
+        return {'statements': statements, 'methods': methods}
+
+
+class _TimedCursor:
+    '''
+    A wrapper around an sqlite3 cursor, used by _QueryStats.
+
+    The statement is recorded (with the time spent executing it and fetching
+    its rows) once all its rows have been fetched: by fetchone(), fetchall(),
+    or by iterating over the cursor to the end.  Statements that return no
+    rows (e.g. inserts) are recorded right away.  Everything else is passed
+    through to the cursor.
+    '''
+    def __init__(self, stats, conn, cursor, sql, params, method, elapsed):
+        self.__stats = stats
+        self.__conn = conn
+        self.__cursor = cursor
+        self.__sql = sql
+        self.__params = params
+        self.__method = method
+        self.__elapsed = elapsed
+        self.__rows = 0
+        self.__done = False
+        if cursor.description is None:
+            self.__finish(max(cursor.rowcount, 0))
+
+
+    def __finish(self, rows=0):
+        if not self.__done:
+            self.__done = True
+            self.__stats.record(self.__conn, self.__sql, self.__params,
+                                self.__method, self.__elapsed,
+                                self.__rows + rows)
+
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self.__cursor.fetchone()
+        self.__elapsed += time.perf_counter() - start
+        self.__finish(0 if row is None else 1)
+        return row
+
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self.__cursor.fetchall()
+        self.__elapsed += time.perf_counter() - start
+        self.__finish(len(rows))
+        return rows
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = next(self.__cursor)
+        except StopIteration:
+            self.__elapsed += time.perf_counter() - start
+            self.__finish()
+            raise
+        self.__elapsed += time.perf_counter() - start
+        self.__rows += 1
+        return row
+
+
+    def __getattr__(self, name):
+        return getattr(self.__cursor, name)
+
+
+@functools.lru_cache(maxsize=1024)
+def _normalize_sql(sql):
+    '''Return "sql" with all runs of whitespace collapsed into one space.'''
+    return ' '.join(sql.split())
+
+
+def _redact_params(params):
+    '''Return the "params" of a statement as a string fit for the slow query
+    log: numbers (IDs, timestamps, etc.) are shown as they are, but strings
+    and blobs (which may be names, passwords or their hashes) only by their
+    type and length.'''
+    if params is None:          # From executemany().
+        return 'None'
+    if isinstance(params, dict):
+        params = params.values()
+    return ', '.join(repr(param) if param is None
+                     or isinstance(param, (int, float))
+                     else '<%s:%d>' % (type(param).__name__, len(param))
+                     for param in params)
+
+
+class _ConnectionPool:
+    '''
+    A pool of SQLite3 connections, shared by all threads using a REStore.
+
+    Each thread gets a connection of its own from the pool the first time it
+    runs a query, and keeps using it until it calls release().  The connections
+    use WAL journaling, so readers in different threads run in parallel with
+    (at most) one writer, instead of all of them serializing on one shared
+    connection.
+
+    The pool exposes the subset of the sqlite3.Connection API used by the
+    _Table* classes, so they can use it as if it were a plain connection.
+    The one difference is that commit() does nothing while the calling thread
+    is inside a transaction() block: the block commits when it's done.
+    Statements run through execute() and executemany() are recorded in
+    "stats" (a _QueryStats).
+    '''
+    def __init__(self, dbfile, size, timeout, stats):
+        self.__dbfile = dbfile
+        self.__timeout = timeout
+        self.__stats = stats
+        self.__idle = queue.LifoQueue(maxsize=size)
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__all = set()
+
+
+    def __connect(self):
+        conn = sqlite3.connect(self.__dbfile, timeout=self.__timeout,
+                               check_same_thread=False)
+        # NOTE: SQLite3 requires us to explicitly enable foreign-key
+        # support at runtime.
+        conn.execute('PRAGMA foreign_keys = ON;')
+        # WAL mode is persistent (it's stored in the DB file), but setting it
+        # on every connection is harmless and covers newly created DBs.  With
+        # WAL, "synchronous = NORMAL" is still safe against corruption, and
+        # avoids an fsync on every commit.
+        conn.execute('PRAGMA journal_mode = WAL;')
+        conn.execute('PRAGMA synchronous = NORMAL;')
+        with self.__lock:
+            self.__all.add(conn)
+        return conn
+
+
+    def connection(self):
+        '''Return the connection bound to the calling thread, taking one from
+        the pool (or opening a new one) if needed.'''
+        conn = getattr(self.__local, 'conn', None)
+        if conn is None:
+            try:
+                conn = self.__idle.get_nowait()
+            except queue.Empty:
+                conn = self.__connect()
+            self.__local.conn = conn
+        return conn
+
+
+    def execute(self, sql, params=()):
+        return self.__stats.execute(self.connection(), sql, params)
+
+
+    def executemany(self, sql, seq_of_params):
+        return self.__stats.executemany(self.connection(), sql, seq_of_params)
+
+
+    def commit(self):
+        if not self.in_transaction():
+            self.connection().commit()
+
+
+    def in_transaction(self):
+        '''Return True if the calling thread is in a transaction() block.'''
+        return getattr(self.__local, 'depth', 0) > 0
+
+
+    @contextlib.contextmanager
+    def transaction(self):
+        conn = self.connection()
+        depth = getattr(self.__local, 'depth', 0)
+        # The outermost block is a real transaction; inner ones are savepoints
+        # within it, so that they can be rolled back on their own.
+        # NOTE: "BEGIN IMMEDIATE" takes the write lock up front (waiting for
+        # it under the busy timeout).  With a plain "BEGIN", a block that
+        # reads before it writes would hold a snapshot, and its first write
+        # would fail at once (without waiting) if another connection had
+        # committed in the meantime.
+        if depth == 0:
+            conn.execute('BEGIN IMMEDIATE;')
+        else:
+            conn.execute('SAVEPOINT tx%d;' % depth)
+        self.__local.depth = depth + 1
+        try:
+            yield
+        except BaseException:
+            self.__local.depth = depth
+            if depth == 0:
+                conn.rollback()
+            else:
+                conn.execute('ROLLBACK TO tx%d;' % depth)
+                conn.execute('RELEASE tx%d;' % depth)
+            raise
+        else:
+            self.__local.depth = depth
+            if depth == 0:
+                conn.commit()
+            else:
+                conn.execute('RELEASE tx%d;' % depth)
+
+
+    def rollback(self):
+        self.connection().rollback()
+
+
+    def release(self):
+        '''Return the calling thread's connection (if any) to the pool.'''
+        conn = getattr(self.__local, 'conn', None)
+        if conn is None:
+            return
+        self.__local.conn = None
+        self.__local.depth = 0
+        # Never hand over a connection with a pending transaction.
+        conn.rollback()
+        try:
+            self.__idle.put_nowait(conn)
+        except queue.Full:
+            with self.__lock:
+                self.__all.discard(conn)
+            conn.close()
+
+
+    def close(self):
+        '''Close all connections opened by the pool.'''
+        with self.__lock:
+            conns, self.__all = self.__all, set()
+        for conn in conns:
+            conn.close()
+        self.__idle = queue.LifoQueue(maxsize=self.__idle.maxsize)
+        self.__local = threading.local()
 
 
 class _TableUsers:
     '''Abstraction of the "users" table.'''
     def __init__(self, conn):
         self.__conn = conn
-        self.__create_table()
-
-
-    def __create_table(self):
-        self.__conn.execute('''\
-            CREATE TABLE IF NOT EXISTS users (
-                uid INTEGER PRIMARY KEY,
-                username TEXT NOT NULL UNIQUE,
-                password TEXT NOT NULL,
-                fullname TEXT NOT NULL,
-                phonenum TEXT NOT NULL
-            );''')
-        self.__conn.commit()
 
 
     def get_uid(self, uname):
@@ -240,13 +1428,36 @@ class _TableUsers:
         return row[0] if row else None
 
 
-    def add_user(self, uname, pword, fname, phone):
+    def add_user(self, uname, phash, fname, phone):
         if self.user_exists(uname):
             raise RuntimeError("user '%s' already exists" % uname)
         self.__conn.execute('''\
             INSERT INTO users (username, password, fullname, phonenum)
-            VALUES (?, ?, ?, ?);''', (uname, pword, fname, phone))
+            VALUES (?, ?, ?, ?);''', (uname, phash, fname, phone))
+        self.__conn.commit()
+
+
+    def add_users(self, users):
+        unames = [user[0] for user in users]
+        taken = set()
+        for chunk in _chunks(unames, _MAX_IN_PARAMS):
+            cursor = self.__conn.execute(
+                'SELECT username FROM users WHERE username IN (%s);'
+                % ', '.join('?' * len(chunk)), chunk)
+            taken.update(row[0] for row in cursor)
+
+        rows, conflicts = [], []
+        for user in users:
+            if user[0] in taken:
+                conflicts.append(user[0])
+            else:
+                taken.add(user[0])
+                rows.append(user)
+        self.__conn.executemany('''\
+            INSERT INTO users (username, password, fullname, phonenum)
+            VALUES (?, ?, ?, ?);''', rows)
         self.__conn.commit()
+        return conflicts
 
 
     def user_exists(self, uname):
@@ -259,12 +1470,38 @@ class _TableUsers:
         self.__conn.commit()
 
 
-    def check_credentials(self, uname, pword):
+    def del_users(self, unames):
+        # NOTE: Deleting a user who has orders would violate the foreign key
+        # on orders (uid), and fail the whole statement; so find (and skip)
+        # those users first.
+        unames = list(unames)
+        busy = set()
+        for chunk in _chunks(unames, _MAX_IN_PARAMS):
+            cursor = self.__conn.execute('''\
+                SELECT username FROM users
+                WHERE username IN (%s) AND EXISTS (
+                    SELECT 1 FROM orders WHERE orders.uid = users.uid);'''
+                % ', '.join('?' * len(chunk)), chunk)
+            busy.update(row[0] for row in cursor)
+
+        self.__conn.executemany('DELETE FROM users WHERE username = ?;',
+                                [(uname,) for uname in unames
+                                 if uname not in busy])
+        self.__conn.commit()
+        return [uname for uname in unames if uname in busy]
+
+
+    # Return (uid, password hash) for user "uname", or None.
+    def get_credentials(self, uname):
         cursor = self.__conn.execute(
-            'SELECT uid FROM users WHERE username = ? AND password = ?;',
-            (uname, pword))
-        row = cursor.fetchone()
-        return row[0] if row else None
+            'SELECT uid, password FROM users WHERE username = ?;', (uname,))
+        return cursor.fetchone()
+
+
+    def set_password(self, uid, phash):
+        self.__conn.execute('UPDATE users SET password = ? WHERE uid = ?;',
+                            (phash, uid))
+        self.__conn.commit()
 
 
     def user_data(self, uid):
@@ -278,27 +1515,14 @@ class _TableAdmins:
     '''Abstraction of the "admins" table.'''
     def __init__(self, conn):
         self.__conn = conn
-        self.__create_table()
-
-
-    def __create_table(self):
-        self.__conn.execute('''\
-            CREATE TABLE IF NOT EXISTS admins (
-                aid INTEGER PRIMARY KEY,
-                username TEXT NOT NULL UNIQUE,
-                password TEXT NOT NULL,
-                vid INTEGER NOT NULL,
-                FOREIGN KEY(vid) REFERENCES vendors(vid)
-            );''')
-        self.__conn.commit()
 
 
-    def add_admin(self, uname, pword, vid):
+    def add_admin(self, uname, phash, vid):
         if self.admin_exists(uname):
             raise RuntimeError("admin '%s' already exists" % uname)
         self.__conn.execute('''\
             INSERT INTO admins (username, password, vid)
-            VALUES (?, ?, ?);''', (uname, pword, vid))
+            VALUES (?, ?, ?);''', (uname, phash, vid))
         self.__conn.commit()
 
 
@@ -313,29 +1537,24 @@ class _TableAdmins:
         self.__conn.commit()
 
 
-    def check_credentials(self, uname, pword):
+    # Return (aid, vid, password hash) for admin "uname", or None.
+    def get_credentials(self, uname):
         cursor = self.__conn.execute(
-            'SELECT aid, vid FROM admins WHERE username = ? AND password = ?;',
-            (uname, pword))
-        row = cursor.fetchone()
-        return row if row else None
+            'SELECT aid, vid, password FROM admins WHERE username = ?;',
+            (uname,))
+        return cursor.fetchone()
+
+
+    def set_password(self, aid, phash):
+        self.__conn.execute('UPDATE admins SET password = ? WHERE aid = ?;',
+                            (phash, aid))
+        self.__conn.commit()
 
 
 class _TableVendors:
     '''Abstraction of the "vendors" table.'''
     def __init__(self, conn):
         self.__conn = conn
-        self.__create_table()
-
-
-    def __create_table(self):
-        self.__conn.execute('''\
-            CREATE TABLE IF NOT EXISTS vendors (
-                vid INTEGER PRIMARY KEY,
-                name TEXT NOT NULL UNIQUE,
-                address TEXT NOT NULL
-            );''')
-        self.__conn.commit()
 
 
     def get_vid(self, name):
@@ -363,14 +1582,24 @@ class _TableVendors:
         self.__conn.commit()
 
 
-    def list_vendors(self):
-        cursor = self.__conn.execute('SELECT * FROM vendors;')
+    def list_vendors(self, after, limit):
+        cursor = self.__conn.execute('''\
+            SELECT * FROM vendors WHERE vid > ?
+            ORDER BY vid LIMIT ?;''', (after, _sql_limit(limit)))
         return [row for row in cursor]
 
 
     def list_vendors_by_name(self, name):
-        cursor = self.__conn.execute(
-            'SELECT * FROM vendors WHERE name LIKE ?;', ('%' + name + '%',))
+        if len(name) < _FTS_MIN_CHARS:
+            cursor = self.__conn.execute(
+                'SELECT * FROM vendors WHERE name LIKE ?;', ('%' + name + '%',))
+        else:
+            # Best matches (as ranked by FTS5) come first.
+            cursor = self.__conn.execute('''\
+                SELECT vendors.* FROM vendors_fts
+                INNER JOIN vendors ON vendors.vid = vendors_fts.rowid
+                WHERE vendors_fts MATCH ?
+                ORDER BY vendors_fts.rank;''', (_fts_phrase(name),))
         return [row for row in cursor]
 
 
@@ -378,17 +1607,6 @@ class _TableItems:
     '''Abstraction of the "items" table.'''
     def __init__(self, conn):
         self.__conn = conn
-        self.__create_table()
-
-
-    def __create_table(self):
-        self.__conn.execute('''\
-            CREATE TABLE IF NOT EXISTS items (
-                iid INTEGER PRIMARY KEY,
-                name TEXT NOT NULL UNIQUE,
-                calories INTEGER DEFAULT 0
-            );''')
-        self.__conn.commit()
 
 
     def get_iid(self, name):
@@ -412,6 +1630,21 @@ class _TableItems:
         return self.get_iid(name)
 
 
+    def add_items(self, names):
+        names = list(set(names))
+        self.__conn.executemany(
+            'INSERT OR IGNORE INTO items (name) VALUES (?);',
+            [(name,) for name in names])
+        self.__conn.commit()
+        iids = {}
+        for chunk in _chunks(names, _MAX_IN_PARAMS):
+            cursor = self.__conn.execute(
+                'SELECT name, iid FROM items WHERE name IN (%s);'
+                % ', '.join('?' * len(chunk)), chunk)
+            iids.update(cursor)
+        return iids
+
+
     def item_exists(self, name):
         iid = self.get_iid(name)
         return iid is not None
@@ -426,20 +1659,6 @@ class _TableDishes:
     '''Abstraction of the "dishes" table.'''
     def __init__(self, conn):
         self.__conn = conn
-        self.__create_table()
-
-
-    def __create_table(self):
-        self.__conn.execute('''\
-            CREATE TABLE IF NOT EXISTS dishes (
-                did INTEGER PRIMARY KEY,
-                iid INTEGER NOT NULL,
-                vid INTEGER NOT NULL,
-                price REAL NOT NULL,
-                FOREIGN KEY(iid) REFERENCES items(iid),
-                FOREIGN KEY(vid) REFERENCES vendors(vid)
-            );''')
-        self.__conn.commit()
 
 
     def get_did(self, iid, vid):
@@ -457,6 +1676,21 @@ class _TableDishes:
         self.__conn.commit()
 
 
+    def add_dishes(self, dishes):
+        self.__conn.executemany('''\
+            INSERT INTO dishes (iid, vid, price)
+            VALUES (?, ?, ?);''', dishes)
+        self.__conn.commit()
+
+
+    def dish_ids(self):
+        cursor = self.__conn.execute('''\
+            SELECT items.name, vendors.name, did FROM dishes
+            INNER JOIN items ON items.iid = dishes.iid
+            INNER JOIN vendors ON vendors.vid = dishes.vid;''')
+        return {(item, vendor): did for item, vendor, did in cursor}
+
+
     def dish_exists(self, iid, vid):
         did = self.get_did(iid, vid)
         return did is not None
@@ -469,11 +1703,22 @@ class _TableDishes:
 
 
     def list_dishes_by_name(self, name):
-        cursor = self.__conn.execute('''\
-            SELECT did, items.name, vendors.name, price FROM dishes
-            INNER JOIN items ON items.iid = dishes.iid
-            INNER JOIN vendors ON vendors.vid = dishes.vid
-            WHERE items.name LIKE ?;''', ('%' + name + '%',))
+        if len(name) < _FTS_MIN_CHARS:
+            cursor = self.__conn.execute('''\
+                SELECT did, items.name, vendors.name, price FROM dishes
+                INNER JOIN items ON items.iid = dishes.iid
+                INNER JOIN vendors ON vendors.vid = dishes.vid
+                WHERE items.name LIKE ?;''', ('%' + name + '%',))
+        else:
+            # Best matching items (as ranked by FTS5) come first; the dishes
+            # for the same item are listed cheapest first.
+            cursor = self.__conn.execute('''\
+                SELECT did, items.name, vendors.name, price FROM items_fts
+                INNER JOIN items ON items.iid = items_fts.rowid
+                INNER JOIN dishes ON dishes.iid = items.iid
+                INNER JOIN vendors ON vendors.vid = dishes.vid
+                WHERE items_fts MATCH ?
+                ORDER BY items_fts.rank, price;''', (_fts_phrase(name),))
         return [row for row in cursor]
 
 
@@ -490,18 +1735,6 @@ class _TableOrders:
     '''Abstraction of the "orders" table.'''
     def __init__(self, conn):
         self.__conn = conn
-        self.__create_table()
-
-
-    def __create_table(self):
-        self.__conn.execute('''\
-            CREATE TABLE IF NOT EXISTS orders (
-                oid INTEGER PRIMARY KEY,
-                uid INTEGER NOT NULL,
-                timestamp INTEGER NOT NULL,
-                FOREIGN KEY(uid) REFERENCES users(uid)
-            );''')
-        self.__conn.commit()
 
 
     def get_oid(self, uid, ts):
@@ -515,11 +1748,18 @@ class _TableOrders:
         # reliable in production, like UUIDs, e.g.
 
 
+    def get_uid(self, oid):
+        cursor = self.__conn.execute(
+            'SELECT uid FROM orders WHERE oid = ?;', (oid,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+
     def add_order(self, uid, ts):
-        self.__conn.execute(
+        cursor = self.__conn.execute(
             'INSERT INTO orders (uid, timestamp) VALUES (?, ?);', (uid, ts))
         self.__conn.commit()
-        return self.get_oid(uid, ts)
+        return cursor.lastrowid
 
 
     def del_order(self, oid):
@@ -531,26 +1771,20 @@ class _TableOrderDishes:
     '''Abstraction of the "orderdishes" table.'''
     def __init__(self, conn):
         self.__conn = conn
-        self.__create_table()
 
 
-    def __create_table(self):
+    def add_order_dish(self, oid, did, qty):
         self.__conn.execute('''\
-            CREATE TABLE IF NOT EXISTS orderdishes (
-                oid INTEGER NOT NULL,
-                did INTEGER NOT NULL,
-                quantity INTEGER NOT NULL,
-                cancelled INTEGER DEFAULT 0,
-                FOREIGN KEY(oid) REFERENCES orders(oid),
-                FOREIGN KEY(did) REFERENCES dishes(did)
-            );''')
+            INSERT INTO orderdishes (oid, did, quantity)
+            VALUES (?, ?, ?);''', (oid, did, qty))
         self.__conn.commit()
 
 
-    def add_order_dish(self, oid, did, qty):
-        self.__conn.execute('''\
+    # Add all the "dishes" (did, qty pairs) of order "oid".
+    def add_order_dishes(self, oid, dishes):
+        self.__conn.executemany('''\
             INSERT INTO orderdishes (oid, did, quantity)
-            VALUES (?, ?, ?);''', (oid, did, qty))
+            VALUES (?, ?, ?);''', [(oid, did, qty) for did, qty in dishes])
         self.__conn.commit()
 
 
@@ -566,7 +1800,13 @@ class _TableOrderDishes:
         self.__conn.commit()
 
 
-    def list_order_by_uid(self, uid):
+    # NOTE: The order listings are paged by orders (not by dishes), so that
+    # an order is never split across pages.  The subqueries pick the IDs of
+    # the orders in the page; only orders with dishes count, as the others
+    # have no rows, and a short page would be taken for the last one (see
+    # paged_result() in storeapi.py).  These return the cursor itself, so
+    # that callers can stream the rows.
+    def list_order_by_uid(self, uid, after, limit):
         cursor = self.__conn.execute('''\
             SELECT
                 orderdishes.oid, orders.timestamp, items.name,
@@ -576,12 +1816,17 @@ class _TableOrderDishes:
             INNER JOIN orders ON orders.oid = orderdishes.oid
             INNER JOIN items ON items.iid = dishes.iid
             INNER JOIN vendors ON vendors.vid = dishes.vid
-            WHERE orders.uid = ?
-            ORDER BY orderdishes.oid ASC;''', (uid,))
-        return [row for row in cursor]
+            WHERE orders.oid IN (
+                SELECT oid FROM orders
+                WHERE uid = ? AND oid > ? AND EXISTS (
+                    SELECT 1 FROM orderdishes
+                    WHERE orderdishes.oid = orders.oid)
+                ORDER BY oid LIMIT ?)
+            ORDER BY orderdishes.oid ASC;''', (uid, after, _sql_limit(limit)))
+        return cursor
 
 
-    def list_order_by_vid(self, vid):
+    def list_order_by_vid(self, vid, after, limit):
         cursor = self.__conn.execute('''\
             SELECT
                 orderdishes.oid, orders.timestamp,
@@ -591,6 +1836,55 @@ class _TableOrderDishes:
             INNER JOIN orders ON orders.oid = orderdishes.oid
             INNER JOIN items ON items.iid = dishes.iid
             INNER JOIN users ON users.uid = orders.uid
-            WHERE dishes.vid = ?
-            ORDER BY orderdishes.oid ASC;''', (vid,))
-        return [row for row in cursor]
+            WHERE dishes.vid = ? AND orderdishes.oid IN (
+                SELECT DISTINCT orderdishes.oid FROM orderdishes
+                INNER JOIN dishes ON dishes.did = orderdishes.did
+                WHERE dishes.vid = ? AND orderdishes.oid > ?
+                ORDER BY orderdishes.oid LIMIT ?)
+            ORDER BY orderdishes.oid ASC;''',
+            (vid, vid, after, _sql_limit(limit)))
+        return cursor
+
+
+    def list_order_by_uid_between(self, uid, start, end, after, limit):
+        cursor = self.__conn.execute('''\
+            SELECT
+                orderdishes.oid, orders.timestamp, items.name,
+                vendors.name, dishes.price, orderdishes.quantity
+            FROM orderdishes
+            INNER JOIN dishes ON dishes.did = orderdishes.did
+            INNER JOIN orders ON orders.oid = orderdishes.oid
+            INNER JOIN items ON items.iid = dishes.iid
+            INNER JOIN vendors ON vendors.vid = dishes.vid
+            WHERE orders.oid IN (
+                SELECT oid FROM orders
+                WHERE uid = ? AND timestamp >= ? AND timestamp < ?
+                    AND oid > ? AND EXISTS (
+                        SELECT 1 FROM orderdishes
+                        WHERE orderdishes.oid = orders.oid)
+                ORDER BY oid LIMIT ?)
+            ORDER BY orderdishes.oid ASC;''',
+            (uid, start, end, after, _sql_limit(limit)))
+        return cursor
+
+
+    # The vendor's orders in the range come from "vendororders", which has
+    # them by vendor and time; then their dishes (from the vendor) are read.
+    def list_order_by_vid_between(self, vid, start, end, after, limit):
+        cursor = self.__conn.execute('''\
+            SELECT
+                orderdishes.oid, orders.timestamp,
+                users.fullname, items.name, orderdishes.quantity
+            FROM orderdishes
+            INNER JOIN dishes ON dishes.did = orderdishes.did
+            INNER JOIN orders ON orders.oid = orderdishes.oid
+            INNER JOIN items ON items.iid = dishes.iid
+            INNER JOIN users ON users.uid = orders.uid
+            WHERE dishes.vid = ? AND orderdishes.oid IN (
+                SELECT oid FROM vendororders
+                WHERE vid = ? AND timestamp >= ? AND timestamp < ?
+                    AND oid > ?
+                ORDER BY oid LIMIT ?)
+            ORDER BY orderdishes.oid ASC;''',
+            (vid, vid, start, end, after, _sql_limit(limit)))
+        return cursor
@@ -2,7 +2,12 @@
 
 import os
 import requests
+import requests.adapters
 import sys
+import time
+import urllib3.util.request
+
+import recodec
 
 # --- Variables. ---
 
@@ -10,15 +15,165 @@ import sys
 # TODO: This should really be coming from a config file.
 apiurl = 'http://localhost:5000/'
 
-# Symbolic constant for HTTP OK status code.
+# Symbolic constants for HTTP status codes.
 HTTP_OK = 200
+HTTP_NOT_MODIFIED = 304
+
+# Timeouts (in seconds) for connecting to the server, and for reading its
+# response, for each API call.
+connect_timeout = 3.05
+read_timeout = 30
+
+# How many times we retry a failed call (to an idempotent endpoint), and the
+# delay before the first retry; it doubles with each retry.
+max_retries = 3
+retry_backoff = 0.25
+
+
+# --- Classes. ---
+
+class APIClient:
+    '''
+    A client for the RestEasy web API.
+
+    All calls go through one requests.Session, so the TCP connections to the
+    server are pooled and kept alive across calls.  Calls to endpoints that
+    only read data are retried, with exponential backoff, if they fail due to
+    network errors or "server unavailable" type statuses.  Calls that change
+    data are never retried, since they may have gone through already.
+    '''
+
+    # Endpoints that can safely be called more than once for one request.
+    IDEMPOTENT = frozenset([
+        'ping', 'get-uid', 'user-exists', 'user-data',
+        'list-vendors', 'list-vendors-by-name',
+        'list-dishes-by-vendor', 'list-dishes-by-name',
+        'list-order-by-uid', 'list-order-by-vid',
+        'list-order-docs-by-uid', 'list-order-docs-by-vid',
+        'list-order-by-uid-between', 'list-order-by-vid-between',
+    ])
+
+    # Statuses worth retrying: the server (or a proxy in front of it) is
+    # temporarily unable to handle the call.
+    RETRY_STATUSES = frozenset([502, 503, 504])
+
+    def __init__(self, baseurl, timeout=(connect_timeout, read_timeout),
+                 retries=max_retries, backoff=retry_backoff, poolsize=10):
+        self.__baseurl = baseurl
+        self.__timeout = timeout
+        self.__retries = retries
+        self.__backoff = backoff
+        self.__session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=poolsize)
+        self.__session.mount('http://', adapter)
+        self.__session.mount('https://', adapter)
+        # Ask for the encoding we decode fastest; see decode().
+        self.__session.headers['Accept'] = recodec.ACCEPT
+        # And for the response to be compressed, with any of the codings the
+        # HTTP library can decode (gzip, plus br and zstd when their modules
+        # are installed); it decodes the responses for us.
+        self.__session.headers['Accept-Encoding'] = \
+            urllib3.util.request.ACCEPT_ENCODING
+        # The last response (carrying an ETag) we got for each distinct call.
+        # We send its ETag along with the next identical call; if the data did
+        # not change, the server answers "304 Not Modified" and we reuse the
+        # response.
+        self.__tagged = {}
+
+
+    def get(self, endpoint, params={}):
+        '''Call the given API `endpoint' with query parameters `params'.'''
+        key = (endpoint, tuple(sorted(params.items())))
+        cached = self.__tagged.get(key)
+        headers = {'If-None-Match': cached.headers['ETag']} if cached else {}
+        resp = self.__send('GET', endpoint, endpoint in self.IDEMPOTENT,
+                           params=params, headers=headers)
+        if resp.status_code == HTTP_NOT_MODIFIED and cached:
+            return cached
+        if resp.status_code == HTTP_OK and 'ETag' in resp.headers:
+            self.__tagged[key] = resp
+        return resp
+
+
+    def post(self, endpoint, data):
+        '''POST `data' (JSON-encoded) to the given API `endpoint'.'''
+        return self.__send('POST', endpoint, False, json=data)
+
+
+    def set_token(self, token):
+        '''Send the session `token' (as returned by a login call) with all
+        later calls; or, if it's None, stop sending one.'''
+        if token is None:
+            self.__session.headers.pop('Authorization', None)
+        else:
+            self.__session.headers['Authorization'] = 'Bearer %s' % token
+
+
+    def __send(self, method, endpoint, retry, **kwargs):
+        url = self.__baseurl + endpoint
+        attempts = 1 + (self.__retries if retry else 0)
+        for attempt in range(attempts):
+            last = attempt == attempts - 1
+            try:
+                resp = self.__session.request(method, url,
+                                              timeout=self.__timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if last:
+                    raise
+            else:
+                if last or resp.status_code not in self.RETRY_STATUSES:
+                    return resp
+            time.sleep(self.__backoff * 2 ** attempt)
+
+
+    def close(self):
+        '''Close all the pooled connections.'''
+        self.__session.close()
+
+
+# The client shared by all the functions below.
+client = APIClient(apiurl)
 
 
 # --- Functions. ---
 
 def call_api(endpoint, params={}):
     '''Call the given API `endpoint' with query parameters `params'.'''
-    return requests.get(apiurl + endpoint, params)
+    return client.get(endpoint, params)
+
+
+def iter_pages(endpoint, params={}, limit=100):
+    '''Call the given (paged) API `endpoint' with query parameters `params',
+    fetching `limit' entries per call.  Yield the rows from the pages, one by
+    one; the next page is fetched only when the current one is used up.
+    Raise RuntimeError if a call fails.'''
+    params = dict(params, limit=limit)
+    while True:
+        resp = call_api(endpoint, params)
+        if resp.status_code != HTTP_OK:
+            raise RuntimeError('call to "%s" failed with status %d'
+                               % (endpoint, resp.status_code))
+        page = decode(resp)
+        yield from page['rows']
+        if page['next'] is None:
+            return
+        params['after'] = page['next']
+
+
+def decode(resp):
+    '''Return the data in the body of `resp' (the response to an API call),
+    in whichever encoding the server sent it.'''
+    return recodec.decode(resp.content, resp.headers.get('Content-Type'))
+
+
+def post_api(endpoint, data):
+    '''POST `data' (JSON-encoded) to the given API `endpoint'.'''
+    return client.post(endpoint, data)
+
+
+def set_session_token(token):
+    '''Authenticate all later API calls with the session `token'.'''
+    client.set_token(token)
 
 
 def error_exit(msg):
@@ -33,7 +188,7 @@ def check_tty():
 
 def ping_server():
     try:
-        resp = requests.get(apiurl + 'ping')
+        resp = call_api('ping')
     except Exception:
         error_exit('cannot contact server; exiting')
 
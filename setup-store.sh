@@ -7,5 +7,4 @@ dbfile="restore.db"
 set -x
 rm -f $dbfile
 ./process-users.py -c config.ini -i users.csv
-./process-vendor.py -c config.ini -i vendor1.txt
-./process-vendor.py -c config.ini -i vendor2.txt
+./process-vendor.py -b -c config.ini -i vendor1.txt vendor2.txt
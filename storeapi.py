@@ -1,18 +1,78 @@
-from flask import Flask, abort, jsonify, request
+import base64
+import binascii
+import configparser
+import functools
+import hmac
+import itertools
+import json
+import os
+import sqlite3
+import time
+
+from flask import (
+    Flask,
+    Response,
+    abort,
+    g,
+    jsonify,
+    make_response,
+    request,
+    stream_with_context
+)
+from werkzeug.wsgi import ClosingIterator
 
 # Our data layer.
 from restore import REStore
+import recodec
+import recompress
+import remetrics
+import reprofile
+import resession
 
 app = Flask(__name__)
-store = REStore('config.ini')
+# NOTE: The config file can be overridden (e.g. to use a scratch DB for
+# testing) through the environment.
+CONFIG_FILE = os.environ.get('RESTEASY_CONFIG', 'config.ini')
+store = REStore(CONFIG_FILE)
+
+config = configparser.ConfigParser()
+config.read(CONFIG_FILE)
+# The login sessions of users and admins.
+sessions = resession.SessionCache(config['DEFAULT'].getint('sessionttl', 1800),
+                                  config['DEFAULT'].getint('maxsessions',
+                                                           100000))
+# Compression of the responses.
+compressor = recompress.Compressor(
+    config['DEFAULT'].getint('compressminsize', 1024),
+    config['DEFAULT'].getint('compresscachesize', 256))
+
+# Max number of entries (vendors, or orders) we return in one page.
+MAX_PAGE_SIZE = 1000
+
+# Number of rows we serialize into each chunk of a streamed response.
+STREAM_CHUNK_ROWS = 100
+
+# Streamed responses can also be sent as NDJSON (see stream_rows()), besides
+# the encodings in recodec.
+NDJSON_MIMETYPE = 'application/x-ndjson'
+STREAM_MIMETYPES = recodec.MIMETYPES + [NDJSON_MIMETYPE]
+
+# Token that must be sent (in an "X-Debug-Token" header) to use the /debug/*
+# endpoints.  If it is not set, those endpoints are disabled.
+DEBUG_TOKEN = os.environ.get('RESTEASY_DEBUG_TOKEN')
+
+# Limits on the size of a profiling session (see /debug/profile).
+MAX_PROFILE_REQUESTS = 10000
+MAX_PROFILE_SECONDS = 600
 
 
 # --- Helper functions to reduce boilerplate. ---
-def get_qparams_or_abort(*qpnames):
+def get_qparams_or_abort(*qpnames, optional=()):
     '''Return the values of the named query parameters as a tuple, if present.
-    Abort otherwise.'''
+    Abort otherwise.  The values of the "optional" parameters follow, with
+    None for those that are absent.'''
     for arg in request.args:
-        if arg not in qpnames:
+        if arg not in qpnames and arg not in optional:
             abort(400, "unexpected parameter '%s'" % arg)
 
     qpvals = []
@@ -21,16 +81,237 @@ def get_qparams_or_abort(*qpnames):
         if qpval is None:
             abort(400, "missing parameter '%s'" % qpname)
         qpvals.append(qpval)
+    for qpname in optional:
+        qpvals.append(request.args.get(qpname))
 
     return qpvals
 
 
+# Listings that can be long are paged using keyset pagination: the client asks
+# for a page of at most "limit" entries, and gets back the entries along with
+# an opaque "next" cursor, which it passes as "after" to get the next page.
+# The cursor encodes the key (ID) of the last entry in the page.
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError):
+        key = None
+    if not isinstance(key, int):
+        abort(400, 'invalid cursor')
+    return key
+
+
+def get_page_or_abort(after, limit):
+    '''Convert the "after" and "limit" (paging) query parameters into the
+    key to start after and the page size.  Abort if they are invalid.'''
+    after = decode_cursor(after) if after is not None else 0
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            abort(400, "parameter 'limit' must be an integer")
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            abort(400, "parameter 'limit' must be between 1 and %d"
+                  % MAX_PAGE_SIZE)
+    return after, limit
+
+
+def get_time_range_or_abort(start, end):
+    '''Convert the "from" and "to" query parameters (times in seconds since
+    the epoch) into the integer range [start, end).  Abort if they are
+    invalid.'''
+    try:
+        start, end = int(start), int(end)
+    except ValueError:
+        abort(400, "parameters 'from' and 'to' must be integers")
+    if start > end:
+        abort(400, "parameter 'from' must not be after 'to'")
+    return start, end
+
+
+# Responses are sent in the encoding the client prefers, out of those in
+# recodec: plain JSON (as by jsonify()) unless it asks for another.
+def response_mimetype(offers=recodec.MIMETYPES):
+    '''Return the mimetype (out of "offers") to encode the response in, as
+    per the "Accept" header of the request.'''
+    return request.accept_mimetypes.best_match(offers, offers[0])
+
+
+def encode(val):
+    '''Return a response with the value "val", encoded as the client prefers
+    (see response_mimetype()).'''
+    mimetype = response_mimetype()
+    if mimetype == recodec.JSON_MIMETYPE:
+        return jsonify(val)
+    return Response(recodec.encode(val, mimetype), mimetype=mimetype)
+
+
+def paged_result(rows, limit):
+    '''Return "rows" (encoded).  If a page "limit" was given, return them
+    as {"rows": rows, "next": cursor}, where cursor is null on the last page.
+    The key of each row is its first column; several consecutive rows may share
+    a key (e.g. the dishes of one order), and count as one entry.'''
+    if limit is None:
+        return encode(rows)
+    more = len({row[0] for row in rows}) >= limit
+    return encode({'rows': rows,
+                   'next': encode_cursor(rows[-1][0]) if more else None})
+
+
+def stream_mimetype():
+    '''Return the mimetype to stream a listing in (see stream_rows()).  The
+    other encodings (see recodec) cannot be streamed: the rows would all have
+    to be read (and kept in memory) first.  So JSON or NDJSON is picked
+    whenever the client accepts either, even if it prefers another encoding;
+    the other encodings are used only for clients that accept nothing else.'''
+    return (request.accept_mimetypes.best_match(
+        [recodec.JSON_MIMETYPE, NDJSON_MIMETYPE])
+            or response_mimetype(STREAM_MIMETYPES))
+
+
+def stream_rows(rows):
+    '''Return a response that streams "rows" (any iterable of rows) as a
+    JSON array, serializing them chunk by chunk as they are sent.  If the
+    client prefers NDJSON (via "Accept: application/x-ndjson"), send one JSON
+    document (row) per line instead.  (See stream_mimetype().)'''
+    mimetype = stream_mimetype()
+    if mimetype not in (recodec.JSON_MIMETYPE, NDJSON_MIMETYPE):
+        return encode(list(rows))
+    ndjson = mimetype == NDJSON_MIMETYPE
+
+    def generate():
+        it = iter(rows)
+        if not ndjson:
+            yield '['
+        sep = ''
+        while True:
+            chunk = list(itertools.islice(it, STREAM_CHUNK_ROWS))
+            if not chunk:
+                break
+            docs = [json.dumps(row, separators=(',', ':')) for row in chunk]
+            if ndjson:
+                yield '\n'.join(docs) + '\n'
+            else:
+                yield sep + ','.join(docs)
+                sep = ','
+        if not ndjson:
+            yield ']\n'
+
+    # NOTE: stream_with_context() keeps the request (and so our DB connection,
+    # see release_store()) alive until the whole response has been sent.
+    return Response(stream_with_context(generate()),
+                    mimetype=NDJSON_MIMETYPE if ndjson
+                             else recodec.JSON_MIMETYPE)
+
+
 def check_result(val, badval, msg, stcode=400):
-    '''Return the value "val" (jsonified), if it does not equal "badval".
+    '''Return the value "val" (encoded), if it does not equal "badval".
     Abort otherwise.'''
     if val == badval:
         abort(stcode, msg)
-    return jsonify(val)
+    return encode(val)
+
+
+def catalog_etag(view):
+    '''Decorator for views that only read the catalog (vendors, items and
+    dishes).  Tag their responses with an ETag derived from the catalog
+    version, and answer "304 Not Modified" if the client already has the
+    current version.  The ETags are weak, so that they match whether or not
+    the response was compressed (see compress_response()).'''
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        version = store.catalog_version()
+        # The view encodes its response as negotiated by response_mimetype(),
+        # or by stream_mimetype() if it streams it.  When both give the same,
+        # we know the tag without running the view.
+        mimetypes = {response_mimetype(), stream_mimetype()}
+        etag = catalog_tag(version, mimetypes.pop())
+        if len(mimetypes) == 0 and request.if_none_match.contains_weak(etag):
+            resp = Response(status=304)
+        else:
+            resp = make_response(view(*args, **kwargs))
+            # Tag it as it was actually encoded.
+            etag = catalog_tag(version, resp.mimetype)
+            if request.if_none_match.contains_weak(etag):
+                resp.close()
+                resp = Response(status=304)
+        resp.set_etag(etag, weak=True)
+        # Clients may keep the response, but must revalidate it before use.
+        resp.headers['Cache-Control'] = 'no-cache'
+        return resp
+    return wrapper
+
+
+def catalog_tag(version, mimetype):
+    '''Return the ETag for the catalog "version" encoded as "mimetype": the
+    same data in another encoding is another representation, with a tag of
+    its own.'''
+    etag = 'catalog-%d' % version
+    if mimetype != recodec.JSON_MIMETYPE:
+        etag += '-' + recodec.NAMES.get(mimetype, 'ndjson')
+    return etag
+
+
+def session_token():
+    '''Return the session token sent with the request, or None.'''
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    return token.strip() if scheme.lower() == 'bearer' else None
+
+
+def require_session(kind):
+    '''Decorator for views that need a logged in user (if "kind" is "user")
+    or admin (if it's "admin").  The client must send the token it got when it
+    logged in, as "Authorization: Bearer TOKEN".  The data of the session is
+    available to the view as "g.session".'''
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            token = session_token()
+            session = sessions.get(token) if token else None
+            if session is None or session['kind'] != kind:
+                abort(401, 'not logged in (as %s)' % kind)
+            g.session = session
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def check_owner(key, val):
+    '''Abort (with 403) unless the "key" of the caller's session (e.g. its
+    "uid") is "val", i.e. unless the caller is acting on their own data.'''
+    if str(g.session[key]) != str(val):
+        abort(403, "not allowed for this '%s'" % key)
+
+
+def require_debug_token(view):
+    '''Decorator for the debug views: let only those who send the right
+    debug token use them.  (They are "not found" if no token is set.)'''
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not DEBUG_TOKEN:
+            abort(404)
+        token = request.headers.get('X-Debug-Token', '')
+        if not hmac.compare_digest(token.encode(), DEBUG_TOKEN.encode()):
+            abort(403, 'invalid debug token')
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def get_int_or_abort(name, default, low, high):
+    '''Return the value of the integer query parameter "name" (or
+    "default"), if it's between "low" and "high".  Abort otherwise.'''
+    try:
+        val = int(request.args.get(name, default))
+    except ValueError:
+        abort(400, "parameter '%s' must be an integer" % name)
+    if not low <= val <= high:
+        abort(400, "parameter '%s' must be between %d and %d"
+              % (name, low, high))
+    return val
 
 
 def check_exception(func, *params):
@@ -39,13 +320,299 @@ def check_exception(func, *params):
     except Exception as e:
         abort(400, e)
     else:
-        return jsonify('OK')
+        return encode('OK')
+
+
+# Each request is served by a thread of its own; hand the DB connection it used
+# back to the store's pool once the request is done.
+@app.teardown_request
+def release_store(exc):
+    store.release()
+
+
+# Our responses depend on the encodings the client accepts (see encode());
+# let caches know.
+@app.after_request
+def vary_on_accept(resp):
+    resp.vary.add('Accept')
+    return resp
+
+
+# Compress the response, if the client accepts one of the codings we have
+# (see recompress).  The compressed bodies of tagged responses are cached,
+# keyed on the URL, the mimetype and the ETag.
+# NOTE: We change the response in place, rather than return a new one, so as
+# to keep what the other hooks have set to run when it is closed (see
+# finish_request_metrics()).  A streamed body is compressed as it is sent;
+# closing the response closes the original body too, which ends the request
+# (see stream_rows()).
+@app.after_request
+def compress_response(resp):
+    resp.vary.add('Accept-Encoding')
+    coding = request.accept_encodings.best_match(compressor.codings())
+    if (coding is None or resp.status_code != 200 or resp.direct_passthrough
+            or 'Content-Encoding' in resp.headers):
+        return resp
+    etag, weak = resp.get_etag()
+    if resp.is_streamed:
+        body = resp.response
+        resp.response = ClosingIterator(
+            compressor.stream(resp.iter_encoded(), coding),
+            [body.close] if hasattr(body, 'close') else [])
+        resp.headers.pop('Content-Length', None)
+    else:
+        data = resp.get_data()
+        if not compressor.wants(len(data)):
+            return resp
+        # NOTE: The tag names the representation, but its mimetype goes into
+        # the key all the same, so that another body can never be sent in
+        # place of this one.
+        key = (request.full_path, resp.mimetype, etag) if etag else None
+        resp.set_data(compressor.compress(data, coding, key))
+    resp.headers['Content-Encoding'] = coding
+    if etag and not weak:
+        # The compressed body is not byte-for-byte the same as the original.
+        resp.set_etag(etag, weak=True)
+    return resp
+
+
+# --- Metrics, published at /metrics (for Prometheus). ---
+metrics = remetrics.Registry()
+http_requests = metrics.counter(
+    'resteasy_http_requests_total',
+    'Requests served, by route, method and status.',
+    ('route', 'method', 'status'))
+http_in_flight = metrics.gauge(
+    'resteasy_http_requests_in_flight',
+    'Requests being served right now.')
+http_latency = metrics.histogram(
+    'resteasy_http_request_duration_seconds',
+    'Time taken to serve requests, including streaming the response, '
+    'by route and method.',
+    ('route', 'method'))
+
+
+@app.before_request
+def start_request_metrics():
+    g.started = time.perf_counter()
+    http_in_flight.inc()
+
+
+# NOTE: This runs for failed requests as well (with the error response).  We
+# record the request only when the response is closed, i.e. after all of it
+# has been sent, which for streamed responses (see stream_rows()) may be well
+# after the view returned.
+@app.after_request
+def finish_request_metrics(resp):
+    if 'started' not in g:
+        return resp
+    # Label requests by their route (not their URL), so that the number of
+    # label values stays bounded.
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    method, status, started = request.method, str(resp.status_code), g.started
+
+    def record():
+        http_in_flight.dec()
+        http_requests.inc(route, method, status)
+        http_latency.observe(time.perf_counter() - started, route, method)
+
+    resp.call_on_close(record)
+    return resp
+
+
+@metrics.collector
+def session_metrics():
+    stats = sessions.stats()
+    lines = remetrics.render_family(
+        'resteasy_session_lookups_total', 'counter',
+        'Session token lookups, by result.',
+        [([('result', 'hit')], stats['hits']),
+         ([('result', 'miss')], stats['misses'])])
+    for key, kind, helptext in [
+            ('created', 'counter', 'Sessions created (by logging in).'),
+            ('expirations', 'counter', 'Sessions expired (unused too long).'),
+            ('evictions', 'counter', 'Sessions evicted to make room.'),
+            ('size', 'gauge', 'Sessions active.')]:
+        name = 'resteasy_sessions_%s' % key
+        if kind == 'counter':
+            name += '_total'
+        lines += remetrics.render_family(name, kind, helptext,
+                                         [([], stats[key])])
+    return lines
+
+
+@metrics.collector
+def compression_metrics():
+    stats = compressor.stats()
+    codings = sorted(stats['codings'].items())
+    lines = remetrics.render_family(
+        'resteasy_compressed_responses_total', 'counter',
+        'Responses compressed, by coding.',
+        [([('coding', coding)], counts['responses'])
+         for coding, counts in codings])
+    lines += remetrics.render_family(
+        'resteasy_compression_bytes_total', 'counter',
+        'Bytes of the compressed responses, by coding, before ("in") and '
+        'after ("out") compression.',
+        [([('coding', coding), ('stage', stage)], counts['bytes_' + stage])
+         for coding, counts in codings for stage in ('in', 'out')])
+    lines += remetrics.render_family(
+        'resteasy_compression_cache_lookups_total', 'counter',
+        'Lookups of compressed bodies in the cache, by result.',
+        [([('result', 'hit')], stats['hits']),
+         ([('result', 'miss')], stats['misses'])])
+    lines += remetrics.render_family(
+        'resteasy_compression_cache_evictions_total', 'counter',
+        'Compressed bodies evicted from the cache to make room.',
+        [([], stats['evictions'])])
+    lines += remetrics.render_family(
+        'resteasy_compression_cache_size', 'gauge',
+        'Compressed bodies in the cache.',
+        [([], stats['size'])])
+    return lines
+
+
+# --- Profiling, controlled through /debug/profile. ---
+profiler = reprofile.RequestProfiler()
+
+
+@app.before_request
+def start_profiling():
+    if request.path.startswith('/debug/'):
+        return
+    profile = profiler.begin_request()
+    if profile is not None:
+        g.profile = profile
+
+
+# NOTE: As with the metrics, the profile covers the whole response, including
+# the streaming of it.
+@app.after_request
+def finish_profiling(resp):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        resp.call_on_close(functools.partial(profiler.end_request, profile))
+    return resp
+
+
+@metrics.collector
+def store_metrics():
+    '''Return the metrics for the store: its result cache, the time spent in
+    its methods (and in the DB queries they ran), and its SQL statements.'''
+    cache = store.cache_stats()
+    lookups = cache['hits'] + cache['misses']
+    lines = remetrics.render_family(
+        'resteasy_store_cache_lookups_total', 'counter',
+        'Result cache lookups, by result.',
+        [([('result', 'hit')], cache['hits']),
+         ([('result', 'miss')], cache['misses'])])
+    lines += remetrics.render_family(
+        'resteasy_store_cache_hit_ratio', 'gauge',
+        'Fraction of the result cache lookups so far that were hits.',
+        [([], cache['hits'] / lookups if lookups else 0)])
+    for key, kind, helptext in [
+            ('evictions', 'counter', 'Results evicted from the cache.'),
+            ('invalidations', 'counter', 'Results invalidated by writes.'),
+            ('size', 'gauge', 'Results in the cache.'),
+            ('maxsize', 'gauge', 'Max number of results in the cache.')]:
+        name = 'resteasy_store_cache_%s' % key
+        if kind == 'counter':
+            name += '_total'
+        lines += remetrics.render_family(name, kind, helptext,
+                                         [([], cache[key])])
+
+    stats = store.query_stats()
+    methods = sorted(stats['methods'].items())
+    for key, name, helptext in [
+            ('calls', 'resteasy_store_method_calls_total',
+             'Calls to the store, by method.'),
+            ('time', 'resteasy_store_method_seconds_total',
+             'Time spent in the store, by method.'),
+            ('queries', 'resteasy_store_method_queries_total',
+             'DB queries run by the store, by method.'),
+            ('query_time', 'resteasy_store_method_query_seconds_total',
+             'Time spent on DB queries, by store method.')]:
+        lines += remetrics.render_family(
+            name, 'counter', helptext,
+            [([('method', method)], counts[key])
+             for method, counts in methods])
+    statements = stats['statements'].values()
+    for key, name, helptext in [
+            ('calls', 'resteasy_db_queries_total', 'DB queries run.'),
+            ('time', 'resteasy_db_query_seconds_total',
+             'Time spent on DB queries.'),
+            ('rows', 'resteasy_db_query_rows_total',
+             'Rows returned (or changed) by DB queries.'),
+            ('slow', 'resteasy_db_slow_queries_total',
+             'DB queries slower than the slow query threshold.')]:
+        lines += remetrics.render_family(
+            name, 'counter', helptext,
+            [([], sum(counts[key] for counts in statements))])
+    return lines
 
 
 # --- General endpoints. ---
 @app.route('/ping')
 def ping():
-    return jsonify('OK')
+    return encode('OK')
+
+
+@app.route('/metrics')
+def get_metrics():
+    return Response(metrics.render(), content_type=remetrics.CONTENT_TYPE)
+
+
+# --- Debugging endpoints. ---
+@app.route('/debug/profile', methods=['POST'])
+@require_debug_token
+def start_profile():
+    '''Start profiling the next "requests" requests, or those that start in
+    the next "seconds" seconds, whichever limit is hit first.'''
+    get_qparams_or_abort(optional=('requests', 'seconds'))
+    nrequests = get_int_or_abort('requests', 100, 1, MAX_PROFILE_REQUESTS)
+    seconds = get_int_or_abort('seconds', 60, 1, MAX_PROFILE_SECONDS)
+    if not profiler.start(nrequests, seconds):
+        abort(409, 'a profiling session is already in progress')
+    return encode(profiler.status())
+
+
+@app.route('/debug/profile', methods=['DELETE'])
+@require_debug_token
+def stop_profile():
+    '''Stop profiling any more requests.'''
+    profiler.stop()
+    return encode(profiler.status())
+
+
+@app.route('/debug/profile', methods=['GET'])
+@require_debug_token
+def get_profile():
+    '''Return the status of the profiling session while it's in progress
+    (with status 202).  Once it's done, return its results: as a pstats file
+    by default, or as a text report if "format" is "text" (with the top
+    "limit" functions, ordered by "sort").'''
+    fmt, sort, _ = get_qparams_or_abort(optional=('format', 'sort', 'limit'))
+    status = profiler.status()
+    if status['in_progress']:
+        return encode(status), 202
+    if fmt == 'text':
+        limit = get_int_or_abort('limit', 50, 1, 10000)
+        if sort not in (None, 'cumulative', 'tottime', 'calls', 'name'):
+            abort(400, "parameter 'sort' must be one of cumulative, "
+                       "tottime, calls, name")
+        report = profiler.report(sort or 'cumulative', limit)
+        if report is None:
+            abort(404, 'no requests were profiled')
+        return Response(report, mimetype='text/plain')
+    if fmt not in (None, 'pstats'):
+        abort(400, "parameter 'format' must be pstats or text")
+    result = profiler.result()
+    if result is None:
+        abort(404, 'no requests were profiled')
+    filename = 'resteasy-%d.pstats' % status['started']
+    return Response(result, mimetype='application/octet-stream',
+                    headers={'Content-Disposition':
+                             'attachment; filename="%s"' % filename})
 
 
 # --- API around users. ---
@@ -59,7 +626,7 @@ def get_uid():
 @app.route('/user-exists')
 def user_exists():
     uname, = get_qparams_or_abort('username')
-    return jsonify(store.user_exists(uname))
+    return encode(store.user_exists(uname))
 
 
 @app.route('/add-user')
@@ -69,94 +636,250 @@ def add_user():
 
 
 @app.route('/del-user')
+@require_session('user')
 def del_user():
-    params = get_qparams_or_abort('username')
-    return check_exception(store.del_user, *params)
+    uname, = get_qparams_or_abort('username')
+    check_owner('username', uname)
+    resp = check_exception(store.del_user, uname)
+    sessions.delete(session_token())
+    return resp
 
 
 @app.route('/login-user')
 def login_user():
-    params = get_qparams_or_abort('username', 'password')
-    return check_result(store.check_user_credentials(*params), None,
-                        "incorrect username and/or password", 401)
+    '''Log a user in.  Return their user ID, and the token for the new
+    session, as {"uid": UID, "token": TOKEN}.'''
+    uname, pword = get_qparams_or_abort('username', 'password')
+    uid = store.check_user_credentials(uname, pword)
+    if uid is None:
+        abort(401, "incorrect username and/or password")
+    token = sessions.create({'kind': 'user', 'uid': uid, 'username': uname})
+    return encode({'uid': uid, 'token': token})
+
+
+@app.route('/logout', methods=['POST'])
+def logout():
+    '''End the caller's session (if any).'''
+    token = session_token()
+    if token:
+        sessions.delete(token)
+    return encode('OK')
 
 
 @app.route('/user-data')
+@require_session('user')
 def get_user_data():
-    params = get_qparams_or_abort('uid')
-    return check_result(store.user_data(*params), None, 'invalid user ID', 400)
+    uid, = get_qparams_or_abort('uid')
+    check_owner('uid', uid)
+    return check_result(store.user_data(uid), None, 'invalid user ID', 400)
 
 
 # --- API around admins. ---
+# NOTE: Admins can add other admins for their own vendor only.
 @app.route('/add-admin')
+@require_session('admin')
 def add_admin():
     params = get_qparams_or_abort('username', 'password', 'vid')
+    check_owner('vid', params[2])
     return check_exception(store.add_admin, *params)
 
 
 @app.route('/del-admin')
+@require_session('admin')
 def del_admin():
-    params = get_qparams_or_abort('username')
-    return check_exception(store.del_admin, *params)
+    uname, = get_qparams_or_abort('username')
+    check_owner('username', uname)
+    resp = check_exception(store.del_admin, uname)
+    sessions.delete(session_token())
+    return resp
 
 
 @app.route('/login-admin')
 def login_admin():
-    params = get_qparams_or_abort('username', 'password')
-    return check_result(store.check_admin_credentials(*params), None,
-                        "incorrect username and/or password", 401)
+    '''Log an admin in.  Return their admin ID, the ID of their vendor, and
+    the token for the new session, as {"aid": AID, "vid": VID, "token":
+    TOKEN}.'''
+    uname, pword = get_qparams_or_abort('username', 'password')
+    row = store.check_admin_credentials(uname, pword)
+    if row is None:
+        abort(401, "incorrect username and/or password")
+    aid, vid = row
+    token = sessions.create({'kind': 'admin', 'aid': aid, 'vid': vid,
+                             'username': uname})
+    return encode({'aid': aid, 'vid': vid, 'token': token})
 
 
 # --- API around vendors. ---
 @app.route('/list-vendors')
+@catalog_etag
 def list_vendors():
-    return jsonify(store.list_vendors())
+    after, limit = get_page_or_abort(
+        *get_qparams_or_abort(optional=('after', 'limit')))
+    if limit is None:
+        return stream_rows(store.list_vendors(after))
+    return paged_result(store.list_vendors(after, limit), limit)
 
 
 @app.route('/list-vendors-by-name')
+@catalog_etag
 def list_vendors_by_name():
     name, = get_qparams_or_abort('name')
-    return jsonify(store.list_vendors_by_name(name))
+    return encode(store.list_vendors_by_name(name))
 
 
 # --- API around dishes. ---
 @app.route('/list-dishes-by-vendor')
+@catalog_etag
 def list_dishes_by_vendor():
     vid, = get_qparams_or_abort('vid')
-    return jsonify(store.list_dishes_by_vendor(vid))
+    return encode(store.list_dishes_by_vendor(vid))
 
 
 @app.route('/list-dishes-by-name')
+@catalog_etag
 def list_dishes_by_name():
     name, = get_qparams_or_abort('name')
-    return jsonify(store.list_dishes_by_name(name))
+    return encode(store.list_dishes_by_name(name))
 
 
 # --- API around orders. ---
 @app.route('/add-order')
+@require_session('user')
 def add_order():
     uid, ts = get_qparams_or_abort('uid', 'timestamp')
-    return jsonify(store.add_order(uid, ts))
+    check_owner('uid', uid)
+    return encode(store.add_order(uid, ts))
 
 
+# NOTE: New clients should use /place-order instead.
 @app.route('/add-order-dish')
+@require_session('user')
 def add_order_dish():
     oid, did, qty = get_qparams_or_abort('oid', 'did', 'quantity')
+    uid = store.get_order_uid(oid)
+    if uid is None:
+        abort(404, 'no such order')
+    check_owner('uid', uid)
     try:
         store.add_order_dish(oid, did, qty)
     except Exception:
         abort(500, 'failed to order dish')
     else:
-        return jsonify('OK')
+        return encode('OK')
+
+
+@app.route('/place-order', methods=['POST'])
+@require_session('user')
+def place_order():
+    '''Place a whole order in one go.  The request body is a JSON object like
+    {"uid": UID, "timestamp": TS, "dishes": [[DID, QTY], ...]}.'''
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400, 'expected a JSON object in the request body')
+    for key in ('uid', 'timestamp', 'dishes'):
+        if key not in data:
+            abort(400, "missing field '%s'" % key)
+    try:
+        ts = int(data['timestamp'])
+    except (TypeError, ValueError):
+        abort(400, "field 'timestamp' must be an integer")
+    try:
+        dishes = [(int(did), int(qty)) for did, qty in data['dishes']]
+    except (TypeError, ValueError):
+        abort(400, "field 'dishes' must be a list of [did, quantity] pairs")
+    if not dishes:
+        abort(400, 'cannot place an empty order')
+    if any(qty <= 0 for _, qty in dishes):
+        abort(400, 'dish quantities must be positive')
+    check_owner('uid', data['uid'])
+
+    try:
+        oid = store.place_order(data['uid'], ts, dishes)
+    except sqlite3.IntegrityError:
+        abort(400, 'no such dish')
+    except Exception:
+        abort(500, 'failed to place order')
+    else:
+        return encode(oid)
 
 
 @app.route('/list-order-by-uid')
+@require_session('user')
 def list_order_by_uid():
-    uid, = get_qparams_or_abort('uid')
-    return jsonify(store.list_order_by_uid(uid))
+    uid, after, limit = get_qparams_or_abort('uid',
+                                             optional=('after', 'limit'))
+    check_owner('uid', uid)
+    after, limit = get_page_or_abort(after, limit)
+    if limit is None:
+        return stream_rows(store.iter_order_by_uid(uid, after))
+    return paged_result(store.list_order_by_uid(uid, after, limit), limit)
 
 
 @app.route('/list-order-by-vid')
+@require_session('admin')
 def list_order_by_vid():
-    vid, = get_qparams_or_abort('vid')
-    return jsonify(store.list_order_by_vid(vid))
+    vid, after, limit = get_qparams_or_abort('vid',
+                                             optional=('after', 'limit'))
+    check_owner('vid', vid)
+    after, limit = get_page_or_abort(after, limit)
+    if limit is None:
+        return stream_rows(store.iter_order_by_vid(vid, after))
+    return paged_result(store.list_order_by_vid(vid, after, limit), limit)
+
+
+# These list the same orders as the two above, but as a document per order,
+# with the order's dishes nested in it; see REStore.
+@app.route('/list-order-docs-by-uid')
+@require_session('user')
+def list_order_docs_by_uid():
+    uid, after, limit = get_qparams_or_abort('uid',
+                                             optional=('after', 'limit'))
+    check_owner('uid', uid)
+    after, limit = get_page_or_abort(after, limit)
+    if limit is None:
+        return stream_rows(store.iter_order_docs_by_uid(uid, after))
+    return paged_result(store.list_order_docs_by_uid(uid, after, limit),
+                        limit)
+
+
+@app.route('/list-order-docs-by-vid')
+@require_session('admin')
+def list_order_docs_by_vid():
+    vid, after, limit = get_qparams_or_abort('vid',
+                                             optional=('after', 'limit'))
+    check_owner('vid', vid)
+    after, limit = get_page_or_abort(after, limit)
+    if limit is None:
+        return stream_rows(store.iter_order_docs_by_vid(vid, after))
+    return paged_result(store.list_order_docs_by_vid(vid, after, limit),
+                        limit)
+
+
+@app.route('/list-order-by-uid-between')
+@require_session('user')
+def list_order_by_uid_between():
+    uid, start, end, after, limit = get_qparams_or_abort(
+        'uid', 'from', 'to', optional=('after', 'limit'))
+    check_owner('uid', uid)
+    start, end = get_time_range_or_abort(start, end)
+    after, limit = get_page_or_abort(after, limit)
+    if limit is None:
+        return stream_rows(store.iter_order_by_uid_between(uid, start, end,
+                                                           after))
+    return paged_result(store.list_order_by_uid_between(uid, start, end,
+                                                        after, limit), limit)
+
+
+@app.route('/list-order-by-vid-between')
+@require_session('admin')
+def list_order_by_vid_between():
+    vid, start, end, after, limit = get_qparams_or_abort(
+        'vid', 'from', 'to', optional=('after', 'limit'))
+    check_owner('vid', vid)
+    start, end = get_time_range_or_abort(start, end)
+    after, limit = get_page_or_abort(after, limit)
+    if limit is None:
+        return stream_rows(store.iter_order_by_vid_between(vid, start, end,
+                                                           after))
+    return paged_result(store.list_order_by_vid_between(vid, start, end,
+                                                        after, limit), limit)